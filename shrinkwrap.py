@@ -1,32 +1,91 @@
 #!/usr/bin/env python3
 
 import argparse
+import base64
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
 import datetime
-from collections import namedtuple
+from collections import Counter, deque, namedtuple
 from collections.abc import Sequence
-from contextlib import contextmanager
+from contextlib import ExitStack, contextmanager, nullcontext
+from functools import partial, wraps
+import cProfile
+import hashlib
+import fcntl
+from fnmatch import fnmatch
+import hmac
+import importlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from io import BytesIO
+import json
+import mmap
 import os
 from pathlib import Path
+import platform
+import posixpath
 import re
-from retry import retry
 import shlex
 import shutil
 from subprocess import check_call, check_output, Popen, STDOUT, PIPE, CalledProcessError
 import sys
+import tarfile
+import tempfile
+import threading
+import time
+import tracemalloc
 from typing import Optional
+from urllib.parse import quote, urljoin, urlparse
+from xml.etree import ElementTree
 import zipfile
 
-import jinja2
-import requests
-import semver
-import yaml
+
+class _LazyModule:
+    """A dependency imported when it's first used, so the cli and importing shrinkwrap stay fast."""
+
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        return getattr(importlib.import_module(self._name), attr)
+
+
+jinja2 = _LazyModule("jinja2")
+requests = _LazyModule("requests")
+semver = _LazyModule("semver")
+yaml = _LazyModule("yaml")
+
+
+def retry(exceptions, tries=-1, delay=0, backoff=1):
+    """
+    The retry package's decorator, imported once a decorated function is first called.
+
+    @param exceptions: exception class or tuple of them, or a callable returning those of a lazy dependency
+    """
+
+    def decorator(fn):
+        @wraps(fn)
+        def retried(*args, **kwargs):
+            from retry.api import retry_call
+
+            caught = exceptions if isinstance(exceptions, (type, tuple)) else exceptions()
+            return retry_call(fn, args, kwargs, caught, tries, delay, backoff=backoff)
+
+        return retried
+
+    return decorator
+
 
 shlx = shlex.split
+_print_lock = threading.Lock()
 
 
 @contextmanager
 def status(msg):
+    if threading.current_thread() is not threading.main_thread():
+        # concurrent workers report on a single line once finished
+        yield
+        with _print_lock:
+            print(f"    {msg} ... done")
+        return
     sys.stdout.write(f"    {msg} ... ")
     sys.stdout.flush()
     yield
@@ -45,34 +104,1221 @@ def remove_suffix(str_o, suffix):
     return str_o
 
 
-def get_args():
+# libyaml's loader and dumper are used when pyyaml is built with it, they're an order of magnitude faster
+def load_yaml(stream):
+    return yaml.load(stream, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+
+
+def dump_yaml(data, stream):
+    return yaml.dump(data, stream, Dumper=getattr(yaml, "CSafeDumper", yaml.SafeDumper))
+
+
+def render_template(name, target: Path, **context):
+    """Render one of the templates shipped with shrinkwrap into target."""
+    template = jinja2.Template((Path(__file__).parent / "templates" / name).read_text())
+    target.write_text(template.render(**context))
+
+
+def extract_charm(content: bytes, path):
+    """Unpack a downloaded charm archive into path."""
+    zipfile.ZipFile(BytesIO(content)).extractall(path)
+
+
+def packed_charm(charm_path: Path) -> Path:
+    """Path of the .charm archive kept in place of the charm's extracted folder."""
+    return Path(f"{charm_path}.charm")
+
+
+def charm_file(charm_path: Path, name):
+    """
+    Open a file of a charm, whether it's extracted or kept as its .charm archive.
+
+    Only the requested member of a packed charm is read, into memory.
+    """
+    if charm_path.suffix == ".charm" and charm_path.is_file():
+        with zipfile.ZipFile(charm_path) as charm:
+            return BytesIO(charm.read(name))
+    return (charm_path / name).open("rb")
+
+
+def load_charm_yaml(charm_path: Path, name, documents=None):
+    """
+    Parse a YAML file of a charm.
+
+    @param documents: DocumentCache of documents already parsed, the file is always parsed when None
+    """
+    with charm_file(charm_path, name) as fp:
+        return documents.load(fp.read()) if documents else load_yaml(fp)
+
+
+def get_args(argv=None):
     """Parse cli arguments."""
     parser = argparse.ArgumentParser()
-    parser.add_argument("bundle", type=str, help="the bundle to shrinkwrap")
+    parser.add_argument("bundle", type=str, nargs="?", help="the bundle to shrinkwrap")
     parser.add_argument("--channel", "-c", default=None, help="the channel of the bundle")
-    parser.add_argument("--arch", "-a", default=None, help="the target architecture of the bundle")
+    parser.add_argument(
+        "--arch",
+        "-a",
+        default=None,
+        action="append",
+        help="the target architecture of the bundle, repeat or comma separate for multiple architectures",
+    )
     parser.add_argument(
         "--overlay",
         default=list(),
         action="append",
         help="Set of overlays to apply to the base bundle.",
     )
+    parser.add_argument(
+        "--only-apps",
+        default=None,
+        action="append",
+        help="shrinkwrap only these applications of the bundle and overlays, repeat or comma separate",
+    )
+    parser.add_argument(
+        "--exclude-apps",
+        default=None,
+        action="append",
+        help="leave these applications out of the bundle and overlays, repeat or comma separate",
+    )
+    parser.add_argument(
+        "--image-allow",
+        default=None,
+        action="append",
+        help="only download container images matching one of these patterns, e.g. 'pause:*'",
+    )
+    parser.add_argument(
+        "--image-deny", default=None, action="append", help="skip container images matching any of these patterns"
+    )
+    parser.add_argument(
+        "--image-map",
+        default=None,
+        help="YAML mapping of charm or application names to the image patterns they deploy, "
+        "images mapped only to charms which aren't shrinkwrapped are skipped",
+    )
     parser.add_argument("--use_path", "-d", default=None, help="Reuse existing downloaded shrinkwrap path")
     parser.add_argument("--skip-resources", action="store_true", help="Skip downloading attached charm resources")
     parser.add_argument("--skip-snaps", action="store_true", help="Skip downloading required charm snaps")
     parser.add_argument("--skip-containers", action="store_true", help="Skip downloading container images")
     parser.add_argument("--skip-tar-gz", action="store_true", help="Skip creating a tar.gz in the ./build folder")
-    return parser.parse_args()
+    parser.add_argument(
+        "--packed-charms",
+        action="store_true",
+        help="Keep charms as their .charm archives rather than extracting them",
+    )
+    parser.add_argument(
+        "--batch",
+        default=None,
+        help="YAML list of targets (bundle, channel, overlay, arch) built together from one artifact store",
+    )
+    parser.add_argument(
+        "--store",
+        default=None,
+        help="Artifact store shared between builds (default for --batch: ./build/.store)",
+    )
+    parser.add_argument(
+        "--upload",
+        default=None,
+        metavar="s3://BUCKET/PREFIX",
+        help="Stream the tarball to S3 compatible object storage rather than writing it to ./build",
+    )
+    parser.add_argument("--upload-part-size", type=int, default=64, help="MiB in each part of the upload")
+    parser.add_argument("--upload-workers", type=int, default=4, help="number of parts uploaded concurrently")
+    parser.add_argument(
+        "--max-disk",
+        type=disk_size,
+        default=None,
+        help="Disk the build may stage at once (e.g. 40G), failing early when its plan can't fit",
+    )
+    parser.add_argument(
+        "--coordinate",
+        default=None,
+        metavar="HOST:PORT",
+        help="Serve the snap, resource and image downloads to workers on this address, e.g. :8081",
+    )
+    parser.add_argument(
+        "--local-workers",
+        type=int,
+        default=0,
+        help="number of worker processes started on this host for --coordinate",
+    )
+    parser.add_argument(
+        "--prometheus-textfile",
+        default=None,
+        help="Also write the build metrics in the prometheus textfile format to this file",
+    )
+    parser.add_argument(
+        "--profile",
+        default=None,
+        help="Write CPU (pstats) and memory profiles of every build stage into this folder",
+    )
+    args = parser.parse_args(argv)
+    if not (args.bundle or args.batch):
+        parser.error("either a bundle or --batch targets are required")
+    if args.batch and (args.bundle or args.use_path):
+        parser.error("--batch cannot be combined with a bundle or --use_path")
+    if args.upload and args.skip_tar_gz:
+        parser.error("--upload cannot be combined with --skip-tar-gz")
+    if args.local_workers and not args.coordinate:
+        parser.error("--local-workers requires --coordinate")
+    args.arch = arch_list(args.arch)
+    args.only_apps, args.exclude_apps = comma_list(args.only_apps), comma_list(args.exclude_apps)
+    return args
+
+
+def comma_list(args):
+    """Flatten repeated and comma separated arguments, preserving their order."""
+    if not args:
+        return None
+    values = [value.strip() for arg in args for value in arg.split(",") if value.strip()]
+    return list(dict.fromkeys(values)) or None
+
+
+def arch_list(arch_args):
+    return comma_list(arch_args)
+
+
+def host_arch():
+    """Snap architecture of this host, e.g. amd64, fetched when a build isn't given its architectures."""
+    return SnapDownloader.HOST_ARCHES.get(platform.machine(), platform.machine())
+
+
+def disk_size(value):
+    """Bytes of a size such as 512M, 40G or 1.5T."""
+    match = re.fullmatch(r"([\d.]+)\s*([KMGT]?)(?:i?B)?", str(value).strip(), re.IGNORECASE)
+    if not match:
+        raise argparse.ArgumentTypeError(f"{value} isn't a size such as 512M or 40G")
+    number, unit = match.groups()
+    return int(float(number) * 1024 ** "_KMGT".index(unit.upper() or "_"))
+
+
+def human_size(size):
+    return f"{size / 2**30:.1f} GiB"
+
+
+def batch_targets(args):
+    """
+    Build arguments for every target of a batch file.
+
+    Each target is a mapping with a required "bundle" and optional "channel", "overlay" and "arch",
+    the remaining arguments are shared by all targets.
+    """
+    with Path(args.batch).open() as fp:
+        targets = load_yaml(fp) or []
+    assert isinstance(targets, list), f"{args.batch} should contain a list of targets"
+
+    for target in targets:
+        assert "bundle" in target, f"Batch target {target} doesn't name a bundle"
+        overlay = target.get("overlay") or []
+        arch = target.get("arch")
+        target_args = dict(vars(args))
+        target_args.update(
+            bundle=target["bundle"],
+            channel=target.get("channel"),
+            overlay=[overlay] if isinstance(overlay, str) else list(overlay),
+            arch=arch_list([arch] if isinstance(arch, str) else arch) or args.arch,
+            batch=None,
+        )
+        yield argparse.Namespace(**target_args)
 
 
-class Downloader:
+@contextmanager
+def file_lock(path: Path, blocking=True):
+    """
+    Exclusive lock between processes and threads, held while the context is open.
+
+    @param blocking: False raises BlockingIOError rather than waiting for another holder
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open("a") as fp:
+        fcntl.flock(fp, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        try:
+            yield
+        finally:
+            fcntl.flock(fp, fcntl.LOCK_UN)
+
+
+def thread_pool(workers):
+    """Threads of a build which print wherever the thread creating them prints, e.g. into a service job's log."""
+    output = sys.stdout
+    return ThreadPoolExecutor(
+        max_workers=workers, initializer=output.inherit() if isinstance(output, _JobOutput) else None
+    )
+
+
+def named_lock(name, blocking=True):
+    """Lock shared by every shrinkwrap process on this host, e.g. for a build path or a docker tag."""
+    digest = hashlib.sha256(name.encode()).hexdigest()
+    return file_lock(Path(tempfile.gettempdir()) / "shrinkwrap-locks" / f"{digest}.lock", blocking)
+
+
+def path_lock(path: Path):
+    """Lock of a path written by concurrent builds, kept out of the build so it isn't archived."""
+    return named_lock(f"path:{Path(path).resolve()}")
+
+
+# read once, as the umask can only be read by setting it
+UMASK = os.umask(0o022)
+os.umask(UMASK)
+
+
+def replace_file(path: Path, text: str):
+    """Replace a file atomically, through a temporary file unique to this writer so concurrent writers don't collide."""
+    fd, partial = tempfile.mkstemp(prefix=f".{path.name}.", dir=path.parent)
+    try:
+        with os.fdopen(fd, "w") as fp:
+            fp.write(text)
+        # mkstemp files are private to their owner, files shared through a store are written as open() would
+        os.chmod(partial, 0o666 & ~UMASK)
+        os.replace(partial, path)
+    except BaseException:
+        os.unlink(partial)
+        raise
+
+
+def read_journal(path: Path):
+    """Entries of a json lines journal, none when it doesn't exist."""
+    entries = []
+    if path.exists():
+        for line in path.read_text().splitlines():
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                continue  # an interrupted write leaves a partial final line
+    return entries
+
+
+def append_journal(path: Path, entry: dict):
+    """Append an entry to a json lines journal, durably before returning."""
+    with path.open("a+b") as fp:
+        line = json.dumps(entry).encode() + b"\n"
+        if fp.seek(0, os.SEEK_END):
+            fp.seek(-1, os.SEEK_END)
+            if fp.read(1) != b"\n":
+                line = b"\n" + line  # start after the partial line of an interrupted write
+        fp.write(line)
+        fp.flush()
+        os.fsync(fp.fileno())
+
+
+def _link_tree(source: Path, target: Path):
+    """Hard link source into target, copying when the link crosses file systems."""
+
+    def _link(src, dst):
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        if dst.exists() or dst.is_symlink():
+            dst.unlink()
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copy2(src, dst)
+
+    if not source.is_dir():
+        return _link(source, target)
+    target.mkdir(parents=True, exist_ok=True)
+    for src in source.rglob("*"):
+        dst = target / src.relative_to(source)
+        if src.is_dir():
+            dst.mkdir(parents=True, exist_ok=True)
+        else:
+            _link(src, dst)
+
+
+class DocumentCache:
+    """
+    Parsed YAML documents keyed by the digest of their content, persisted so reruns don't parse them again.
+
+    Documents are kept as JSON, which is parsed far faster than YAML, and a fresh copy is returned for
+    every load so callers may change it. Documents which don't survive a round trip through JSON aren't kept.
+    Only the most recently used documents are persisted, so a long lived store's file stays small.
+    """
+
+    def __init__(self, path, max_documents=2048):
+        """
+        @param path: PathLike[str] of the JSON file the documents are persisted in
+        @param max_documents: documents persisted, the least recently used are dropped beyond it
+        """
+        self.path = Path(path)
+        self.max_documents = max_documents
+        self._documents = {}
+        self._changed = False
+        self._lock = threading.Lock()
+        if self.path.exists():
+            try:
+                self._documents = json.loads(self.path.read_text())
+            except ValueError:
+                pass  # rebuilt from the documents as they're parsed again
+
+    def load(self, content: bytes):
+        key = f"sha256:{hashlib.sha256(content).hexdigest()}"
+        with self._lock:
+            cached = self._documents.pop(key, None)
+            if cached is not None:
+                self._documents[key] = cached  # most recently used last
+        if cached is not None:
+            return json.loads(cached)
+        document = load_yaml(content)
+        try:
+            cached = json.dumps(document)
+        except (TypeError, ValueError):
+            return document
+        if json.loads(cached) == document:
+            with self._lock:
+                self._documents[key] = cached
+                self._changed = True
+        return document
+
+    def save(self):
+        with self._lock:
+            if not self._changed:
+                return
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            # builds sharing a store save concurrently, so keep whatever the others saved first
+            with path_lock(self.path):
+                if self.path.exists():
+                    try:
+                        saved = json.loads(self.path.read_text())
+                    except ValueError:
+                        saved = {}
+                    saved = {key: value for key, value in saved.items() if key not in self._documents}
+                    self._documents = {**saved, **self._documents}
+                dropped = list(self._documents)[: max(len(self._documents) - self.max_documents, 0)]
+                for key in dropped:
+                    del self._documents[key]
+                replace_file(self.path, json.dumps(self._documents))
+            self._changed = False
+
+
+class ArtifactStore:
+    """
+    Artifacts shared between builds, keyed by what they are rather than where a build places them.
+
+    Builds link artifacts out of the store into their own root, so a charm, resource, snap
+    or image needed by several bundles or channels is only downloaded once.
+    """
+
+    def __init__(self, path, ttl=None):
+        """
+        @param path: PathLike[str]
+        @param ttl: seconds resolved metadata is reused for, forever when None
+        """
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self._resolved = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(*parts):
+        return "/".join(re.sub(r"[^\w.:+=@-]", "_", str(part)) for part in parts if part)
+
+    def _key_lock(self, key):
+        """Lock held while a key is resolved or fetched, so concurrent builds wait rather than fetch it again."""
+        with self._lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def memo(self, key, resolve):
+        """Resolve metadata once for every build using this store."""
+        with self._key_lock(("memo", key)):
+            resolved = self._resolved.get(key)
+            if resolved is None or (self.ttl is not None and time.monotonic() - resolved[0] > self.ttl):
+                resolved = self._resolved[key] = time.monotonic(), resolve()
+        return resolved[1]
+
+    def provide(self, key, target: Path, fetch):
+        """
+        Link the artifact stored at key into target.
+
+        @param fetch: callable populating a path with the artifact, called only when it isn't stored
+        """
+        entry = self.path / key
+        # other processes sharing the store wait on the lock file, then reuse what was fetched
+        with self._key_lock(key), file_lock(self.path / ".locks" / f"{key}.lock"):
+            if entry.exists():
+                print(f'    Stored "{key}" reused')
+            else:
+                partial = entry.with_name(f"{entry.name}.partial")
+                if partial.is_dir():
+                    shutil.rmtree(partial)
+                elif partial.exists():
+                    partial.unlink()
+                partial.parent.mkdir(parents=True, exist_ok=True)
+                fetch(partial)
+                partial.rename(entry)
+        _link_tree(entry, target)
+        return target
+
+
+# files from this size are hashed through a memory map rather than buffered reads
+MMAP_DIGEST_SIZE = 64 << 20
+
+
+def file_digest(path: Path):
+    digest = hashlib.sha256()
+    with path.open("rb") as fp:
+        if os.fstat(fp.fileno()).st_size >= MMAP_DIGEST_SIZE:
+            # hashlib releases the GIL while hashing the mapped file, so threads hash large files on every core
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                if hasattr(mapped, "madvise"):
+                    mapped.madvise(mmap.MADV_SEQUENTIAL)
+                digest.update(mapped)
+        else:
+            for chunk in iter(lambda: fp.read(1 << 20), b""):
+                digest.update(chunk)
+    return f"sha256:{digest.hexdigest()}"
+
+
+def tree_digest(path: Path, digest_file=file_digest):
+    """
+    Digest of a file, or of every file name and content within a folder.
+
+    @param digest_file: callable returning the digest of each file, e.g. from digests already computed
+    """
+    if not path.is_dir():
+        return digest_file(path)
+    digest = hashlib.sha256()
+    for sub in sorted(sub for sub in path.rglob("*") if sub.is_file()):
+        digest.update(f"{sub.relative_to(path).as_posix()}\0{digest_file(sub)}\n".encode())
+    return f"sha256:{digest.hexdigest()}"
+
+
+def _tree_size(path: Path):
+    if path.is_dir():
+        return sum(sub.stat().st_size for sub in path.rglob("*") if sub.is_file())
+    return path.stat().st_size if path.exists() else 0
+
+
+def _mtime(path: Path):
+    return path.stat().st_mtime_ns if path.exists() else None
+
+
+class Artifact(namedtuple("Artifact", "kind, app, name, revision, arch, path, size, digest")):
+    """An artifact written into a build, its path is relative to the build root."""
+
+    @property
+    def local_path(self):
+        return f"./{self.path}"
+
+
+class BuildJournal:
+    """
+    Append-only record of a build's progress, so a restarted build continues where it stopped.
+
+    Resolved metadata is replayed rather than requested again, completed artifacts keep their digest,
+    and finished steps of the pipeline are skipped.
+    """
+
+    def __init__(self, path, target=None):
+        """
+        @param path: PathLike[str]
+        @param target: json description of the build, the journal of any other build is started again
+        """
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self.steps = {}
+        self.resolved = {}
+        self.artifacts = {}
+        entries = read_journal(self.path)
+        self.resumed = bool(entries) and entries[0] == {"step": "start", "target": target}
+        if self.resumed:
+            for entry in entries[1:]:
+                self._apply(entry)
+        else:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.path.write_text("")
+            self.record("start", target=target)
+
+    def _apply(self, entry):
+        step = entry["step"]
+        if step == "resolve":
+            self.resolved[entry["key"]] = entry["value"]
+        elif step == "artifact":
+            self.artifacts[entry["path"]] = entry
+        else:
+            self.steps[step] = entry
+
+    def record(self, step, **details):
+        entry = dict(details, step=step)
+        with self._lock:
+            append_journal(self.path, entry)
+            self._apply(entry)
+
+    def done(self, step):
+        return step in self.steps
+
+    def memo(self, key, resolve):
+        """Resolve metadata once for every run of this build."""
+        key = json.dumps(key)
+        if key not in self.resolved:
+            self.record("resolve", key=key, value=resolve())
+        return self.resolved[key]
+
+    def artifact(self, path: Path):
+        """Record an artifact completely written into the build."""
+        self.record(
+            "artifact",
+            path=str(path),
+            size=_tree_size(path),
+            mtime_ns=path.stat().st_mtime_ns,
+            digest=tree_digest(path),
+        )
+
+    def completed(self, path: Path):
+        return str(path) in self.artifacts
+
+    def digest(self, path: Path):
+        """Digest recorded for the artifact, None when it wasn't recorded or has changed since."""
+        entry = self.artifacts.get(str(path))
+        if (
+            entry
+            and path.exists()
+            and (entry["size"], entry["mtime_ns"]) == (_tree_size(path), path.stat().st_mtime_ns)
+        ):
+            return entry["digest"]
+        return None
+
+
+class ArtifactIndex:
+    """
+    Every artifact the downloaders wrote into a build root.
+
+    The index is persisted as the build's artifacts.json manifest, which renders the offline bundle
+    without walking the build tree. Digests are computed when the manifest is saved, and reused from
+    the previous manifest for artifacts which haven't changed since.
+    """
+
+    MANIFEST = "artifacts.json"
+
+    def __init__(self, root):
+        """
+        @param root: PathLike[str]
+        """
+        self.root = Path(root)
+        self._artifacts = {}
+        self._mtimes = {}
+        self._lock = threading.Lock()
+        # callables given the index and each artifact it records
+        self.listeners = []
+
+    def add(self, kind, path: Path, app=None, name=None, revision=None, arch=None):
+        """Record an artifact written into the build root, those which weren't written are skipped."""
+        path = Path(path)
+        if not path.exists():
+            return None
+        artifact = Artifact(kind, app, name, revision, arch, path.relative_to(self.root).as_posix(), None, None)
+        artifact = artifact._replace(size=_tree_size(path))
+        with self._lock:
+            previous = self._artifacts.get(artifact.path)
+            if previous and previous[:-1] == artifact[:-1] and self._unchanged(artifact.path):
+                artifact = artifact._replace(digest=previous.digest)
+            self._artifacts[artifact.path] = artifact
+        for listener in self.listeners:
+            listener(self, artifact)
+        return artifact
+
+    def seal(self, path):
+        """Compute the digest of an artifact now, before it's removed from the build root."""
+        digest = tree_digest(self.root / path)
+        with self._lock:
+            self._artifacts[path] = self._artifacts[path]._replace(digest=digest)
+
+    def _unchanged(self, path):
+        return self._mtimes.get(path) == (self.root / path).stat().st_mtime_ns
+
+    def of(self, kind):
+        return [artifact for artifact in self if artifact.kind == kind]
+
+    def find(self, kind, app=None, name=None):
+        """The first artifact of a kind matching the application and name."""
+        for artifact in self.of(kind):
+            if (app is None or artifact.app == app) and (name is None or artifact.name == name):
+                return artifact
+        return None
+
+    def __iter__(self):
+        return iter(sorted(self._artifacts.values(), key=lambda a: a.path))
+
+    def save(self, journal: Optional[BuildJournal] = None):
+        """
+        Write the manifest, computing the digest of every new or changed artifact.
+
+        @param journal: digests recorded as the artifacts were downloaded
+        """
+        with self._lock:
+            for path, artifact in self._artifacts.items():
+                if artifact.digest is None:
+                    digest = journal and journal.digest(self.root / path)
+                    self._artifacts[path] = artifact._replace(digest=digest or tree_digest(self.root / path))
+            # artifacts already streamed into the tarball have no mtime
+            entries = [
+                dict(artifact._asdict(), mtime_ns=_mtime(self.root / artifact.path))
+                for artifact in sorted(self._artifacts.values(), key=lambda a: a.path)
+            ]
+        manifest = self.root / self.MANIFEST
+        # builds sharing a root save their manifests concurrently
+        with path_lock(manifest):
+            replace_file(manifest, json.dumps({"version": 1, "artifacts": entries}, indent=1))
+
+    @classmethod
+    def load(cls, root):
+        """
+        The index saved in the build root, dropping artifacts which no longer exist.
+
+        :rvalue: Optional[ArtifactIndex]
+        """
+        index = cls(root)
+        manifest = index.root / cls.MANIFEST
+        if not manifest.exists():
+            return None
+        for entry in json.loads(manifest.read_text())["artifacts"]:
+            mtime_ns = entry.pop("mtime_ns", None)
+            artifact = Artifact(**entry)
+            if (index.root / artifact.path).exists():
+                index._artifacts[artifact.path] = artifact
+                index._mtimes[artifact.path] = mtime_ns
+        return index
+
+    @classmethod
+    def scan(cls, root, arches=None):
+        """Index the artifacts of a build tree written before builds saved a manifest."""
+        index = cls(root)
+        for rsc_path in index.root.glob("resources/*/*/*"):
+            app, name = rsc_path.parent.parent.name, rsc_path.parent.name
+            index.add("resource", rsc_path, app=app, name=name)
+        for snap in index.root.glob("snaps/**/*.tar.gz"):
+            index.add("snap", snap, name=snap.relative_to(index.root / "snaps").parts[0])
+        containers_path = index.root / "containers"
+        for arch in arches if arches and len(arches) > 1 else [None]:
+            arch_path = containers_path / arch if arch else containers_path
+            for container_tgz in arch_path.glob("**/*.tar.gz"):
+                image = remove_suffix(container_tgz.relative_to(arch_path).as_posix(), ".tar.gz")
+                index.add("container", container_tgz, name=image, arch=arch)
+        return index
+
+
+class DiskBudget:
+    """
+    Bound on the disk a build stages, admitting each transfer only once its expected size fits.
+
+    The staging of the whole plan is estimated before anything is fetched, so a plan which can't
+    fit fails straight away rather than once the disk is full.
+    """
+
+    def __init__(self, limit, packager=None):
+        """
+        @param limit: bytes the build root, its tarball and the transfers in flight may use together
+        @param packager: StreamingPackager archiving artifacts as they complete, None keeps them in the root
+        """
+        self.limit = limit
+        self.packager = packager
+        self.used = 0
+        self._reserved = 0
+        self._changed = threading.Condition()
+
+    def attach(self, index):
+        """Hand every artifact the index records to the packager."""
+        if self.packager:
+            index.listeners.append(self.packager.add)
+
+    def check(self, used, pending):
+        """
+        Fail unless the plan fits the budget, returning its estimated peak.
+
+        @param used: bytes already written into the build root
+        @param pending: list of (size, staging) estimates of the artifacts still to be fetched
+        """
+        total = used + sum(size for size, _ in pending)
+        # an image is pulled into docker before it's saved, and a packed artifact is briefly in the tarball twice
+        extra = [staging - size for size, staging in pending]
+        if self.packager:
+            extra += [size for size, _ in pending]
+        peak = total + max(extra, default=0)
+        assert peak <= self.limit, (
+            f"The build needs an estimated {human_size(peak)} of disk ({human_size(total)} of artifacts), "
+            f"more than the --max-disk budget of {human_size(self.limit)}"
+        )
+        self.used = used
+        return peak
+
+    @contextmanager
+    def admit(self, expected, target: Path):
+        """Hold a transfer until its expected staging fits the budget, then charge what it wrote to target."""
+        with self._changed:
+            while self._reserved and self.used + self._reserved + expected > self.limit:
+                self._changed.wait()
+            assert self.used + expected <= self.limit, (
+                f"Fetching {target} needs an estimated {human_size(expected)} with {human_size(self.used)} "
+                f"already used, more than the --max-disk budget of {human_size(self.limit)}"
+            )
+            self._reserved += expected
+        try:
+            yield
+        finally:
+            with self._changed:
+                self._reserved -= expected
+                self.used += _tree_size(target)
+                self._changed.notify_all()
+
+
+class StreamingPackager:
+    """
+    Write the build's tarball while it downloads, removing each artifact from the root once packed.
+
+    Snaps, resources and images are packed as soon as they're indexed and the rest of the root when the
+    packager is closed, so the disk never holds both the complete root and its tarball.
+    """
+
+    KINDS = {"snap", "resource", "container"}
+
+    def __init__(self, root, output):
+        """
+        @param root: PathLike[str]
+        @param output: PathLike[str] of the tarball, written as .partial until it's closed
+        """
+        self.root = Path(root)
+        self.output = Path(output)
+        self._partial = self.output.with_name(f"{self.output.name}.partial")
+        self._tar = tarfile.open(self._partial, "w:gz", compresslevel=6)
+        # a single thread appends to the tarball, in the order artifacts complete
+        self._pool = thread_pool(1)
+        self._futures = []
+
+    def add(self, index, artifact: Artifact):
+        if artifact.kind in self.KINDS:
+            self._futures.append(self._pool.submit(self._pack, index, artifact))
+
+    def _pack(self, index, artifact: Artifact):
+        path = self.root / artifact.path
+        if not (path.exists() or path.is_symlink()):
+            return
+        # the manifest still needs the digest of an artifact no longer in the root
+        index.seal(artifact.path)
+        self._tar.add(path, arcname=(Path(self.root.name) / artifact.path).as_posix())
+        if path.is_dir() and not path.is_symlink():
+            shutil.rmtree(path)
+        else:
+            path.unlink()
+
+    def wait(self):
+        """Wait for the artifacts handed to the packager to be packed."""
+        for future in self._futures:
+            future.result()
+
+    def close(self):
+        """Pack the rest of the root and complete the tarball, removing the root."""
+        self.wait()
+        self._pool.shutdown()
+        self._tar.add(self.root, arcname=self.root.name)
+        self._tar.close()
+        self._partial.rename(self.output)
+        shutil.rmtree(self.root)
+
+
+class Profiler:
+    """
+    CPU and memory profile of each build stage, enabled with --profile.
+
+    Stages are profiled on the thread running the pipeline. Work handed to worker threads
+    or subprocesses only shows up as the time the stage spends waiting for it.
+    """
+
+    TOP_ALLOCATIONS = 10
+
     def __init__(self, path):
+        """
+        @param path: PathLike[str] folder receiving the profiles
+        """
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.profiles = {}
+        self.memory = {}
+        self._tracing = not tracemalloc.is_tracing()
+        if self._tracing:
+            tracemalloc.start()
+
+    @staticmethod
+    def _snapshot():
+        return tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+
+    @contextmanager
+    def stage(self, name):
+        profile = self.profiles.setdefault(name, cProfile.Profile())
+        before = self._snapshot()
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            _, peak = tracemalloc.get_traced_memory()
+            memory = self.memory.setdefault(name, {"peak": 0, "allocations": Counter()})
+            memory["peak"] = max(memory["peak"], peak)
+            for stat in self._snapshot().compare_to(before, "lineno")[: self.TOP_ALLOCATIONS]:
+                memory["allocations"][str(stat.traceback)] += stat.size_diff
+
+    def write(self):
+        """Write a pstats file per stage, with a summary of their memory peaks and top allocations."""
+        lines = []
+        for name, profile in self.profiles.items():
+            profile.dump_stats(str(self.path / f"{name}.pstats"))
+            memory = self.memory[name]
+            lines.append(f"{name}: peak {memory['peak'] / 2**20:.1f} MiB")
+            for location, size in memory["allocations"].most_common(self.TOP_ALLOCATIONS):
+                lines.append(f"    {size / 2**10:12.1f} KiB  {location}")
+        (self.path / "memory.txt").write_text("\n".join(lines) + "\n")
+        if self._tracing:
+            tracemalloc.stop()
+
+
+# the artifact record each thread is fetching, so retries deep within its transfer are counted against it
+_fetching = threading.local()
+
+
+def count_retry():
+    """Count a retry of whatever transfer the artifact fetched on this thread is making."""
+    record = getattr(_fetching, "record", None)
+    if record is not None:
+        record["retried"] += 1
+
+
+class Metrics:
+    """
+    Timing and throughput of a build, per stage and per artifact.
+
+    Artifacts are recorded by the downloaders, stages by the build pipeline.
+    """
+
+    def __init__(self, profiler: Optional[Profiler] = None, progress=None):
+        """
+        @param profiler: also profiles every stage
+        @param progress: callable given a Progress as each stage starts and finishes, and each artifact is fetched
+        """
+        self.profiler = profiler
+        self.progress = progress
+        self.started = datetime.datetime.now()
+        self._start = time.monotonic()
+        self.stages = {}
+        self.artifacts = []
+        self._lock = threading.Lock()
+
+    def _notify(self, *progress):
+        if self.progress:
+            self.progress(Progress(*progress))
+
+    @contextmanager
+    def stage(self, name):
+        self._notify("started", name, None, None, None)
+        start = time.monotonic()
+        try:
+            with self.profiler.stage(name) if self.profiler else nullcontext():
+                yield
+        finally:
+            seconds = time.monotonic() - start
+            with self._lock:
+                self.stages[name] = self.stages.get(name, 0.0) + seconds
+            self._notify("finished", name, None, round(seconds, 3), None)
+
+    @contextmanager
+    def artifact(self, kind, name):
+        """
+        Record fetching an artifact, the caller sets its "bytes" once transferred.
+
+        An artifact without any bytes transferred was reused from a previous download.
+        """
+        record = {"kind": kind, "name": name, "bytes": 0, "attempts": 0, "retried": 0}
+        _fetching.record = record
+        start = time.monotonic()
+        try:
+            yield record
+        finally:
+            _fetching.record = None
+            record["seconds"] = round(time.monotonic() - start, 3)
+            record["retries"] = max(record.pop("attempts") - 1, 0) + record.pop("retried")
+            record["reused"] = not record["bytes"]
+            with self._lock:
+                self.artifacts.append(record)
+            self._notify("fetched", name, kind, record["seconds"], record["bytes"])
+
+    def attempt(self):
+        """Count an attempt at transferring the artifact recorded on this thread."""
+        record = getattr(_fetching, "record", None)
+        if record is not None:
+            record["attempts"] += 1
+
+    def report(self):
+        totals = {}
+        for record in self.artifacts:
+            total = totals.setdefault(record["kind"], {"count": 0, "bytes": 0, "seconds": 0.0, "retries": 0})
+            total["count"] += 1
+            total["bytes"] += record["bytes"]
+            total["seconds"] += record["seconds"]
+            total["retries"] += record["retries"]
+        for total in totals.values():
+            total["seconds"] = round(total["seconds"], 3)
+            total["bytes_per_second"] = round(total["bytes"] / total["seconds"]) if total["seconds"] else 0
+        return {
+            "started": self.started.isoformat(timespec="seconds"),
+            "seconds": round(time.monotonic() - self._start, 3),
+            "stages": {name: round(seconds, 3) for name, seconds in self.stages.items()},
+            "totals": totals,
+            "artifacts": self.artifacts,
+            "metadata": METADATA.report(),
+        }
+
+    def write(self, path):
         """
         @param path: PathLike[str]
         """
+        Path(path).write_text(json.dumps(self.report(), indent=2))
+
+    def write_prometheus(self, path):
+        """
+        Write the report as a node-exporter textfile.
+
+        @param path: PathLike[str]
+        """
+        report = self.report()
+        metrics = [
+            ("shrinkwrap_build_seconds", "Wall time of the build", [("", report["seconds"])]),
+            (
+                "shrinkwrap_stage_seconds",
+                "Wall time of each build stage",
+                [(f'stage="{name}"', seconds) for name, seconds in report["stages"].items()],
+            ),
+        ]
+        for field, help_text in [
+            ("count", "Artifacts fetched"),
+            ("bytes", "Bytes transferred"),
+            ("seconds", "Time spent fetching artifacts"),
+            ("bytes_per_second", "Artifact throughput"),
+            ("retries", "Retried artifact transfers"),
+        ]:
+            samples = [(f'kind="{kind}"', total[field]) for kind, total in report["totals"].items()]
+            metrics.append((f"shrinkwrap_artifact_{field}", help_text, samples))
+
+        lines = []
+        for metric, help_text, samples in metrics:
+            lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} gauge"]
+            lines += [f"{metric}{{{labels}}} {value}" if labels else f"{metric} {value}" for labels, value in samples]
+        # textfile collectors may read at any time, so replace the file atomically
+        partial = Path(f"{path}.partial")
+        partial.write_text("\n".join(lines) + "\n")
+        partial.rename(path)
+
+
+class MetadataClient:
+    """
+    Idempotent requests for store and github metadata, bounded by timeouts and hedged against slow responses.
+
+    Once enough responses are timed, a request still unanswered after the recent p95 latency is sent again
+    and whichever response arrives first is used, so one slow response doesn't stall a serial build.
+    """
+
+    def __init__(
+        self, connect_timeout=5.0, read_timeout=30.0, percentile=95, min_samples=20, min_delay=0.25, window=500
+    ):
+        """
+        @param connect_timeout: seconds to connect to the server
+        @param read_timeout: seconds to wait for each read of the response
+        @param percentile: latency percentile after which a request is hedged
+        @param min_samples: responses timed before requests are hedged
+        @param min_delay: seconds a request is always given before it's hedged
+        @param window: number of recent responses the percentile is taken from
+        """
+        self.timeout = (connect_timeout, read_timeout)
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.pooled = False
+        self.requests = self.hedged = self.failures = 0
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._sessions = threading.local()
+        self._hedges = ThreadPoolExecutor(max_workers=16)
+
+    def pool(self):
+        """Keep connections open between requests, each thread reusing its own session."""
+        self.pooled = True
+
+    def _send(self, method, url, timed=True, **kwargs):
+        if self.pooled:
+            if not hasattr(self._sessions, "session"):
+                self._sessions.session = requests.Session()
+            send = getattr(self._sessions.session, method)
+        else:
+            send = getattr(requests, method)
+        start = time.monotonic()
+        try:
+            resp = send(url, timeout=self.timeout, **kwargs)
+        except requests.RequestException:
+            with self._lock:
+                self.failures += 1
+            raise
+        with self._lock:
+            self.requests += 1
+            if timed:
+                self._latencies.append(time.monotonic() - start)
+        return resp
+
+    def latency(self, percentile):
+        """Seconds within which the percentile of recent responses arrived, None before any are timed."""
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, len(latencies) * percentile // 100)]
+
+    def hedge_delay(self):
+        """Seconds a request is given before it's sent again, None while too few responses are timed."""
+        if len(self._latencies) < self.min_samples:
+            return None
+        return max(self.latency(self.percentile), self.min_delay)
+
+    def request(self, method, url, hedge=True, tries=3, delay=1, backoff=2, **kwargs):
+        """
+        Send a request, retrying when the server doesn't connect or respond in time.
+
+        Retries are counted against the artifact being fetched on this thread.
+        @param hedge: send the request again once it's slower than the recent p95, only for idempotent requests.
+                      Requests which aren't hedged, e.g. downloads, aren't timed for the percentile either.
+        """
+        for attempt in range(tries):
+            try:
+                return self._hedged(method, url, **kwargs) if hedge else self._send(method, url, False, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == tries - 1:
+                    raise
+            count_retry()
+            time.sleep(delay * backoff**attempt)
+
+    def _hedged(self, method, url, **kwargs):
+        delay = self.hedge_delay()
+        if delay is None:
+            return self._send(method, url, **kwargs)
+        first = self._hedges.submit(self._send, method, url, **kwargs)
+        if wait([first], timeout=delay).done:
+            return first.result()
+        with self._lock:
+            self.hedged += 1
+        second = self._hedges.submit(self._send, method, url, **kwargs)
+        errors = []
+        for future in as_completed([first, second]):
+            try:
+                return future.result()
+            except requests.RequestException as e:
+                errors.append(e)
+        raise errors[0]
+
+    def get(self, url, hedge=True, **kwargs):
+        return self.request("get", url, hedge, **kwargs)
+
+    def head(self, url, hedge=True, **kwargs):
+        return self.request("head", url, hedge, **kwargs)
+
+    def report(self):
+        p50, p95 = self.latency(50), self.latency(95)
+        return {
+            "requests": self.requests,
+            "hedged": self.hedged,
+            "failures": self.failures,
+            "p50_seconds": p50 and round(p50, 3),
+            "p95_seconds": p95 and round(p95, 3),
+        }
+
+
+# every downloader shares the timings and connections of one client
+METADATA = MetadataClient()
+
+
+class Downloader:
+    KIND = "artifact"
+
+    def __init__(
+        self,
+        path,
+        store: Optional[ArtifactStore] = None,
+        metrics: Optional[Metrics] = None,
+        index: Optional[ArtifactIndex] = None,
+        journal: Optional[BuildJournal] = None,
+        budget: Optional[DiskBudget] = None,
+    ):
+        """
+        @param path: PathLike[str]
+        @param store: shared artifact store, artifacts are downloaded directly when None
+        @param metrics: records each artifact fetched
+        @param index: records each artifact written into the build root
+        @param journal: records resolved metadata and completed artifacts, so a restarted build resumes
+        @param budget: disk the downloads may stage at once, unbounded when None
+        """
         self.path = Path(path)
         self.path.mkdir(parents=True, exist_ok=True)
         self._downloaded = {}
+        self.store = store
+        self.metrics = metrics or Metrics()
+        self.index = index if index is not None else ArtifactIndex(self.path.parent)
+        self.journal = journal
+        self.budget = budget
+        self._sizes = {}
+
+    def _admit(self, expected, target: Path):
+        """Wait for the disk budget to fit a transfer of the expected bytes into target."""
+        if self.budget is None:
+            return nullcontext()
+        return self.budget.admit(expected, target)
+
+    def _size(self, key, resolve):
+        """Resolve the estimated size of an artifact once for this downloader."""
+        if key not in self._sizes:
+            self._sizes[key] = self._memo(key, resolve)
+        return self._sizes[key]
+
+    def _memo(self, key, resolve):
+        if self.store is not None:
+            resolve = partial(self.store.memo, key, resolve)
+        if self.journal is not None:
+            return self.journal.memo(key, resolve)
+        return resolve()
+
+    def _exists(self, target: Path, artifact: Optional[Path] = None):
+        """
+        Whether the target was already downloaded.
+
+        A resumed build removes an artifact the interrupted run didn't complete, so it is fetched again.
+
+        @param artifact: the downloaded file or folder holding the target, the target itself when None
+        """
+        artifact = artifact or target
+        if not target.exists():
+            return False
+        if self.journal is None:
+            return True
+        if self.journal.resumed and not self.journal.completed(artifact):
+            print(f"    Incomplete {artifact} removed")
+            if artifact.is_dir():
+                shutil.rmtree(artifact)
+            else:
+                artifact.unlink()
+            return False
+        if not self.journal.completed(artifact):
+            self.journal.artifact(artifact)
+        return True
+
+    def _from_store(self, key, target: Path, fetch):
+        with self.metrics.artifact(self.KIND, key or str(target)) as record:
+
+            def measured(path):
+                fetch(path)
+                record["bytes"] = _tree_size(path)
+
+            if self.store is None or key is None:
+                measured(target)
+            else:
+                self.store.provide(key, target, measured)
+        if self.journal:
+            self.journal.artifact(target)
+        return target
 
     @staticmethod
     def to_args(target: Path, channel: Optional[str] = None, arch: Optional[str] = None):
@@ -91,21 +1337,51 @@ class StoreDownloader(Downloader):
     CH_URL = "https://api.charmhub.io/v2"
 
     def _charmhub_info(self, name, **query):
-        url = f"{self.CH_URL}/charms/info/{name}"
-        resp = requests.get(url, params=query)
-        return resp.json()
+        def resolve():
+            url = f"{self.CH_URL}/charms/info/{name}"
+            resp = METADATA.get(url, params=query)
+            return resp.json()
+
+        return self._memo(("charmhub", name, tuple(sorted(query.items()))), resolve)
 
 
 class BundleDownloader(StoreDownloader):
-    def __init__(self, root, args):
+    KIND = "charm"
+
+    def __init__(self, root, args, packed=False, only_apps=None, exclude_apps=None, **kwargs):
         """
         @param root: PathLike[str]
+        @param packed: keep each charm as its .charm archive rather than extracting it
+        @param only_apps: applications kept in the bundles, every application when None
+        @param exclude_apps: applications removed from the bundles
         """
-        super().__init__(Path(root) / "charms")
+        super().__init__(Path(root) / "charms", **kwargs)
         self.bundle_path = self.path / ".bundle"
         self.args = args
-        self.overlays = OverlayDownloader(self.bundle_path)
+        self.packed = packed
+        self.only_apps = set(only_apps or [])
+        self.exclude_apps = set(exclude_apps or [])
+        self.overlays = OverlayDownloader(self.bundle_path, **kwargs)
         self._cached_bundles = {}
+        # documents are keyed by their content, so any build sharing the store reuses them
+        self.documents = DocumentCache(
+            self.store.path / "documents.json" if self.store else Path(f"{Path(root)}.documents.json")
+        )
+
+    def selected(self, app_name):
+        return (not self.only_apps or app_name in self.only_apps) and app_name not in self.exclude_apps
+
+    def _select(self, bundle):
+        """Remove the applications which aren't selected, and their relations, from a bundle."""
+        apps = self.apps_or_svcs(bundle) or {}
+        for app_name in [app_name for app_name in apps if not self.selected(app_name)]:
+            del apps[app_name]
+        if bundle.get("relations"):
+            bundle["relations"] = [
+                relation
+                for relation in bundle["relations"]
+                if all(self.selected(str(endpoint).split(":")[0]) for endpoint in relation)
+            ]
 
     @property
     def bundles(self):
@@ -123,10 +1399,14 @@ class BundleDownloader(StoreDownloader):
         for bundle_name in all_bundles:
             if bundle_name != "bundle.yaml":
                 self.overlays.download(bundle_name)
-            with (self.bundle_path / bundle_name).open() as fp:
-                bundle = yaml.safe_load(fp)
-                self._cached_bundles[bundle_name] = bundle
-
+            self._cached_bundles[bundle_name] = self.documents.load((self.bundle_path / bundle_name).read_bytes())
+
+        if self.only_apps or self.exclude_apps:
+            known = {app_name for bundle in self._cached_bundles.values() for app_name in self.apps_or_svcs(bundle)}
+            unknown = self.only_apps - known
+            assert not unknown, f"{', '.join(sorted(unknown))} aren't applications of the bundle, choose from {known}"
+            for bundle in self._cached_bundles.values():
+                self._select(bundle)
         return self._cached_bundles
 
     @staticmethod
@@ -136,9 +1416,9 @@ class BundleDownloader(StoreDownloader):
     @property
     def applications(self):
         return {
-            app_name: self.apps_or_svcs(self.bundles["bundle.yaml"]).get(app_name) or app
+            app_name: (self.apps_or_svcs(self.bundles["bundle.yaml"]) or {}).get(app_name) or app
             for bundle in self.bundles.values()
-            for app_name, app in self.apps_or_svcs(bundle).items()
+            for app_name, app in (self.apps_or_svcs(bundle) or {}).items()
         }
 
     def bundle_download(self):
@@ -148,77 +1428,131 @@ class BundleDownloader(StoreDownloader):
     def app_download(self, appname: str, app: dict):
         charm, channel = app["charm"], app.get("channel")
         _, app_target = self.to_args(Path(appname), channel)
-        path = self._downloader(charm, app_target / "metadata.yaml", channel)
-        return charm, path.parent
+        if self.packed:
+            path = self._downloader(charm, packed_charm(app_target), channel)
+        else:
+            path = self._downloader(charm, app_target / "metadata.yaml", channel).parent
+        self.index.add(self.KIND, path, app=appname, name=charm)
+        return charm, path
 
     def _downloader(self, name, path, channel):
         ch = name.startswith("ch:") or not name.startswith("cs:")
         name = remove_prefix(remove_prefix(name, "ch:"), "cs:")
         target = self.path / path
-        if target.exists():
-            print(f'    Downloaded "{name}" already exists')
-            return target
+        # a .charm target is written as the archive, otherwise the charm is extracted around the target
+        extract = target if target.suffix == ".charm" else target.parent
+        with path_lock(target):
+            if self._exists(target, extract):
+                print(f'    Downloaded "{name}" already exists')
+                return target
 
-        extract = target.parent
-        extract.mkdir(parents=True, exist_ok=True)
-        if ch:
-            self._charmhub_downloader(name, extract, channel=channel)
-        else:
-            self._charmstore_downloader(name, extract, channel=channel)
+            target.parent.mkdir(parents=True, exist_ok=True)
+            if ch:
+                self._charmhub_downloader(name, extract, channel=channel)
+            else:
+                self._charmstore_downloader(name, extract, channel=channel)
         return target
 
+    @staticmethod
+    def _unpacker(target):
+        """Write the charm archive as is for a .charm target, otherwise extract it into the target folder."""
+        if target.suffix == ".charm":
+            return "packed", lambda content, path: path.write_bytes(content)
+        return "", extract_charm
+
     def _charmhub_downloader(self, name, target, channel=None):
         with status(f'Downloading "{name} {channel}" from charm hub'):
             charm_info = self._charmhub_info(name, channel=channel, fields="default-release.revision.download.url")
             url = charm_info["default-release"]["revision"]["download"]["url"]
-            resp = requests.get(url)
-            zipfile.ZipFile(BytesIO(resp.content)).extractall(target)
+            packed, unpack = self._unpacker(target)
+
+            def fetch(path):
+                resp = METADATA.get(url, hedge=False)
+                unpack(resp.content, path)
+
+            # charm hub download urls are unique to the charm revision
+            key = ArtifactStore.key("charms", packed, Path(urlparse(str(url)).path).name)
+            self._from_store(key, target, fetch)
 
     def _charmstore_downloader(self, name, target, channel=None):
         with status(f'Downloading "{name} {channel}" from charm store'):
             url = f"{self.CS_URL}/{name}/archive"
-            resp = requests.get(url, params={"channel": channel})
-            zipfile.ZipFile(BytesIO(resp.content)).extractall(target)
+            packed, unpack = self._unpacker(target)
+
+            def fetch(path):
+                resp = METADATA.get(url, hedge=False, params={"channel": channel})
+                unpack(resp.content, path)
+
+            self._from_store(ArtifactStore.key("charms", "cs", packed, name, channel or "stable"), target, fetch)
 
 
 class OverlayDownloader(Downloader):
+    KIND = "overlay"
     GH_URL = "https://api.github.com/repos/charmed-kubernetes/bundle/contents/overlays"
 
-    def __init__(self, bundles_path):
+    def __init__(self, bundles_path, **kwargs):
         """
         @param bundles_path: PathLike[str]
         """
-        super().__init__(bundles_path)
+        super().__init__(bundles_path, **kwargs)
         self._list_cache = None
 
     @property
     def list(self):
         if self._list_cache:
             return self._list_cache
-        resp = requests.get(self.GH_URL, headers={"Accept": "application/vnd.github.v3+json"})
-        self._list_cache = {obj.get("name"): obj.get("download_url") for obj in resp.json()}
+
+        def resolve():
+            resp = METADATA.get(self.GH_URL, headers={"Accept": "application/vnd.github.v3+json"})
+            return {obj.get("name"): obj.get("download_url") for obj in resp.json()}
+
+        self._list_cache = self._memo(("github", self.GH_URL), resolve)
         return self._list_cache
 
     def download(self, overlay):
         target = self.path / overlay
-        if target.exists():
-            print(f'    Downloaded "{overlay}" exists')
-            return
-        overlay_url = self.list[overlay]
-        with status(f'Downloading "{overlay_url}" from github'):
-            with target.open("w") as fp:
-                fp.write(requests.get(overlay_url).text)
+        with path_lock(target):
+            if self._exists(target):
+                print(f'    Downloaded "{overlay}" exists')
+                return
+            overlay_url = self.list[overlay]
+            with status(f'Downloading "{overlay_url}" from github'), self.metrics.artifact(
+                self.KIND, overlay
+            ) as record:
+                with target.open("w") as fp:
+                    fp.write(METADATA.get(overlay_url).text)
+                record["bytes"] = target.stat().st_size
+            if self.journal:
+                self.journal.artifact(target)
 
 
 class ContainerDownloader(Downloader):
+    KIND = "container"
     URL = "https://api.github.com/repos/charmed-kubernetes/bundle/contents/container-images"
     IMAGE_REPO = "rocks.canonical.com/cdk/"
+    # juju architecture names which differ from their docker platform
+    PLATFORMS = {"armhf": "linux/arm/v7", "ppc64el": "linux/ppc64le"}
+    DOCKER_ARCHES = {"amd64", "arm", "arm64", "ppc64le", "riscv64", "s390x"}
+    # bytes docker unpacks and saves for each compressed byte of an image, until it's removed again
+    STAGING = 3
 
-    def __init__(self, root):
+    def __init__(self, root, arches=None, image_filter=None, **kwargs):
         """
         @param root: PathLike[str]
+        @param arches: list of architectures to pull, None pulls the host architecture
+        @param image_filter: callable deciding which images of the listing are pulled, all when None
         """
-        super().__init__(Path(root) / "containers")
+        super().__init__(Path(root) / "containers", **kwargs)
+        self.arches = arches or [None]
+        self.image_filter = image_filter
+
+    @property
+    def multi_arch(self):
+        return len(self.arches) > 1
+
+    @classmethod
+    def platform(cls, arch):
+        return cls.PLATFORMS.get(arch, f"linux/{arch}")
 
     def revisions(self, channel_filter: str):
         if channel_filter == "latest/stable":
@@ -236,13 +1570,16 @@ class ContainerDownloader(Downloader):
             revision, _ = channel_filter.split("/", 1)
             channel_re = re.compile(rf"^v{re.escape(revision)}")
 
-        resp = requests.get(self.URL, headers={"Accept": "application/vnd.github.v3+json"})
+        def resolve():
+            resp = METADATA.get(self.URL, headers={"Accept": "application/vnd.github.v3+json"})
+            return resp.json()
+
         versions = [
             (
                 remove_suffix(remove_prefix(obj.get("name"), "v"), ".txt"),
                 obj.get("download_url"),
             )
-            for obj in resp.json()
+            for obj in self._memo(("github", self.URL), resolve)
             if matches(obj.get("name"))
         ]
         return sorted(versions, key=lambda k: semver.VersionInfo.parse(k[0]))
@@ -254,47 +1591,138 @@ class ContainerDownloader(Downloader):
             image_src, image = image, image[len(self.IMAGE_REPO) :]
         return image_src, image
 
-    def _image_save(self, image):
+    def image_target(self, image, arch=None) -> Path:
+        _, image = self._image_keys(image)
+        path = self.path / arch if self.multi_arch else self.path
+        return Path(f"{path / image}.tar.gz")
+
+    @retry(CalledProcessError, tries=3, delay=2)
+    def _pull(self, image_src, arch):
+        self.metrics.attempt()
+        check_call(shlx(f"docker pull -q --platform {self.platform(arch)} {image_src}"))
+
+    def _image_save(self, image, arch=None):
+        """Save the image for the architecture, returns True when it was pulled into docker."""
         image_src, image = self._image_keys(image)
-        target = Path(f"{self.path / image}.tar.gz")
+        target = self.image_target(image, arch)
+        if self._exists(target):
+            print(f'    Downloaded "{image}" exists')
+            return False
         target.parent.mkdir(parents=True, exist_ok=True)
-        with target.open("wb") as fp:
-            with status(f'Downloading "{image}" from {self.IMAGE_REPO}'):
-                check_call(shlx(f"docker pull -q {image_src}"))
-                p1 = Popen(shlx(f"docker save {image_src}"), stdout=PIPE)
-                p2 = Popen(shlx("gzip"), stdin=p1.stdout, stdout=fp)
-                p1.stdout.close()
-                p2.communicate()
+        # the platform is always named, so a worker on another host pulls the coordinator's architecture
+        pull_arch = arch or host_arch()
+        source = f"{self.IMAGE_REPO} ({pull_arch})"
+        pulled = []
+
+        def fetch(path):
+            self._pull(image_src, pull_arch)
+            pulled.append(image_src)
+            try:
+                with path.open("wb") as fp:
+                    p1 = Popen(shlx(f"docker save {image_src}"), stdout=PIPE)
+                    p2 = Popen(shlx("gzip"), stdin=p1.stdout, stdout=fp)
+                    p1.stdout.close()
+                    p2.communicate()
+                    p1.wait()
+                for proc in (p1, p2):
+                    if proc.returncode:
+                        raise CalledProcessError(proc.returncode, proc.args)
+            except BaseException:
+                # a truncated archive would otherwise be kept, indexed and digested as the image
+                if path.exists():
+                    path.unlink()
+                raise
+
+        with status(f'Downloading "{image}" from {source}'):
+            self._from_store(ArtifactStore.key("containers", pull_arch, f"{image}.tar.gz"), target, fetch)
+        return bool(pulled)
 
     def _image_delete(self, image):
         image_src, image = self._image_keys(image)
         check_call(shlx(f"docker rmi {image_src}"))
 
-    def download(self, channel):
-        print("Containers")
+    def size(self, image, arch=None):
+        """Compressed bytes of the image's layers for the architecture from its manifest, 0 when it isn't known."""
+        image_src, _ = self._image_keys(image)
+
+        def resolve():
+            try:
+                manifests = json.loads(check_output(shlx(f"docker manifest inspect -v {image_src}"), text=True))
+            except (CalledProcessError, ValueError):
+                return {}
+            sizes = {}
+            for manifest in manifests if isinstance(manifests, list) else [manifests]:
+                # a manifest list describes the image of each platform, a single manifest has no descriptor
+                image_platform = manifest.get("Descriptor", {}).get("platform", {})
+                layers = (manifest.get("SchemaV2Manifest") or {}).get("layers", [])
+                sizes[image_platform.get("architecture", "")] = sum(layer.get("size", 0) for layer in layers)
+            return sizes
+
+        sizes = self._size(("docker-manifest", image_src), resolve)
+        arch = arch or host_arch()
+        return sizes.get(self.platform(arch).split("/")[1]) or sizes.get("", 0)
+
+    def estimate(self, channel):
+        """(size, staging) of each image which isn't downloaded yet."""
+        return [
+            (size, size * self.STAGING)
+            for arch in self.arches
+            for image in self.images(channel)
+            if not self.image_target(image, arch).exists()
+            for size in [self.size(image, arch)]
+        ]
+
+    def _image_fetch(self, image, arch=None):
+        """Save the image for the architecture, removing it from docker again when it was pulled."""
+        image_src, name = self._image_keys(image)
+        target = self.image_target(image, arch)
+        expected = self.size(image, arch) * self.STAGING if self.budget and not target.exists() else 0
+        # builds on this host share docker's tags, so only one pulls, saves and removes a tag at a time
+        with self._admit(expected, target), named_lock(f"docker:{image_src}"), path_lock(target):
+            if self._image_save(image, arch):
+                self._image_delete(image)
+        # indexed once the budget has charged the archive, as a streaming packager may remove it from the root
+        self.index.add(self.KIND, target, name=name, arch=arch if self.multi_arch else None)
+
+    def images(self, channel):
+        """Images of the latest container-images listing matching the channel."""
         revisions = self.revisions(channel)
         assert revisions, f"No revisions matched the channel {channel}"
         _, latest_url = revisions[-1]
 
         with status(f'Downloading "{latest_url}" from github'):
-            images = requests.get(latest_url).text.splitlines()
-        for container_image in images:
-            self._image_save(container_image)
-        for container_image in images:
-            self._image_delete(container_image)
+            images = self._memo(("github", latest_url), lambda: METADATA.get(latest_url).text.splitlines())
+        if self.image_filter:
+            images = [image for image in images if self.image_filter(self._image_keys(image)[1])]
+        return images
+
+    def download(self, channel):
+        print("Containers")
+        images = self.images(channel)
+        # each platform is pulled from the image's manifest list, so the host architecture doesn't matter.
+        # Each image is removed once saved so the tag is pulled again for the next architecture
+        for arch in self.arches:
+            for container_image in images:
+                self._image_fetch(container_image, arch)
 
 
 class SnapDownloader(Downloader):
-    def __init__(self, root):
+    KIND = "snap"
+    SNAP_URL = "https://api.snapcraft.io/v2/snaps/info"
+    # host machine names which differ from their snap architecture
+    HOST_ARCHES = {"x86_64": "amd64", "aarch64": "arm64", "ppc64le": "ppc64el", "armv7l": "armhf"}
+
+    def __init__(self, root, **kwargs):
         """
         @param root: PathLike[str]
         """
-        super().__init__(Path(root) / "snaps")
+        super().__init__(Path(root) / "snaps", **kwargs)
         self.empty_snap = self.path / ".empty.snap"
         self.empty_snap.touch(exist_ok=True)
 
     @retry(CalledProcessError, tries=3, delay=2)
     def _fetch_snap(self, snap, args):
+        self.metrics.attempt()
         out = check_output(
             shlx(f"snap-store-proxy fetch-snaps {snap}{args}"),
             stderr=STDOUT,
@@ -314,16 +1742,89 @@ class SnapDownloader(Downloader):
             self._downloaded[snap_key] = self.to_args(self.path / snap, channel, arch)
         return self._downloaded[snap_key]
 
+    def _release(self, snap, channel, arch):
+        """The snap's release in the channel for the architecture, None if it isn't found."""
+        arch = arch or host_arch()
+        track, _, risk = channel.rpartition("/")
+
+        def resolve():
+            resp = METADATA.get(
+                f"{self.SNAP_URL}/{snap}",
+                params={"fields": "revision,download"},
+                headers={"Snap-Device-Series": "16"},
+            )
+            return resp.json()
+
+        for release in self._memo(("snap", snap), resolve).get("channel-map", []):
+            published = release["channel"]
+            if (published["track"], published["risk"], published["architecture"]) == (track or "latest", risk, arch):
+                return release
+        return None
+
+    def revision(self, snap, channel, arch):
+        """Revision of the snap published in the channel for the architecture, None if it isn't found."""
+        release = self._release(snap, channel, arch)
+        return release and release["revision"]
+
+    def size(self, snap, channel, arch):
+        """Bytes of the snap published in the channel for the architecture, 0 when it isn't known."""
+        release = self._release(snap, channel, arch)
+        return (release or {}).get("download", {}).get("size", 0)
+
+    def estimate(self):
+        """(size, staging) of each marked snap which isn't downloaded yet."""
+        return [
+            (self.size(snap, channel, arch),) * 2
+            for (snap, channel, arch), (_, snap_target) in self._downloaded.items()
+            if not list(snap_target.glob("*.tar.gz"))
+        ]
+
+    def _download_arch(self, downloads, snap_locks):
+        for snap, channel, arch, download_args, snap_target in downloads:
+            self._download_snap(snap, channel, arch, download_args, snap_target, snap_locks)
+            for tgz in snap_target.glob("*.tar.gz"):
+                self.index.add(self.KIND, tgz, name=snap, arch=arch)
+
+    def _download_snap(self, snap, channel, arch, download_args, snap_target, snap_locks):
+        if not arch:
+            # the host's snap is stored by its architecture, the same as a worker fetching it for this build
+            arch = host_arch()
+            download_args += f" --architecture={arch}"
+        with path_lock(snap_target):
+            if self._exists(snap_target) and len(list(snap_target.glob("*.tar.gz"))):
+                print(f'    Downloaded snap "{snap}" exists')
+                return
+
+            def fetch(path):
+                path.mkdir(parents=True, exist_ok=True)
+                tgz = self._fetch_snap(snap, download_args)
+                check_call(shlx(f"mv {tgz} {path}"))
+
+            # snap-store-proxy names its tarballs by snap and time in the working directory, so the same snap
+            # isn't fetched for two architectures, or by two builds, at once
+            fetching = named_lock(f"snap-store-proxy:{Path.cwd()}:{snap}")
+            expected = self.size(snap, channel, arch) if self.budget else 0
+            with self._admit(expected, snap_target), snap_locks[snap], fetching, status(
+                f'Downloading snap "{snap}"{download_args} from snap store'
+            ):
+                key = None
+                if self.store:
+                    revision = self.revision(snap, channel, arch)
+                    key = revision and ArtifactStore.key("snaps", snap, arch, revision)
+                self._from_store(key, snap_target, fetch)
+
     def download(self):
         print("Snaps")
+        by_arch = {}
         for (snap, channel, arch), (download_args, snap_target) in self._downloaded.items():
-            if len(list(snap_target.glob("*.tar.gz"))):
-                print(f'    Downloaded snap "{snap}" exists')
-                continue
-            with status(f'Downloading snap "{snap}" from snap store'):
-                snap_target.mkdir(parents=True, exist_ok=True)
-                tgz = self._fetch_snap(snap, download_args)
-                check_call(shlx(f"mv {tgz} {snap_target}"))
+            by_arch.setdefault(arch, []).append((snap, channel, arch, download_args, snap_target))
+        snap_locks = {snap: threading.Lock() for snap, _, _ in self._downloaded}
+
+        # each architecture is fetched in parallel
+        with thread_pool(len(by_arch) or 1) as pool:
+            futures = [pool.submit(self._download_arch, downloads, snap_locks) for downloads in by_arch.values()]
+            for future in futures:
+                future.result()
 
 
 class Resource(namedtuple("Resource", "name, type, path, revision, url_format")):
@@ -358,11 +1859,13 @@ class Resource(namedtuple("Resource", "name, type, path, revision, url_format"))
 
 
 class ResourceDownloader(StoreDownloader):
-    def __init__(self, root):
+    KIND = "resource"
+
+    def __init__(self, root, **kwargs):
         """
         @param root: PathLike[str]
         """
-        super().__init__(Path(root) / "resources")
+        super().__init__(Path(root) / "resources", **kwargs)
 
     def list(self, charm, channel):
         ch = charm.startswith("ch:") or not charm.startswith("cs:")
@@ -371,11 +1874,16 @@ class ResourceDownloader(StoreDownloader):
             resources = Resource.from_charmhub(resp["default-release"]["resources"])
         else:
             name = remove_prefix(charm, "cs:")
-            resp = requests.get(
-                f"{self.CS_URL}/{name}/meta/resources",
-                params={"channel": channel},
-            )
-            resources = Resource.from_charmstore(f"{self.CS_URL}/{name}", resp.json())
+
+            def resolve():
+                resp = METADATA.get(
+                    f"{self.CS_URL}/{name}/meta/resources",
+                    params={"channel": channel},
+                )
+                return resp.json()
+
+            json = self._memo(("charmstore-resources", name, channel), resolve)
+            resources = Resource.from_charmstore(f"{self.CS_URL}/{name}", json)
         return resources
 
     def mark_download(self, app, charm, resource) -> Path:
@@ -384,26 +1892,57 @@ class ResourceDownloader(StoreDownloader):
             self._downloaded[resource_key] = self.path / app / resource.name / resource.path
         return self._downloaded[resource_key]
 
+    def size(self, resource):
+        """Bytes of the resource from the Content-Length of its url, 0 when it isn't known."""
+
+        def resolve():
+            resp = METADATA.head(resource.url, allow_redirects=True)
+            return int(resp.headers.get("Content-Length") or 0)
+
+        return self._size(("resource-size", resource.url), resolve)
+
+    def estimate(self):
+        """(size, staging) of each marked resource which isn't downloaded yet."""
+        return [
+            (self.size(resource),) * 2 for (_, _, resource), target in self._downloaded.items() if not target.exists()
+        ]
+
     def download(self):
         print("Resources")
         for (app, charm, resource), target in self._downloaded.items():
-            if target.exists():
+            self._download_resource(charm, resource, target)
+            self.index.add(self.KIND, target, app=app, name=resource.name, revision=resource.revision)
+
+    @retry(CalledProcessError, tries=3, delay=2)
+    def _wget(self, url, path):
+        self.metrics.attempt()
+        check_call(shlx(f"wget --quiet {url} -O {path}"))
+
+    def _download_resource(self, charm, resource, target):
+        with path_lock(target):
+            if self._exists(target):
                 print(f"    Downloaded resource {resource.name} - {resource.revision} exists")
-                continue
+                return
+
+            def fetch(path):
+                self._wget(resource.url, path)
 
             target.parent.mkdir(parents=True, exist_ok=True)
-            with status(f"Downloading {charm} resource {resource.name} @ revision {resource.revision}"):
-                check_call(shlx(f"wget --quiet {resource.url} -O {target}"))
+            expected = self.size(resource) if self.budget else 0
+            with self._admit(expected, target), status(
+                f"Downloading {charm} resource {resource.name} @ revision {resource.revision}"
+            ):
+                # resource urls are unique to the resource revision
+                self._from_store(ArtifactStore.key("resources", resource.url), target, fetch)
 
 
-def charm_snap_channel(app, charm_path) -> str:
+def charm_snap_channel(app, charm_path, documents: Optional[DocumentCache] = None) -> str:
     # Try to get channel from config
-    with (charm_path / "config.yaml").open() as stream:
-        config = yaml.safe_load(stream)
-        try:
-            channel = config["options"]["channel"]["default"]
-        except KeyError:
-            channel = "auto"
+    config = load_charm_yaml(charm_path, "config.yaml", documents)
+    try:
+        channel = config["options"]["channel"]["default"]
+    except KeyError:
+        channel = "auto"
 
     if channel == "auto":
         channel = "stable"
@@ -416,23 +1955,103 @@ def charm_snap_channel(app, charm_path) -> str:
     return channel
 
 
-def download(args, root):
-    charms = BundleDownloader(root, args)
-    snaps = SnapDownloader(root)
-    resources = ResourceDownloader(root)
+class ImageFilter(namedtuple("ImageFilter", "allow, deny, charm_images, charms")):
+    """
+    Decides which container images of the listing a bundle needs.
+
+    An image is pulled when it matches an allow pattern, if any are given, and no deny pattern. Images mapped
+    by charm_images are only pulled when one of their charms or applications is in the bundle.
+    """
+
+    @classmethod
+    def from_args(cls, args, applications):
+        """:rvalue: Optional[ImageFilter]"""
+        if not (args.image_allow or args.image_deny or args.image_map):
+            return None
+        charm_images = {}
+        if args.image_map:
+            with Path(args.image_map).open() as fp:
+                charm_images = load_yaml(fp) or {}
+            assert isinstance(charm_images, dict), f"{args.image_map} should map charms to image patterns"
+        charms = set(applications)
+        for app in applications.values():
+            if app and app.get("charm"):
+                charms.add(remove_prefix(remove_prefix(app["charm"], "ch:"), "cs:").rpartition("/")[2])
+        return cls(args.image_allow or [], args.image_deny or [], charm_images, charms)
+
+    @staticmethod
+    def _matches(image, patterns):
+        return any(fnmatch(image, pattern) for pattern in patterns)
+
+    def __call__(self, image):
+        if self.allow and not self._matches(image, self.allow):
+            return False
+        if self._matches(image, self.deny):
+            return False
+        mapped = [charm for charm, patterns in self.charm_images.items() if self._matches(image, patterns or [])]
+        return not mapped or any(charm in self.charms for charm in mapped)
+
+
+class DownloadPlan(namedtuple("DownloadPlan", "charms, snaps, resources, containers, k8s_cp_channel")):
+    """Downloaders with every snap and resource of a bundle marked, containers is None when they're skipped."""
+
+
+def bundle_downloader(args, root, **kwargs):
+    """The build's charm and bundle downloader, the artifacts already in the root are kept in its index."""
+    # whether from a previous manifest or an older build tree
+    index = ArtifactIndex.load(root) or ArtifactIndex.scan(root, args.arch)
+    if kwargs.get("budget"):
+        kwargs["budget"].attach(index)
+    return BundleDownloader(
+        root,
+        args,
+        packed=args.packed_charms,
+        only_apps=args.only_apps,
+        exclude_apps=args.exclude_apps,
+        index=index,
+        **kwargs,
+    )
+
+
+def plan_download(
+    args,
+    root,
+    store: Optional[ArtifactStore] = None,
+    metrics: Optional[Metrics] = None,
+    journal: Optional[BuildJournal] = None,
+    budget: Optional[DiskBudget] = None,
+):
+    """
+    Download the charms of the bundle, marking the snaps and resources they need.
+
+    :rvalue: DownloadPlan
+    """
+    arches = args.arch or [None]
+    metrics = metrics or Metrics()
+    kwargs = dict(store=store, metrics=metrics, journal=journal, budget=budget)
+    charms = bundle_downloader(args, root, **kwargs)
+    index = charms.index
+    snaps = SnapDownloader(root, index=index, **kwargs)
+    resources = ResourceDownloader(root, index=index, **kwargs)
     print("Bundles")
     k8s_cp_channel = None
 
+    with metrics.stage("resolve"):
+        applications = charms.applications
+
     # For each application, download the charm, resources, and snaps.
-    for app_name, app in charms.applications.items():
-        charm, charm_path = charms.app_download(app_name, app)
-        snap_channel = charm_snap_channel(app, charm_path)
+    for app_name, app in applications.items():
+        with metrics.stage("charms"):
+            charm, charm_path = charms.app_download(app_name, app)
+            snap_channel = charm_snap_channel(app, charm_path, charms.documents)
         charm_channel = app.get("channel")
         if charm in ["kubernetes-control-plane", "kubernetes-master"]:  # wokeignore:rule=master
             k8s_cp_channel = snap_channel
 
         # Download each resource or snap.
-        for resource in resources.list(charm, charm_channel):
+        with metrics.stage("resolve"):
+            charm_resources = resources.list(charm, charm_channel)
+        for resource in charm_resources:
             # Create the filename from the snap Name and Path extension. Use this instead of just Path because
             # multiple resources can have the same names for Paths.
             path = resource.path
@@ -448,14 +2067,19 @@ def download(args, root):
                 # be the case.
                 snap = Path(path).stem
 
-                # Download the snap and move it into position.
-                snaps.mark_download(snap, snap_channel, args.arch)
+                # Download the snap for every architecture and move it into position.
+                for arch in arches:
+                    snaps.mark_download(snap, snap_channel, arch)
 
                 # Ensure an empty snap shows up in the resource path
                 snap_resource = resources.path / app_name / name / path
                 if not snap_resource.is_symlink():
                     snap_resource.parent.mkdir(parents=True, exist_ok=True)
-                    check_call(shlx(f"ln -r -s {snaps.empty_snap} {snap_resource}"))
+                    try:
+                        os.symlink(os.path.relpath(snaps.empty_snap, snap_resource.parent), snap_resource)
+                    except FileExistsError:
+                        pass  # linked by a concurrent build of this root
+                index.add(ResourceDownloader.KIND, snap_resource, app=app_name, name=name)
             else:
                 # This isn't a snap, pull the resource from the appropriate store
                 # use the bundle provided resource revision if available
@@ -466,23 +2090,93 @@ def download(args, root):
 
     base_snaps = ["core18", "core20", "lxd", "snapd"]
     for snap in base_snaps:
-        snaps.mark_download(snap, "stable", None)
+        for arch in arches:
+            snaps.mark_download(snap, "stable", arch)
 
+    containers = None
+    if k8s_cp_channel and not args.skip_containers:
+        # Container Images are based on the kubernetes-control-plane channel
+        images = ImageFilter.from_args(args, applications)
+        containers = ContainerDownloader(root, args.arch, images, index=index, **kwargs)
+    plan = DownloadPlan(charms, snaps, resources, containers, k8s_cp_channel)
+    if budget:
+        check_budget(args, plan, budget, metrics)
+    return plan
+
+
+def check_budget(args, plan: DownloadPlan, budget: DiskBudget, metrics: Metrics):
+    """Estimate the disk the rest of the plan stages, failing before anything is fetched when it can't fit."""
+    with status("Estimating disk usage"), metrics.stage("resolve"):
+        pending = []
+        if not args.skip_snaps:
+            pending += plan.snaps.estimate()
+        if not args.skip_resources:
+            pending += plan.resources.estimate()
+        if plan.containers:
+            pending += plan.containers.estimate(plan.k8s_cp_channel)
+        peak = budget.check(_tree_size(plan.charms.index.root), pending)
+    print(f"    Estimated peak of {human_size(peak)} within the {human_size(budget.limit)} budget")
+
+
+def fetch_download(args, plan: DownloadPlan, metrics: Metrics, save_index=True):
+    """
+    Download everything marked by the plan and save the build's artifact index.
+
+    @param save_index: False when only the store is filled, so the artifacts aren't digested for a manifest
+    """
     if not args.skip_snaps:
-        snaps.download()
+        with metrics.stage("snaps"):
+            plan.snaps.download()
 
     if not args.skip_resources:
-        resources.download()
-
-    if k8s_cp_channel and not args.skip_containers:
-        # Download the Container Images based on the kubernetes-control-plane channel
-        containers = ContainerDownloader(root)
-        containers.download(k8s_cp_channel)
-
-    return charms
+        with metrics.stage("resources"):
+            plan.resources.download()
+
+    if plan.containers:
+        with metrics.stage("containers"):
+            plan.containers.download(plan.k8s_cp_channel)
+
+    if not save_index:
+        plan.charms.documents.save()
+        return plan.charms
+
+    with metrics.stage("index"):
+        plan.charms.documents.save()
+        budget = plan.charms.budget
+        if budget and budget.packager:
+            budget.packager.wait()
+        plan.charms.index.save(plan.charms.journal)
+    return plan.charms
+
+
+def download(
+    args,
+    root,
+    store: Optional[ArtifactStore] = None,
+    metrics: Optional[Metrics] = None,
+    journal: Optional[BuildJournal] = None,
+    budget: Optional[DiskBudget] = None,
+    save_index=True,
+):
+    metrics = metrics or Metrics()
+    return fetch_download(args, plan_download(args, root, store, metrics, journal, budget), metrics, save_index)
+
+
+def build_offline_bundle(
+    root,
+    charms: BundleDownloader,
+    arches=None,
+    index: Optional[ArtifactIndex] = None,
+    documents: Optional[DocumentCache] = None,
+):
+    """
+    @param arches: architectures of a build tree without an artifact index
+    @param index: the downloaded artifacts, loaded from the build's manifest when None
+    @param documents: charm metadata already parsed, the metadata is always parsed when None
+    """
+    if index is None:
+        index = ArtifactIndex.load(root) or ArtifactIndex.scan(root, arches)
 
-
-def build_offline_bundle(root, charms: BundleDownloader):
     def local_path(build_path):
         """
         @param build_path: PathLike[str]
@@ -491,26 +2185,28 @@ def build_offline_bundle(root, charms: BundleDownloader):
 
     def update_resources(app_name, rsc):
         def resource_file(name):
-            rsc_path = (root / "resources" / app_name / name).glob("*")
-            # each resource path should contain one file, take the first one
             # if this resource is a snap, it will point to an symlink to "./snaps/empty.snap"
-            try:
-                return local_path(next(rsc_path))
-            except StopIteration:
-                return None
+            artifact = index.find(ResourceDownloader.KIND, app_name, name)
+            return artifact and artifact.local_path
 
         return {name: resource_file(name) or rev for name, rev in rsc.items()}
 
     def update_app(app_name, app):
         if app:
-            _, target = Downloader.to_args(root / "charms" / app_name, app.get("channel"))
+            charm = index.find(BundleDownloader.KIND, app_name)
+            if charm:
+                target = root / charm.path
+            else:
+                _, target = Downloader.to_args(root / "charms" / app_name, app.get("channel"))
+                if packed_charm(target).exists():
+                    target = packed_charm(target)
             # Load the resource definition from the current bundle if possible
             # This will be a map of resource-name to resource numerical version
             resources = app.get("resources")
             if not resources:
                 # Load the resource from the local charm
                 # This will be a map of resource-name to resource metadata
-                resources = yaml.safe_load((target / "metadata.yaml").open()).get("resources", {})
+                resources = load_charm_yaml(target, "metadata.yaml", documents).get("resources", {})
             app.update(
                 {
                     "charm": local_path(target),
@@ -528,7 +2224,7 @@ def build_offline_bundle(root, charms: BundleDownloader):
         }
 
         with (root / bundle_name).open("w") as fp:
-            yaml.safe_dump(created_bundle, fp)
+            dump_yaml(created_bundle, fp)
 
         is_trusted = any(app.get("trust") for app in BundleDownloader.apps_or_svcs(bundle).values() if app)
         is_overlay = bundle_name != "bundle.yaml"
@@ -541,40 +2237,803 @@ def build_offline_bundle(root, charms: BundleDownloader):
         if is_trusted:
             deploy_args += " --trust"
 
+    if documents:
+        documents.save()
+
     push_snaps = root / "push_snaps.sh"
-    push_snaps_tmp = Path(__file__).parent / "templates" / "push_snaps.sh.j2"
-    template = jinja2.Template(push_snaps_tmp.read_text())
-    push_snaps.write_text(template.render(snaps=[local_path(snap) for snap in (root / "snaps").glob("**/*.tar.gz")]))
+    render_template("push_snaps.sh.j2", push_snaps, snaps=[snap.local_path for snap in index.of(SnapDownloader.KIND)])
     push_snaps.chmod(mode=0o755)
 
-    containers_path = root / "containers"
+    containers, multi_arch = {}, {}
+    for container in index.of(ContainerDownloader.KIND):
+        if container.arch:
+            # images of each architecture are pushed separately, then joined by a manifest list
+            multi_arch.setdefault(container.name, {})[container.arch] = container.local_path
+        else:
+            containers[container.name] = container.local_path
     push_containers = root / "push_container_images.sh"
-    push_containers_tmp = Path(__file__).parent / "templates" / "push_container_images.sh.j2"
-    template = jinja2.Template(push_containers_tmp.read_text())
-    push_containers.write_text(
-        template.render(
-            containers={
-                f"{container_tgz.relative_to(containers_path)}".replace(".tar.gz", ""): local_path(container_tgz)
-                for container_tgz in containers_path.glob("**/*.tar.gz")
-            },
-            IMAGE_REPO=ContainerDownloader.IMAGE_REPO,
-        )
+    render_template(
+        "push_container_images.sh.j2",
+        push_containers,
+        containers=containers,
+        multi_arch=multi_arch,
+        IMAGE_REPO=ContainerDownloader.IMAGE_REPO,
     )
     push_containers.chmod(mode=0o755)
 
-    deploy_readme = root / "README"
-    readme_tmp = Path(__file__).parent / "templates" / "README.j2"
-    template = jinja2.Template(readme_tmp.read_text())
-    deploy_readme.write_text(template.render(deploy_args=deploy_args))
+    render_template("README.j2", root / "README", deploy_args=deploy_args)
 
     deploy_sh = root / "deploy.sh"
     deploy_sh.write_text("#!/bin/bash\n" "cat ./README\n")
     deploy_sh.chmod(mode=0o755)
 
+    # ship this script for its push commands on the air-gapped side
+    shutil.copy(__file__, root / "shrinkwrap.py")
+
+
+def get_push_images_args(argv=None):
+    """Parse push-images cli arguments."""
+    parser = argparse.ArgumentParser(prog="shrinkwrap.py push-images")
+    parser.add_argument("path", nargs="?", default=".", help="the unpacked shrinkwrap bundle or its containers folder")
+    parser.add_argument(
+        "--registry",
+        default=os.environ.get("DOCKER_REGISTRY"),
+        help="the registry receiving the images (default: $DOCKER_REGISTRY)",
+    )
+    parser.add_argument("--prefix", default="cdk", help="repository prefix for every image")
+    parser.add_argument("--insecure", action="store_true", help="Use plain http with the registry")
+    parser.add_argument(
+        "--username",
+        default=os.environ.get("DOCKER_REGISTRY_USERNAME"),
+        help="registry user, the password is read from $DOCKER_REGISTRY_PASSWORD",
+    )
+    parser.add_argument("--workers", type=int, default=8, help="number of images pushed concurrently")
+    args = parser.parse_args(argv)
+    if not args.registry:
+        parser.error("DOCKER_REGISTRY is unset")
+    return args
+
+
+class _BlobReader:
+    """Sized file-like body, so blobs are streamed to the registry rather than loaded into memory."""
+
+    def __init__(self, fp, size):
+        self.fp, self.size = fp, size
+
+    def __len__(self):
+        return self.size
+
+    def read(self, size=-1):
+        return self.fp.read(size)
+
+
+class RegistryClient:
+    """Registry v2 API client pushing blobs and manifests without a docker daemon."""
+
+    def __init__(self, registry, username=None, password=None, workers=8):
+        if "://" not in registry:
+            registry = f"https://{registry}"
+        self.url = registry.rstrip("/")
+        self.auth = (username, password or "") if username else None
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._tokens = {}
+
+    def _authenticate(self, repo, challenge):
+        """Request a token for the repository when the registry asks for bearer authentication."""
+        scheme, _, params = challenge.partition(" ")
+        if scheme.lower() != "bearer":
+            return False
+        params = dict(re.findall(r'(\w+)="([^"]*)"', params))
+        realm = params.pop("realm")
+        resp = self.session.get(realm, params=params, auth=self.auth)
+        resp.raise_for_status()
+        token = resp.json()
+        self._tokens[repo] = token.get("token") or token.get("access_token")
+        return True
+
+    def _send(self, method, repo, url, headers, **kwargs):
+        if repo in self._tokens:
+            headers = dict(headers, Authorization=f"Bearer {self._tokens[repo]}")
+            return self.session.request(method, url, headers=headers, **kwargs)
+        return self.session.request(method, url, headers=headers, auth=self.auth, **kwargs)
+
+    def _request(self, method, repo, path, headers=None, **kwargs):
+        url = urljoin(f"{self.url}/", path)
+        resp = self._send(method, repo, url, headers or {}, **kwargs)
+        # a streamed body can't be sent twice, but its upload session has already authenticated
+        if resp.status_code == 401 and not hasattr(kwargs.get("data"), "read"):
+            if self._authenticate(repo, resp.headers.get("WWW-Authenticate", "")):
+                resp = self._send(method, repo, url, headers or {}, **kwargs)
+        return resp
+
+    def blob_exists(self, repo, digest):
+        return self._request("HEAD", repo, f"/v2/{repo}/blobs/{digest}").status_code == 200
+
+    def mount_blob(self, repo, digest, from_repo):
+        """
+        Mount a blob of another repository.
+
+        :rvalue: None when mounted, else the location of the upload session the registry started instead
+        """
+        resp = self._request("POST", repo, f"/v2/{repo}/blobs/uploads/", params={"mount": digest, "from": from_repo})
+        resp.raise_for_status()
+        return None if resp.status_code == 201 else resp.headers["Location"]
+
+    def cancel_upload(self, repo, location):
+        resp = self._request("DELETE", repo, location)
+        if resp.status_code != 404:
+            resp.raise_for_status()
+
+    def upload_blob(self, repo, digest, fp, size, location=None):
+        """
+        @param location: of an upload session already started, one is started when None
+        """
+        if not location:
+            resp = self._request("POST", repo, f"/v2/{repo}/blobs/uploads/")
+            resp.raise_for_status()
+            location = resp.headers["Location"]
+        resp = self._request(
+            "PUT",
+            repo,
+            location,
+            params={"digest": digest},
+            data=_BlobReader(fp, size),
+            headers={"Content-Type": "application/octet-stream", "Content-Length": str(size)},
+        )
+        resp.raise_for_status()
+
+    def put_manifest(self, repo, reference, body: bytes, media_type):
+        resp = self._request(
+            "PUT", repo, f"/v2/{repo}/manifests/{reference}", data=body, headers={"Content-Type": media_type}
+        )
+        resp.raise_for_status()
+
+
+class Blob(namedtuple("Blob", "name, digest, size")):
+    """Blob of an image archive, name is its member within the archive."""
+
+
+class ImageArchive:
+    """
+    A container image saved by `docker save | gzip`.
+
+    Both the legacy docker layout and the OCI layout written by newer docker releases are read.
+    Small members are kept in memory while indexing, layers are read again when they're pushed.
+    """
+
+    CONFIG_TYPE = "application/vnd.oci.image.config.v1+json"
+    LAYER_TYPE = "application/vnd.oci.image.layer.v1.tar"
+    MANIFEST_TYPE = "application/vnd.oci.image.manifest.v1+json"
+    INDEX_TYPE = "application/vnd.oci.image.index.v1+json"
+    INLINE_SIZE = 1 << 20
+
+    def __init__(self, path):
+        """
+        @param path: PathLike[str]
+        """
+        self.path = Path(path)
+        self.inline, sizes, links = {}, {}, {}
+        with tarfile.open(self.path, "r|gz") as tar:
+            for member in tar:
+                if member.isfile():
+                    sizes[member.name] = member.size
+                    if member.size <= self.INLINE_SIZE:
+                        self.inline[member.name] = tar.extractfile(member).read()
+                elif member.issym():
+                    # docker saves a layer repeated within an image as a link to its first copy
+                    links[member.name] = posixpath.normpath(
+                        posixpath.join(posixpath.dirname(member.name), member.linkname)
+                    )
+                elif member.islnk():
+                    links[member.name] = member.linkname
+
+        def resolve(name):
+            for _ in range(len(links)):
+                if name not in links:
+                    break
+                name = links[name]
+            return name
+
+        (saved,) = json.loads(self.inline["manifest.json"])[:1]
+        self.config = json.loads(self.inline[saved["Config"]])
+        oci_manifest = self._oci_manifest()
+        if oci_manifest:
+            self.manifest, self.media_type = oci_manifest
+            manifest = json.loads(self.manifest)
+            descriptors = [manifest["config"]] + manifest["layers"]
+            self.blobs = [Blob(self._blob_name(d["digest"]), d["digest"], d["size"]) for d in descriptors]
+        else:
+            # legacy layers are uncompressed, so their digests are the config's diff_ids
+            config = self.inline[saved["Config"]]
+            config_blob = Blob(saved["Config"], f"sha256:{hashlib.sha256(config).hexdigest()}", len(config))
+            layers = [resolve(layer) for layer in saved["Layers"]]
+            layer_blobs = [
+                Blob(layer, diff_id, sizes[layer]) for layer, diff_id in zip(layers, self.config["rootfs"]["diff_ids"])
+            ]
+            self.blobs = [config_blob] + layer_blobs
+            self.media_type = self.MANIFEST_TYPE
+            manifest = {
+                "schemaVersion": 2,
+                "mediaType": self.MANIFEST_TYPE,
+                "config": {"mediaType": self.CONFIG_TYPE, "digest": config_blob.digest, "size": config_blob.size},
+                "layers": [
+                    {"mediaType": self.LAYER_TYPE, "digest": blob.digest, "size": blob.size} for blob in layer_blobs
+                ],
+            }
+            self.manifest = json.dumps(manifest).encode()
+
+    @staticmethod
+    def _blob_name(digest):
+        return "blobs/{}/{}".format(*digest.split(":", 1))
+
+    def _oci_manifest(self):
+        if "index.json" not in self.inline:
+            return None
+        (descriptor,) = json.loads(self.inline["index.json"])["manifests"][:1]
+        body = self.inline.get(self._blob_name(descriptor["digest"]))
+        if body is None or descriptor.get("mediaType") == self.INDEX_TYPE:
+            return None
+        return body, descriptor.get("mediaType", self.MANIFEST_TYPE)
+
+    @property
+    def digest(self):
+        return f"sha256:{hashlib.sha256(self.manifest).hexdigest()}"
+
+    @property
+    def platform(self):
+        _platform = {"architecture": self.config["architecture"], "os": self.config.get("os", "linux")}
+        if self.config.get("variant"):
+            _platform["variant"] = self.config["variant"]
+        return _platform
+
+
+class ImagePusher:
+    """
+    Push image archives to a registry.
+
+    Blobs already in the repository are skipped, blobs pushed to another repository are mounted
+    from it and a blob shared by images pushed concurrently is only uploaded once.
+    """
+
+    def __init__(self, client: RegistryClient, prefix="cdk"):
+        self.client = client
+        self.prefix = prefix
+        self._known = {}
+        self._lock = threading.Lock()
+        self._blob_locks = {}
+
+    def _ensure_blob(self, repo, blob, open_blob=None):
+        """
+        Make blob available in repo, uploading it when open_blob is provided.
+
+        :rvalue: "existing", "mounted", "uploaded" or None if the blob still needs to be uploaded
+        """
+        with self._lock:
+            blob_lock = self._blob_locks.setdefault(blob.digest, threading.Lock())
+        with blob_lock:
+            holders = self._known.setdefault(blob.digest, set())
+            if repo in holders:
+                return "existing"
+            if self.client.blob_exists(repo, blob.digest):
+                holders.add(repo)
+                return "existing"
+            location = None
+            if holders:
+                location = self.client.mount_blob(repo, blob.digest, next(iter(holders)))
+                if not location:
+                    holders.add(repo)
+                    return "mounted"
+            if not open_blob:
+                if location:
+                    # the session a declined mount started isn't left open until the blob is streamed
+                    self.client.cancel_upload(repo, location)
+                return None
+            # a declined mount starts the upload session
+            self.client.upload_blob(repo, blob.digest, open_blob(), blob.size, location)
+            holders.add(repo)
+            return "uploaded"
+
+    def push(self, path, image, tag_manifest=True):
+        """
+        Push the blobs and manifest of an archived image.
+
+        @param image: image name and tag within the registry prefix
+        @param tag_manifest: tag the manifest, otherwise it's only pushed by digest
+        :rvalue: tuple[ImageArchive, collections.Counter]
+        """
+        name, _, tag = image.rpartition(":") if ":" in image.rsplit("/", 1)[-1] else (image, None, "latest")
+        repo = f"{self.prefix}/{name}" if self.prefix else name
+        archive = ImageArchive(path)
+        counts = Counter()
+
+        pending = {}
+        for blob in archive.blobs:
+            inline = archive.inline.get(blob.name)
+            result = self._ensure_blob(repo, blob, inline is not None and (lambda inline=inline: BytesIO(inline)))
+            if result:
+                counts[result] += 1
+            else:
+                pending[blob.name] = blob
+
+        if pending:
+            # large blobs are streamed in archive order, decompressing the archive once
+            with tarfile.open(archive.path, "r|gz") as tar:
+                for member in tar:
+                    blob = pending.pop(member.name, None)
+                    if blob:
+                        counts[self._ensure_blob(repo, blob, lambda: tar.extractfile(member))] += 1
+
+        reference = tag if tag_manifest else archive.digest
+        self.client.put_manifest(repo, reference, archive.manifest, archive.media_type)
+        return repo, tag, archive, counts
+
+    def push_index(self, repo, tag, archives):
+        """Tag a manifest list joining the platform images of one image."""
+        index = {
+            "schemaVersion": 2,
+            "mediaType": ImageArchive.INDEX_TYPE,
+            "manifests": [
+                {
+                    "mediaType": archive.media_type,
+                    "digest": archive.digest,
+                    "size": len(archive.manifest),
+                    "platform": archive.platform,
+                }
+                for archive in archives
+            ],
+        }
+        self.client.put_manifest(repo, tag, json.dumps(index).encode(), ImageArchive.INDEX_TYPE)
+
+
+def image_archives(containers_path: Path):
+    """
+    Map archives to their image name and architecture.
+
+    Archives are listed by the bundle's artifacts.json. Bundles built before it was written, or without
+    their images, are scanned: archives of multi architecture builds are stored within a folder named after
+    their architecture.
+    :rvalue: dict[Path, tuple[str, Optional[str]]]
+    """
+    index = ArtifactIndex.load(containers_path.parent)
+    images = index.of(ContainerDownloader.KIND) if index else []
+    if images:
+        return {index.root / image.path: (image.name, image.arch) for image in images}
+    archives = {}
+    arch_dirs = {path.name for path in containers_path.iterdir() if path.is_dir()}
+    multi_arch = len(arch_dirs) > 1 and all(
+        ContainerDownloader.platform(arch).split("/")[1] in ContainerDownloader.DOCKER_ARCHES for arch in arch_dirs
+    )
+    for archive in sorted(containers_path.glob("**/*.tar.gz")):
+        image = remove_suffix(str(archive.relative_to(containers_path)), ".tar.gz")
+        arch = None
+        if multi_arch:
+            arch, image = image.split("/", 1)
+        archives[archive] = image, arch
+    return archives
+
+
+def push_images(argv=None):
+    args = get_push_images_args(argv)
+    containers_path = Path(args.path)
+    if (containers_path / "containers").is_dir():
+        containers_path /= "containers"
+
+    client = RegistryClient(
+        args.registry if not args.insecure else f"http://{remove_prefix(args.registry, 'http://')}",
+        args.username,
+        os.environ.get("DOCKER_REGISTRY_PASSWORD"),
+        workers=args.workers,
+    )
+    pusher = ImagePusher(client, args.prefix)
+    archives = image_archives(containers_path)
+
+    def push(item):
+        archive, (image, arch) = item
+        with status(f"Push {image}{f' ({arch})' if arch else ''} to {args.registry}"):
+            return arch, pusher.push(archive, image, tag_manifest=arch is None)
+
+    print("Containers")
+    platforms = {}
+    totals = Counter()
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        for arch, (repo, tag, archive, counts) in pool.map(push, archives.items()):
+            totals.update(counts)
+            if arch:
+                platforms.setdefault((repo, tag), []).append(archive)
+
+    for (repo, tag), archives in platforms.items():
+        with status(f"Tag {repo}:{tag} for {len(archives)} platforms"):
+            pusher.push_index(repo, tag, archives)
+    print(
+        f"    {totals['uploaded']} blobs uploaded, {totals['mounted']} mounted and {totals['existing']} already present"
+    )
 
-def main():
-    args = get_args()
 
+def get_push_snaps_args(argv=None):
+    """Parse push-snaps cli arguments."""
+    parser = argparse.ArgumentParser(prog="shrinkwrap.py push-snaps")
+    parser.add_argument("path", nargs="?", default=".", help="the unpacked shrinkwrap bundle")
+    parser.add_argument("--workers", type=int, default=4, help="number of snaps pushed concurrently")
+    parser.add_argument(
+        "--journal", default=None, help="file recording completed pushes (default: <path>/.push_snaps.journal)"
+    )
+    parser.add_argument("--force", action="store_true", help="Push every snap, even those recorded as pushed")
+    return parser.parse_args(argv)
+
+
+class PushJournal:
+    """Append-only record of pushed artifacts, so a repeated push skips what already completed."""
+
+    def __init__(self, path):
+        """
+        @param path: PathLike[str]
+        """
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self.completed = {(entry["name"], entry["size"]): entry for entry in read_journal(self.path)}
+
+    def __contains__(self, artifact):
+        """
+        @param artifact: tuple[str, int] of name and size
+        """
+        return artifact in self.completed
+
+    def record(self, name, size, seconds):
+        entry = {"name": name, "size": size, "seconds": round(seconds, 3)}
+        with self._lock:
+            append_journal(self.path, entry)
+            self.completed[name, size] = entry
+
+
+def push_snaps(argv=None):
+    args = get_push_snaps_args(argv)
+    root = Path(args.path)
+    journal = PushJournal(args.journal or root / ".push_snaps.journal")
+    index = ArtifactIndex.load(root)
+    snaps = [(snap.path, snap.size) for snap in index.of(SnapDownloader.KIND)] if index else []
+    if not snaps:
+        # bundles built before artifacts.json was written, or without their snaps
+        snaps = [(str(tgz.relative_to(root)), tgz.stat().st_size) for tgz in sorted(root.glob("snaps/**/*.tar.gz"))]
+    pending = [snap for snap in snaps if args.force or snap not in journal]
+    print("Snaps")
+    print(f"    {len(snaps) - len(pending)} of {len(snaps)} snaps already pushed")
+
+    def push(snap):
+        name, size = snap
+        start = time.monotonic()
+        try:
+            with status(f"Push {name}"):
+                check_output(shlx(f"snap-store-proxy push-snap {root / name}"), stderr=STDOUT, text=True)
+        except CalledProcessError as e:
+            return name, None, e.output
+        seconds = time.monotonic() - start
+        journal.record(name, size, seconds)
+        return name, seconds, None
+
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        results = list(pool.map(push, pending))
+
+    failed = [(name, output) for name, seconds, output in results if seconds is None]
+    for name, seconds, _ in sorted(results, key=lambda result: -(result[1] or 0)):
+        if seconds is not None:
+            print(f"    {seconds:8.1f}s {name}")
+    for name, output in failed:
+        print(f"    Failed to push {name}:\n{output}")
+    if failed:
+        sys.exit(f"{len(failed)} of {len(pending)} snaps failed to push, rerun to retry them")
+
+
+def get_verify_args(argv=None):
+    """Parse verify cli arguments."""
+    parser = argparse.ArgumentParser(prog="shrinkwrap.py verify")
+    parser.add_argument("path", nargs="?", default=".", help="the unpacked shrinkwrap bundle or its .tar.gz archive")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 4, help="number of files hashed concurrently")
+    return parser.parse_args(argv)
+
+
+def _manifest_artifacts(manifest: dict):
+    return [
+        Artifact(**{key: value for key, value in entry.items() if key != "mtime_ns"}) for entry in manifest["artifacts"]
+    ]
+
+
+def verify_tree(root: Path, workers=4):
+    """
+    Check every artifact of an unpacked bundle against its manifest.
+
+    :rvalue: list[tuple[Artifact, str]] of the artifacts which failed, with the reason
+    """
+    manifest = root / ArtifactIndex.MANIFEST
+    assert manifest.exists(), f"{root} has no {ArtifactIndex.MANIFEST} to verify"
+    artifacts = _manifest_artifacts(json.loads(manifest.read_text()))
+    files = set()
+    for artifact in artifacts:
+        path = root / artifact.path
+        if path.is_dir():
+            files.update(sub for sub in path.rglob("*") if sub.is_file())
+        else:
+            files.add(path)
+
+    # files rather than artifacts are hashed concurrently so a charm's many files or a large image share the cores,
+    # the largest first so none is left hashing alone at the end
+    files = sorted((path for path in files if path.exists()), key=lambda path: -path.stat().st_size)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        digests = dict(zip(files, pool.map(file_digest, files)))
+
+    failed = []
+    for artifact in artifacts:
+        path = root / artifact.path
+        if not path.exists():
+            failed.append((artifact, "missing"))
+        elif tree_digest(path, digests.__getitem__) != artifact.digest:
+            failed.append((artifact, "digest mismatch"))
+    return failed
+
+
+def verify_archive(archive: Path):
+    """
+    Check every artifact of a bundle's tarball against its manifest, reading the tarball once.
+
+    :rvalue: list[tuple[Artifact, str]] of the artifacts which failed, with the reason
+    """
+    digests, links, manifest = {}, {}, None
+    # the next chunk is decompressed while the previous one is hashed
+    with tarfile.open(archive, "r|*") as tar, ThreadPoolExecutor(max_workers=1) as hasher:
+        for member in tar:
+            path = Path(*Path(member.name).parts[1:])
+            if member.issym():
+                links[path] = Path(os.path.normpath(path.parent / member.linkname))
+            elif member.isfile():
+                fp = tar.extractfile(member)
+                if path == Path(ArtifactIndex.MANIFEST):
+                    manifest = json.loads(fp.read())
+                    continue
+                digest, hashed = hashlib.sha256(), hasher.submit(lambda: None)
+                for chunk in iter(lambda: fp.read(8 << 20), b""):
+                    hashed.result()
+                    hashed = hasher.submit(digest.update, chunk)
+                hashed.result()
+                digests[path] = f"sha256:{digest.hexdigest()}"
+    assert manifest, f"{archive} has no {ArtifactIndex.MANIFEST} to verify"
+    for link, target in links.items():
+        if target in digests:
+            digests[link] = digests[target]
+
+    failed = []
+    for artifact in _manifest_artifacts(manifest):
+        path = Path(artifact.path)
+        files = sorted(sub for sub in digests if path in sub.parents)
+        if path in digests:
+            digest = digests[path]
+        elif files:
+            tree = hashlib.sha256()
+            for sub in files:
+                tree.update(f"{sub.relative_to(path).as_posix()}\0{digests[sub]}\n".encode())
+            digest = f"sha256:{tree.hexdigest()}"
+        else:
+            failed.append((artifact, "missing"))
+            continue
+        if digest != artifact.digest:
+            failed.append((artifact, "digest mismatch"))
+    return failed
+
+
+def verify(argv=None):
+    """Check the charms, resources, snaps and images of a shrinkwrap bundle against its artifact manifest."""
+    args = get_verify_args(argv)
+    path = Path(args.path)
+    start = time.monotonic()
+    with status(f"Verifying {path}"):
+        failed = verify_archive(path) if path.is_file() else verify_tree(path, args.workers)
+    for artifact, reason in failed:
+        print(f"    {artifact.kind} {artifact.path}: {reason}")
+    if failed:
+        sys.exit(f"{len(failed)} artifacts of {path} failed verification")
+    print(f"Verified {path} in {time.monotonic() - start:.1f}s")
+
+
+class S3Client:
+    """S3 API client for multipart uploads, signed with AWS signature version 4."""
+
+    def __init__(self, endpoint, access_key, secret_key, region="us-east-1", workers=4):
+        self.url = endpoint.rstrip("/")
+        self.access_key, self.secret_key = access_key, secret_key
+        self.region = region
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    @staticmethod
+    def _quote(value, safe="-_.~"):
+        return quote(str(value), safe=safe)
+
+    def _signed_headers(self, method, path, query, headers, payload_hash):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        amz_date, date = now.strftime("%Y%m%dT%H%M%SZ"), now.strftime("%Y%m%d")
+        headers = dict(headers, Host=urlparse(self.url).netloc)
+        headers["x-amz-date"], headers["x-amz-content-sha256"] = amz_date, payload_hash
+        canonical_headers = {name.lower(): str(value).strip() for name, value in headers.items()}
+        signed = ";".join(sorted(canonical_headers))
+        canonical = "\n".join(
+            [
+                method,
+                self._quote(path, safe="/-_.~"),
+                query,
+                "".join(f"{name}:{canonical_headers[name]}\n" for name in sorted(canonical_headers)),
+                signed,
+                payload_hash,
+            ]
+        )
+        scope = f"{date}/{self.region}/s3/aws4_request"
+        to_sign = "\n".join(["AWS4-HMAC-SHA256", amz_date, scope, hashlib.sha256(canonical.encode()).hexdigest()])
+        key = f"AWS4{self.secret_key}".encode()
+        for part in [date, self.region, "s3", "aws4_request"]:
+            key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+        signature = hmac.new(key, to_sign.encode(), hashlib.sha256).hexdigest()
+        headers["Authorization"] = (
+            f"AWS4-HMAC-SHA256 Credential={self.access_key}/{scope}, SignedHeaders={signed}, Signature={signature}"
+        )
+        return headers
+
+    def _request(self, method, bucket, key, query=None, data=b"", headers=None):
+        path = f"/{bucket}/{key}"
+        query = "&".join(f"{self._quote(name)}={self._quote(value)}" for name, value in sorted((query or {}).items()))
+        headers = self._signed_headers(method, path, query, headers or {}, hashlib.sha256(data).hexdigest())
+        url = f"{self.url}{self._quote(path, safe='/-_.~')}" + (f"?{query}" if query else "")
+        resp = self.session.request(method, url, data=data, headers=headers)
+        resp.raise_for_status()
+        return resp
+
+    @staticmethod
+    def _xml_text(body, name):
+        return ElementTree.fromstring(body).find(f"{{*}}{name}").text
+
+    def create_multipart_upload(self, bucket, key):
+        resp = self._request("POST", bucket, key, {"uploads": ""}, headers={"Content-Type": "application/gzip"})
+        return self._xml_text(resp.content, "UploadId")
+
+    def upload_part(self, bucket, key, upload_id, number, data: bytes):
+        """Upload one part, verifying the stored part against its md5. Returns the part's ETag."""
+        md5 = hashlib.md5(data)
+        resp = self._request(
+            "PUT",
+            bucket,
+            key,
+            {"partNumber": number, "uploadId": upload_id},
+            data,
+            {"Content-MD5": base64.b64encode(md5.digest()).decode(), "Content-Length": str(len(data))},
+        )
+        etag = resp.headers.get("ETag", "").strip('"')
+        # Content-MD5 has the store reject a corrupted part, but its ETag is only the md5 without KMS or
+        # customer keys encrypting the part
+        encryption = resp.headers.get("x-amz-server-side-encryption", "")
+        if (
+            not encryption.startswith("aws:kms")
+            and "x-amz-server-side-encryption-customer-algorithm" not in resp.headers
+        ):
+            assert etag == md5.hexdigest(), f"Part {number} of {key} was stored with ETag {etag}, not {md5.hexdigest()}"
+        return etag
+
+    def complete_multipart_upload(self, bucket, key, upload_id, etags):
+        parts = "".join(
+            f'<Part><PartNumber>{number}</PartNumber><ETag>"{etag}"</ETag></Part>'
+            for number, etag in enumerate(etags, 1)
+        )
+        body = f"<CompleteMultipartUpload>{parts}</CompleteMultipartUpload>".encode()
+        self._request("POST", bucket, key, {"uploadId": upload_id}, body, {"Content-Type": "application/xml"})
+
+    def abort_multipart_upload(self, bucket, key, upload_id):
+        self._request("DELETE", bucket, key, {"uploadId": upload_id})
+
+
+def _read_part(stream, size):
+    chunks, remaining = [], size
+    while remaining:
+        chunk = stream.read(remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b"".join(chunks)
+
+
+def upload_stream(client: S3Client, bucket, key, stream, part_size=64 << 20, workers=4, finalize=None):
+    """
+    Upload a stream as the parts of a multipart upload, read while earlier parts are uploading.
+
+    At most twice the workers' parts are held in memory, the upload is aborted should any part fail.
+    @param finalize: called once every part is uploaded, the upload is aborted rather than completed if it raises
+    :rvalue: int bytes uploaded
+    """
+    upload_id = client.create_multipart_upload(bucket, key)
+    slots = threading.BoundedSemaphore(workers * 2)
+    futures, size = [], 0
+    try:
+        with thread_pool(workers) as pool:
+            while True:
+                slots.acquire()
+                data = _read_part(stream, part_size)
+                if futures and not data:
+                    slots.release()
+                    break
+                future = pool.submit(client.upload_part, bucket, key, upload_id, len(futures) + 1, data)
+                future.add_done_callback(lambda _: slots.release())
+                futures.append(future)
+                size += len(data)
+                failed = any(future.done() and future.exception() for future in futures)
+                if failed or len(data) < part_size:
+                    break
+            etags = [future.result() for future in futures]
+        if finalize:
+            finalize()
+        client.complete_multipart_upload(bucket, key, upload_id, etags)
+    except BaseException:
+        client.abort_multipart_upload(bucket, key, upload_id)
+        raise
+    return size
+
+
+def upload_archive(root: Path, url, metrics: Metrics, part_size=64 << 20, workers=4, base: Optional[Path] = None):
+    """
+    Stream the build root as a tarball straight to an s3://bucket/prefix url, returning the object's url.
+
+    @param base: folder the tarball's paths are relative to, the root's parent when None
+
+    Credentials and region are read from $AWS_ACCESS_KEY_ID, $AWS_SECRET_ACCESS_KEY and $AWS_DEFAULT_REGION,
+    the endpoint from $AWS_ENDPOINT_URL for S3 compatible object stores.
+    """
+    parsed = urlparse(url)
+    assert parsed.scheme == "s3" and parsed.netloc, f"{url} isn't an s3://bucket/prefix url"
+    base = base or root.parent
+    archived = root.relative_to(base)
+    bucket, key = parsed.netloc, "/".join(filter(None, [parsed.path.strip("/"), f"{archived.as_posix()}.tar.gz"]))
+    region = os.environ.get("AWS_DEFAULT_REGION") or os.environ.get("AWS_REGION") or "us-east-1"
+    client = S3Client(
+        os.environ.get("AWS_ENDPOINT_URL") or f"https://s3.{region}.amazonaws.com",
+        os.environ.get("AWS_ACCESS_KEY_ID"),
+        os.environ.get("AWS_SECRET_ACCESS_KEY"),
+        region,
+        workers,
+    )
+    with metrics.artifact("upload", f"s3://{bucket}/{key}") as record:
+        tar = Popen(shlx(f"tar -cz -C {base} {archived} --force-local"), stdout=PIPE)
+
+        def finalize():
+            # a failed tar still ends its stream, which mustn't be published as the tarball
+            if tar.wait():
+                raise CalledProcessError(tar.returncode, tar.args)
+
+        try:
+            record["bytes"] = upload_stream(client, bucket, key, tar.stdout, part_size, workers, finalize)
+        finally:
+            tar.stdout.close()
+            tar.wait()
+    return f"s3://{bucket}/{key}"
+
+
+# arguments deciding what a build contains, a journal is only resumed by a build of the same arguments
+JOURNALED_ARGS = [
+    "bundle",
+    "channel",
+    "overlay",
+    "arch",
+    "only_apps",
+    "exclude_apps",
+    "image_allow",
+    "image_deny",
+    "image_map",
+    "packed_charms",
+    "skip_resources",
+    "skip_snaps",
+    "skip_containers",
+]
+
+
+def build_root(args) -> Path:
     if args.use_path:
         root = Path(args.use_path)
         assert root.exists(), f"Path {args.use_path} Doesn't Exist"
@@ -584,18 +3043,754 @@ def main():
     else:
         # Create a temporary dir.
         root = Path("build") / "{}-{:%Y-%m-%d-%H-%M-%S}".format(args.bundle, datetime.datetime.now())
+    return root
+
+
+class Progress(namedtuple("Progress", "event, name, kind, seconds, bytes")):
+    """
+    A step of a build, given to progress callbacks.
 
-    bundle = download(args, root)
+    Each stage (resolve, charms, snaps, resources, containers, bundle, archive, ...) is "started" and then
+    "finished" after its seconds, and each artifact is "fetched" with its kind, seconds and bytes transferred.
+    """
+
+
+def _listed(value):
+    """A list of the value, or of each item of a sequence."""
+    if value is None:
+        return None
+    return [value] if isinstance(value, str) else list(value)
+
+
+class ShrinkwrapBuild:
+    """
+    A build of an offline bundle run in-process: resolve, download, then package.
+
+    Builds in one interpreter share the metadata client's connections and timings, and the artifact
+    store when one is given, so many targets can be built without a process each.
+
+        build = ShrinkwrapBuild("charmed-kubernetes", channel="1.29/stable", arches=["amd64"], store="build/.store")
+        plan = build.resolve()
+        build.download()
+        tarball = build.package()
+
+    A build holds its root until package() is done or the build is closed, refusing other builds of the root.
+    """
+
+    def __init__(
+        self,
+        bundle: str,
+        channel: Optional[str] = None,
+        overlays: Sequence = (),
+        arches: Optional[Sequence] = None,
+        root=None,
+        store=None,
+        progress=None,
+        **options,
+    ):
+        """
+        @param bundle: the bundle to shrinkwrap
+        @param channel: the channel of the bundle
+        @param overlays: overlay bundles applied over the bundle
+        @param arches: architectures the bundle is built for, a list or comma separated str, the host's when None
+        @param root: PathLike[str] the bundle is built in, a new folder in ./build when None
+        @param store: ArtifactStore or its PathLike[str] shared between builds, or None to download directly
+        @param progress: callable given a Progress for each stage and artifact of the build
+        @param options: any other build argument, e.g. skip_snaps=True, only_apps=["etcd"] or max_disk="40G"
+        """
+        args = get_args([bundle])
+        unknown = set(options) - set(vars(args))
+        if unknown:
+            raise TypeError(f"unknown build options {', '.join(sorted(unknown))}")
+        # a single value may be a str, e.g. arches="amd64,arm64" or only_apps="etcd", as on the command line
+        for name in ("image_allow", "image_deny"):
+            if isinstance(options.get(name), str):
+                options[name] = [options[name]]
+        for name in ("only_apps", "exclude_apps"):
+            if options.get(name) is not None:
+                options[name] = comma_list(_listed(options[name]))
+        vars(args).update(options, channel=channel, overlay=_listed(overlays), arch=comma_list(_listed(arches)))
+        if isinstance(args.max_disk, str):
+            args.max_disk = disk_size(args.max_disk)
+        assert not (args.upload and args.skip_tar_gz), "upload cannot be combined with skip_tar_gz"
+        if store is not None and not isinstance(store, ArtifactStore):
+            store = ArtifactStore(store)
+        if args.coordinate and store is None:
+            raise ValueError("--coordinate needs a --store shared with the workers")
+        self._setup(args, store, Path(root) if root else None, progress)
+
+    @classmethod
+    def from_args(cls, args, store: Optional[ArtifactStore] = None, root: Optional[Path] = None, progress=None):
+        """A build of parsed cli arguments."""
+        build = cls.__new__(cls)
+        build._setup(args, store, root, progress)
+        return build
+
+    def _setup(self, args, store, root, progress):
+        self.args = args
+        self.store = store
+        self.root = root or build_root(args)
+        # the first build to finish archives and removes its root, so only one build may write a root at a time
+        self._claim = ExitStack()
+        try:
+            self._claim.enter_context(named_lock(f"build:{self.root.resolve()}", blocking=False))
+        except BlockingIOError:
+            raise RuntimeError(
+                f"{self.root} is already being built, concurrent builds need their own roots and may share a --store"
+            ) from None
+        self.output = self.root if args.skip_tar_gz else Path(f"{self.root}.tar.gz")
+        target = {name: getattr(args, name) for name in JOURNALED_ARGS}
+        # a build of other arguments in the same root keeps its own journal, rather than starting this one over
+        digest = hashlib.sha256(json.dumps(target, sort_keys=True).encode()).hexdigest()
+        self.journal = BuildJournal(f"{self.root}.{digest[:12]}.journal", target)
+        self.profiler = args.profile and Profiler(Path(args.profile) / self.root.name)
+        self.metrics = Metrics(self.profiler, progress)
+        # a folder built with --skip-tar-gz may be archived or uploaded by a later run, and a tarball uploaded
+        self.target = args.upload or str(self.output)
+        archive = self.journal.steps.get("archive", {})
+        self.archived = archive.get("target", archive.get("output")) == self.target
+        self.budget = None
+        if args.max_disk and not self.archived:
+            # a local tarball is written while downloading, so the root and tarball don't need room for two copies
+            packager = None if args.upload or args.skip_tar_gz else StreamingPackager(self.root, self.output)
+            self.budget = DiskBudget(args.max_disk, packager)
+        # the streamed tarball of an interrupted build is started again, with the artifacts already packed into it
+        self.streaming = bool(self.budget and self.budget.packager)
+        self.plan = None
+        self.charms = None
+
+    def resolve(self) -> DownloadPlan:
+        """Download the bundle and its charms, planning the snaps, resources and images they need."""
+        if self.plan is None:
+            self.plan = plan_download(self.args, self.root, self.store, self.metrics, self.journal, self.budget)
+        return self.plan
+
+    def download(self) -> BundleDownloader:
+        """Download everything the plan needs, unless an interrupted run of this build already did."""
+        if self.charms is not None:
+            return self.charms
+        if self.journal.done("download") and not self.streaming:
+            print(f"Downloads of {self.root} already completed")
+            self.charms = bundle_downloader(self.args, self.root, metrics=self.metrics, journal=self.journal)
+            return self.charms
+        if self.args.coordinate:
+            self.charms = distributed_download(
+                self.args, self.root, self.store, self.metrics, self.journal, self.budget, self.resolve()
+            )
+        else:
+            self.charms = fetch_download(self.args, self.resolve(), self.metrics)
+        self.journal.record("download")
+        return self.charms
+
+    def package(self):
+        """
+        Write the offline bundle, then archive or upload it.
+
+        :rvalue: Path of the tarball, or the folder with skip_tar_gz, or the url of the uploaded tarball
+        """
+        args, root, metrics, output = self.args, self.root, self.metrics, self.output
+        if self.archived:
+            print(f"Build {root} already completed")
+            self.close()
+            return self.journal.steps["archive"]["output"] if args.upload else output
+        charms = self.download()
+
+        # Generate a new bundle.yaml for deployment
+        if not self.journal.done("bundle") or self.streaming:
+            with status("Writing offline bundle.yaml"), metrics.stage("bundle"):
+                build_offline_bundle(root, charms, args.arch, charms.index, charms.documents)
+            self.journal.record("bundle")
+
+        # Stream the tarball to object storage, or make it locally.
+        if args.upload:
+            with status(f"Uploading tarball to {args.upload}"), metrics.stage("upload"):
+                output = upload_archive(root, args.upload, metrics, args.upload_part_size << 20, args.upload_workers)
+                shutil.rmtree(root)
+        elif self.streaming:
+            with status(f"Completing tarball {output}"), metrics.stage("archive"):
+                self.budget.packager.close()
+        elif not args.skip_tar_gz:
+            with status(f"Writing tarball {output}"), metrics.stage("archive"):
+                check_call(shlx(f"tar -czf {output} -C {root.parent} {root.name} --force-local"))
+                shutil.rmtree(root)
+        self.journal.record("archive", output=str(output), target=self.target)
+        self.archived = True
+
+        # Record the build's performance next to its output
+        metrics.write(f"{root}.metrics.json")
+        if args.prometheus_textfile:
+            metrics.write_prometheus(args.prometheus_textfile)
+        if self.profiler:
+            self.profiler.write()
+        self.close()
+        return output
+
+    def run(self):
+        """Resolve, download and package the build, returning its output."""
+        try:
+            return self.package()
+        finally:
+            self.close()
+
+    def close(self):
+        """Release the build's root to other builds, which package() does once it's done."""
+        self._claim.close()
+
+
+def build(args, store: Optional[ArtifactStore] = None, root: Optional[Path] = None) -> Path:
+    """
+    Build the offline bundle, returning its tarball or folder.
+
+    @param root: folder the bundle is built in, named by the bundle, channel and time when None
+    """
+    return ShrinkwrapBuild.from_args(args, store, root).run()
+
+
+def get_serve_args(argv=None):
+    """Parse serve cli arguments."""
+    parser = argparse.ArgumentParser(prog="shrinkwrap.py serve")
+    parser.add_argument("--host", default="127.0.0.1", help="address the job API listens on")
+    parser.add_argument("--port", type=int, default=8080, help="port the job API listens on")
+    parser.add_argument("--workers", type=int, default=2, help="number of builds run concurrently")
+    parser.add_argument("--store", default=str(Path("build") / ".store"), help="Artifact store shared by every build")
+    parser.add_argument(
+        "--metadata-ttl",
+        type=float,
+        default=600,
+        help="seconds charm, snap and container listings are cached between builds",
+    )
+    parser.add_argument(
+        "--keep-jobs", type=int, default=100, help="finished jobs kept for their state and log, oldest forgotten first"
+    )
+    return parser.parse_args(argv)
+
+
+class _JobOutput:
+    """Standard output which writes what each job's threads print into that job's log."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self._local = threading.local()
+
+    @contextmanager
+    def capture(self, job):
+        self._local.job = job
+        try:
+            yield
+        finally:
+            self._local.job = None
+
+    def inherit(self):
+        """Initializer of a thread pool whose threads print into the log of the job creating it."""
+        job = getattr(self._local, "job", None)
+
+        def initializer():
+            self._local.job = job
+
+        return initializer
+
+    def write(self, text):
+        job = getattr(self._local, "job", None)
+        return (job or self.stream).write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+
+class BuildJob:
+    # json request fields which are build arguments
+    FIELDS = {"bundle", "channel", "overlay", "arch", "max_disk"}
+    FLAGS = {"skip_resources", "skip_snaps", "skip_containers", "skip_tar_gz", "packed_charms"}
+
+    def __init__(self, job_id, args):
+        self.id = job_id
+        self.args = args
+        self.state = "queued"
+        self.output = None
+        self.metrics = None
+        self.error = None
+        self._lines = []
+        self._partial = ""
+        self._changed = threading.Condition()
+
+    @classmethod
+    def parse(cls, job_id, request: dict):
+        """Build arguments of a json job request, raising ValueError when it isn't valid."""
+        if not isinstance(request, dict) or not isinstance(request.get("bundle"), str):
+            raise ValueError("a job requires a bundle")
+        unknown = set(request) - cls.FIELDS - cls.FLAGS
+        if unknown:
+            raise ValueError(f"unknown job fields {', '.join(sorted(unknown))}")
+        argv = [request["bundle"]]
+        for option in ["channel", "max_disk"]:
+            if request.get(option):
+                argv += [f"--{option.replace('_', '-')}", str(request[option])]
+        for option in ["overlay", "arch"]:
+            values = request.get(option) or []
+            for value in [values] if isinstance(values, str) else values:
+                argv += [f"--{option}", str(value)]
+        argv += [f"--{flag.replace('_', '-')}" for flag in sorted(cls.FLAGS) if request.get(flag)]
+        try:
+            return cls(job_id, get_args(argv))
+        except SystemExit:
+            raise ValueError(f"invalid build arguments {' '.join(argv)}")
+
+    @property
+    def done(self):
+        return self.state in ("succeeded", "failed")
+
+    def write(self, text):
+        with self._changed:
+            *lines, self._partial = (self._partial + text).split("\n")
+            self._lines += lines
+            self._changed.notify_all()
+
+    def finish(self, state, **results):
+        with self._changed:
+            if self._partial:
+                self._lines.append(self._partial)
+                self._partial = ""
+            self.state = state
+            for name, value in results.items():
+                setattr(self, name, value)
+            self._changed.notify_all()
+
+    def start(self):
+        with self._changed:
+            self.state = "running"
+            self._changed.notify_all()
+
+    def log(self, start=0):
+        """Yield the lines printed by the job, waiting for more until it's done."""
+        while True:
+            with self._changed:
+                self._changed.wait_for(lambda: len(self._lines) > start or self.done)
+                lines, done = self._lines[start:], self.done
+            yield from lines
+            start += len(lines)
+            if done and not lines:
+                return
+
+    def to_json(self):
+        return {
+            "id": self.id,
+            "state": self.state,
+            "bundle": self.args.bundle,
+            "channel": self.args.channel,
+            "overlay": self.args.overlay,
+            "arch": self.args.arch,
+            "output": self.output and str(self.output),
+            "metrics": self.metrics,
+            "error": self.error,
+        }
+
+
+class BuildService:
+    """
+    Runs build jobs concurrently in one long-lived process.
+
+    Every job shares the artifact store, so listings resolved and artifacts downloaded by one build
+    are reused by the next, and a download in flight for one job is waited on by any other needing it.
+    """
+
+    def __init__(self, store: ArtifactStore, workers=2, output: Optional[_JobOutput] = None, keep_jobs=100):
+        """
+        @param keep_jobs: finished jobs kept for their state and log, the oldest are forgotten first
+        """
+        self.store = store
+        self.jobs = {}
+        self.output = output or _JobOutput(sys.stdout)
+        self.keep_jobs = keep_jobs
+        self._submitted = 0
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+
+    def submit(self, request: dict) -> BuildJob:
+        with self._lock:
+            job = BuildJob.parse(str(self._submitted + 1), request)
+            self._submitted += 1
+            self.jobs[job.id] = job
+            finished = [job_id for job_id, other in self.jobs.items() if other.done]
+            for job_id in finished[: max(len(finished) - self.keep_jobs, 0)]:
+                del self.jobs[job_id]
+        self._pool.submit(self._run, job)
+        return job
+
+    def _run(self, job: BuildJob):
+        job.start()
+        root = Path(f"{build_root(job.args)}-job{job.id}")
+        with self.output.capture(job):
+            try:
+                output = build(job.args, self.store, root)
+            except BaseException as e:
+                job.finish("failed", error=f"{type(e).__name__}: {e}")
+            else:
+                metrics = json.loads(Path(f"{root}.metrics.json").read_text())
+                job.finish("succeeded", output=output, metrics=metrics)
+
+    def shutdown(self):
+        self._pool.shutdown(wait=True)
+
+
+class _JsonHandler(BaseHTTPRequestHandler):
+    def _reply(self, code, body=None):
+        data = json.dumps(body).encode() if body is not None else b""
+        self.send_response(code)
+        if data:
+            self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _body(self):
+        return json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"null")
+
+
+class _ServiceHandler(_JsonHandler):
+    def _job(self, job_id):
+        job = self.server.service.jobs.get(job_id)
+        if not job:
+            self._reply(404, {"error": f"no job {job_id}"})
+        return job
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/jobs":
+            return self._reply(404, {"error": f"no route {self.path}"})
+        try:
+            job = self.server.service.submit(self._body())
+        except ValueError as e:
+            return self._reply(400, {"error": str(e)})
+        self._reply(202, job.to_json())
+
+    def do_GET(self):
+        parts = [part for part in self.path.split("/") if part]
+        if parts == ["jobs"]:
+            return self._reply(200, [job.to_json() for job in self.server.service.jobs.values()])
+        if len(parts) == 2 and parts[0] == "jobs":
+            job = self._job(parts[1])
+            return job and self._reply(200, job.to_json())
+        if len(parts) == 3 and parts[0] == "jobs" and parts[2] == "log":
+            job = self._job(parts[1])
+            if not job:
+                return
+            # streamed until the job is done, the connection closing marks the end of the log
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; charset=utf-8")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            for line in job.log():
+                self.wfile.write(f"{line}\n".encode())
+                self.wfile.flush()
+            return
+        self._reply(404, {"error": f"no route {self.path}"})
+
+    def log_message(self, format, *args):
+        self.server.service.output.stream.write(f"    {self.address_string()} {format % args}\n")
+
+
+def serve(argv=None):
+    args = get_serve_args(argv)
+    output = _JobOutput(sys.stdout)
+    service = BuildService(ArtifactStore(args.store, ttl=args.metadata_ttl), args.workers, output, args.keep_jobs)
+    server = ThreadingHTTPServer((args.host, args.port), _ServiceHandler)
+    server.service = service
+    sys.stdout = output
+    print(f"Serving build jobs on http://{args.host}:{server.server_port}/jobs")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.shutdown()
+        sys.stdout = output.stream
+
+
+# build flags which change what is stored
+WARM_FLAGS = ["skip_resources", "skip_snaps", "skip_containers", "packed_charms"]
+
+
+def get_warm_args(argv=None):
+    """Parse warm cli arguments."""
+    parser = argparse.ArgumentParser(prog="shrinkwrap.py warm")
+    parser.add_argument("targets", help="YAML list of targets (bundle, channel, overlay, arch) as for --batch")
+    parser.add_argument("--store", default=str(Path("build") / ".store"), help="Artifact store to download into")
+    parser.add_argument("--interval", type=float, default=3600, help="seconds between polls for new revisions")
+    parser.add_argument("--once", action="store_true", help="Poll once then exit")
+    parser.add_argument("--skip-resources", action="store_true", help="Skip downloading attached charm resources")
+    parser.add_argument("--skip-snaps", action="store_true", help="Skip downloading required charm snaps")
+    parser.add_argument("--skip-containers", action="store_true", help="Skip downloading container images")
+    parser.add_argument("--packed-charms", action="store_true", help="Store charms for builds using --packed-charms")
+    return parser.parse_args(argv)
+
+
+def warm_store(args):
+    """
+    Download the current artifacts of every target into the store.
+
+    Each target is downloaded into a scratch root within the store, so artifacts already stored are only linked
+    and only newly published revisions are fetched. Metadata is resolved again on every call.
+    """
+    store = ArtifactStore(args.store)
+    flags = [f"--{flag.replace('_', '-')}" for flag in WARM_FLAGS if getattr(args, flag)]
+    batch_args = get_args(["--batch", args.targets, "--store", args.store, "--skip-tar-gz"] + flags)
+    for target_args in list(batch_targets(batch_args)):
+        print(f"Warming {target_args.bundle} {target_args.channel or ''}")
+        metrics = Metrics()
+        try:
+            with tempfile.TemporaryDirectory(prefix=".warm-", dir=store.path) as root:
+                # the scratch root is thrown away, so its manifest isn't written
+                download(target_args, Path(root), store, metrics, save_index=False)
+        except Exception as e:
+            # a target failing to resolve shouldn't stop the others warming
+            print(f"    Failed warming {target_args.bundle}: {type(e).__name__}: {e}")
+            continue
+        fetched = [record for record in metrics.artifacts if not record["reused"]]
+        print(f"    Stored {len(fetched)} new artifacts, {sum(record['bytes'] for record in fetched)} bytes")
+
+
+def warm(argv=None):
+    args = get_warm_args(argv)
+    while True:
+        warm_store(args)
+        if args.once:
+            return
+        time.sleep(args.interval)
+
+
+def get_worker_args(argv=None):
+    """Parse worker cli arguments."""
+    parser = argparse.ArgumentParser(prog="shrinkwrap.py worker")
+    parser.add_argument("url", help="work queue of the coordinating build, e.g. http://builder:8081")
+    parser.add_argument(
+        "--store",
+        default=str(Path("build") / ".store"),
+        help="Artifact store shared with the coordinating build, or synced to it afterwards",
+    )
+    return parser.parse_args(argv)
+
+
+class WorkQueue:
+    """
+    Downloads handed out to workers.
+
+    A claimed item is leased to its worker until it reports the item done. Items of workers which fail or
+    disappear aren't handed out again, the coordinating build downloads whatever isn't stored afterwards.
+    """
+
+    def __init__(self, items, lease=3600):
+        """
+        @param items: list of json work items
+        @param lease: seconds a worker has to complete a claimed item
+        """
+        self.items = {str(item_id): item for item_id, item in enumerate(items)}
+        self.lease = lease
+        self.errors = {}
+        self._pending = list(self.items)
+        self._leased = {}
+        self._changed = threading.Condition()
+
+    def claim(self):
+        """
+        The next item to work on, None once every item has been handed out.
+
+        :rvalue: Optional[tuple[str, dict]]
+        """
+        with self._changed:
+            if not self._pending:
+                return None
+            item_id = self._pending.pop(0)
+            self._leased[item_id] = time.monotonic() + self.lease
+            return item_id, self.items[item_id]
+
+    def complete(self, item_id, error=None):
+        with self._changed:
+            self._leased.pop(item_id, None)
+            if error:
+                self.errors[item_id] = error
+            self._changed.notify_all()
+
+    def _working(self):
+        now = time.monotonic()
+        return any(deadline > now for deadline in self._leased.values())
+
+    def wait(self, workers=None):
+        """
+        Wait until every item is complete, or its lease expired.
+
+        @param workers: local worker processes, stop waiting on unclaimed items once they've all exited
+        """
+
+        def finished():
+            exited = bool(workers) and all(worker.poll() is not None for worker in workers)
+            return not self._working() and (not self._pending or exited)
+
+        with self._changed:
+            while not self._changed.wait_for(finished, timeout=1):
+                pass
+
+
+class _WorkHandler(_JsonHandler):
+    def do_POST(self):
+        parts = [part for part in self.path.split("/") if part]
+        if parts == ["work"]:
+            claimed = self.server.queue.claim()
+            return self._reply(200, {"id": claimed[0], "item": claimed[1]}) if claimed else self._reply(204)
+        if len(parts) == 2 and parts[0] == "work" and parts[1] in self.server.queue.items:
+            self.server.queue.complete(parts[1], (self._body() or {}).get("error"))
+            return self._reply(200, {})
+        self._reply(404, {"error": f"no route {self.path}"})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_work(queue: WorkQueue, address=("", 0)):
+    """
+    Listen for workers claiming items of the queue, returns the server and its url once it's serving.
+
+    :rvalue: tuple[ThreadingHTTPServer, str]
+    """
+    server = ThreadingHTTPServer(address, _WorkHandler)
+    server.queue = queue
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host = address[0] or platform.node()
+    return server, f"http://{host}:{server.server_port}"
+
+
+def work_items(args, plan: DownloadPlan):
+    """
+    Every snap, resource and container image of the plan as json work items.
+
+    Workers may run on other architectures, so items the build fetches for its own host name the host's.
+    """
+    items, host = [], host_arch()
+    if not args.skip_snaps:
+        for snap, channel, arch in plan.snaps._downloaded:
+            items.append({"kind": SnapDownloader.KIND, "snap": snap, "channel": channel, "arch": arch or host})
+    if not args.skip_resources:
+        for app, charm, resource in plan.resources._downloaded:
+            items.append({"kind": ResourceDownloader.KIND, "app": app, "charm": charm, "resource": resource._asdict()})
+    if plan.containers:
+        for arch in plan.containers.arches:
+            for image in plan.containers.images(plan.k8s_cp_channel):
+                items.append({"kind": ContainerDownloader.KIND, "image": image, "arch": arch or host})
+    return items
+
+
+def run_work_item(item, store: ArtifactStore, root: Path):
+    """Download a work item into the store, linking it into a scratch root."""
+    kind = item["kind"]
+    if kind == SnapDownloader.KIND:
+        snaps = SnapDownloader(root, store=store)
+        snaps.mark_download(item["snap"], item["channel"], item["arch"])
+        snaps.download()
+    elif kind == ResourceDownloader.KIND:
+        resources = ResourceDownloader(root, store=store)
+        resources.mark_download(item["app"], item["charm"], Resource(**item["resource"]))
+        resources.download()
+    elif kind == ContainerDownloader.KIND:
+        ContainerDownloader(root, [item["arch"]], store=store)._image_fetch(item["image"], item["arch"])
+    else:
+        raise ValueError(f"unknown work item {kind}")
+
+
+def run_worker(url, store_path):
+    """Download items claimed from the coordinator's queue until it's empty."""
+    store = ArtifactStore(store_path)
+    while True:
+        resp = requests.post(f"{url}/work", timeout=METADATA.timeout)
+        resp.raise_for_status()
+        if resp.status_code == 204:
+            return
+        claimed, error = resp.json(), None
+        try:
+            with tempfile.TemporaryDirectory(prefix=".work-", dir=store.path) as root:
+                run_work_item(claimed["item"], store, Path(root))
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            print(f"    Failed {claimed['item']}: {error}")
+        requests.post(f"{url}/work/{claimed['id']}", json={"error": error}, timeout=METADATA.timeout).raise_for_status()
+
+
+def worker(argv=None):
+    args = get_worker_args(argv)
+    run_worker(args.url.rstrip("/"), args.store)
+
+
+def distributed_download(
+    args,
+    root,
+    store: ArtifactStore,
+    metrics: Metrics,
+    journal: Optional[BuildJournal] = None,
+    budget: Optional[DiskBudget] = None,
+    plan: Optional[DownloadPlan] = None,
+):
+    """
+    Download the bundle with the snaps, resources and images fetched by workers.
+
+    Workers claim items from a queue served on --coordinate and download them into the shared store, the build
+    then links everything from the store, downloading any item a worker failed.
+    """
+    if store is None:
+        raise ValueError("--coordinate needs a --store shared with the workers")
+    plan = plan or plan_download(args, root, store, metrics, journal, budget)
+    queue = WorkQueue(work_items(args, plan))
+    host, _, port = args.coordinate.rpartition(":")
+    server, url = serve_work(queue, (host, int(port)))
+    print(f"Coordinating {len(queue.items)} downloads at {url}")
+    # workers on this host connect over loopback, whether or not the host's name resolves
+    local_url = f"http://{host if host not in ('', '0.0.0.0') else '127.0.0.1'}:{server.server_port}"
+    workers = [
+        Popen([sys.executable, __file__, "worker", local_url, "--store", str(store.path)])
+        for _ in range(args.local_workers)
+    ]
+    try:
+        with metrics.stage("workers"):
+            queue.wait(workers)
+            # the local workers leave once they're told the queue is empty, so stay up until they have
+            for process in workers:
+                process.wait()
+    finally:
+        for process in workers:
+            if process.poll() is None:
+                process.terminate()
+                process.wait()
+        server.shutdown()
+        server.server_close()
+    for item_id, error in queue.errors.items():
+        print(f"    Worker failed {queue.items[item_id]}: {error}")
+    return fetch_download(args, plan, metrics)
+
+
+COMMANDS = {
+    "push-images": push_images,
+    "push-snaps": push_snaps,
+    "serve": serve,
+    "verify": verify,
+    "warm": warm,
+    "worker": worker,
+}
+
+
+def main():
+    METADATA.pool()
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        return COMMANDS[sys.argv[1]](sys.argv[2:])
+
+    args = get_args()
+    store = args.store or ((args.batch or args.coordinate) and Path("build") / ".store")
+    store = store and ArtifactStore(store)
 
-    # Generate a new bundle.yaml for deployment
-    with status("Writing offline bundle.yaml"):
-        build_offline_bundle(root, bundle)
+    if not args.batch:
+        return build(args, store)
 
-    # Make the tarball.
-    if not args.skip_tar_gz:
-        with status(f"Writing tarball {root}.tar.gz"):
-            check_call(shlx(f'tar -czf {root}.tar.gz -C build/ {root.relative_to("build")} --force-local'))
-            shutil.rmtree(root)
+    # Every target shares resolved metadata and downloaded artifacts through the store
+    # targets differing only by overlay or arch may start within a second, so each root is named by its target
+    for number, target_args in enumerate(list(batch_targets(args)), 1):
+        print(f"Target {target_args.bundle} {target_args.channel or ''}")
+        build(target_args, store, Path(f"{build_root(target_args)}-target{number}"))
 
 
 if __name__ == "__main__":
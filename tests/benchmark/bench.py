@@ -0,0 +1,201 @@
+"""
+Benchmark shrinkwrap against local stand-ins of charmhub, GitHub and a container registry.
+
+Every scenario builds a synthetic bundle in a fresh process: download(), build_offline_bundle(),
+the tarball and a push-images run, recording wall time, bytes per second and peak RSS.
+Results are appended to a JSON lines file keyed by commit, so runs can be compared:
+
+    python -m tests.benchmark.bench --apps 5,50,200 --latency 0.05 --bandwidth 20M
+    python -m tests.benchmark.bench --compare
+"""
+
+import argparse
+import json
+import os
+from pathlib import Path
+import resource
+from subprocess import check_call, check_output, run, CalledProcessError, PIPE
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+ROOT = Path(__file__).parent.parent.parent
+sys.path.insert(0, str(ROOT))
+
+import shrinkwrap  # noqa: E402
+from tests.standins import Charmhub, GitHub, Registry, image_layer, payload, save_image, synthetic_bundle  # noqa: E402
+
+UNITS = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+
+
+def size(value):
+    """Parse sizes such as 512K, 20M or 1G."""
+    value = value.strip().upper()
+    if value[-1:] in UNITS:
+        return int(float(value[:-1]) * UNITS[value[-1]])
+    return int(value)
+
+
+def get_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m tests.benchmark.bench")
+    parser.add_argument("--apps", default="5,50", help="comma separated bundle sizes, one scenario each")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every stand-in response")
+    parser.add_argument("--bandwidth", type=size, default=None, help="bytes/s of each stand-in response")
+    parser.add_argument("--charm-size", type=size, default=size("64K"), help="padding within each charm")
+    parser.add_argument("--resource-size", type=size, default=size("1M"), help="size of each file resource")
+    parser.add_argument("--images", type=int, default=10, help="container images pushed to the registry")
+    parser.add_argument("--layer-size", type=size, default=size("4M"), help="size of each image layer")
+    parser.add_argument("--packed-charms", action="store_true", help="keep charms as .charm archives")
+    parser.add_argument("--results", default="bench_results.jsonl", help="JSON lines file receiving the results")
+    parser.add_argument("--compare", action="store_true", help="compare the last two runs of the results file")
+    parser.add_argument("--scenario", default=None, help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def _timed(phases, name, func, *args):
+    start = time.monotonic()
+    result = func(*args)
+    phases[name] = round(time.monotonic() - start, 3)
+    return result
+
+
+def run_scenario(scenario):
+    """Build one synthetic bundle, run in its own process so peak RSS belongs to the scenario."""
+    throttle = dict(latency=scenario["latency"], bandwidth=scenario["bandwidth"])
+    overlay = synthetic_bundle(1, prefix="overlay")
+    bundles = {"bench-bundle": synthetic_bundle(scenario["apps"])}
+    images = [f"bench/image-{i}:1.0" for i in range(scenario["images"])]
+
+    charmhub = Charmhub(bundles, scenario["charm_size"], scenario["resource_size"], **throttle)
+    github = GitHub({"bench-overlay.yaml": overlay}, images, **throttle)
+    registry = Registry(**throttle)
+    urls = {
+        shrinkwrap.StoreDownloader: ("CH_URL", f"{charmhub.url}/v2"),
+        shrinkwrap.OverlayDownloader: ("GH_URL", f"{github.url}/overlays"),
+        shrinkwrap.ContainerDownloader: ("URL", f"{github.url}/container-images"),
+    }
+    original = {cls: getattr(cls, attr) for cls, (attr, _) in urls.items()}
+    for cls, (attr, url) in urls.items():
+        setattr(cls, attr, url)
+    try:
+        with charmhub, github, registry, tempfile.TemporaryDirectory() as tmp:
+            return _build(scenario, charmhub, github, registry, Path(tmp), bundles, images)
+    finally:
+        for cls, (attr, _) in urls.items():
+            setattr(cls, attr, original[cls])
+
+
+def _build(scenario, charmhub, github, registry, tmp, bundles, images):
+    """Download, render, archive and push the synthetic bundle, timing each phase."""
+    build = tmp / "build"
+    root = build / "bench-bundle"
+    args = SimpleNamespace(
+        bundle="bench-bundle",
+        channel=None,
+        overlay=["bench-overlay.yaml"],
+        arch=None,
+        packed_charms=scenario.get("packed_charms", False),
+        only_apps=None,
+        exclude_apps=None,
+        skip_snaps=True,  # snap-store-proxy and docker aren't stood in
+        skip_resources=False,
+        skip_containers=True,  # image archives are pushed to the registry stand-in instead
+    )
+    phases = {}
+    metrics = shrinkwrap.Metrics()
+    charms = _timed(phases, "download", shrinkwrap.download, args, root, None, metrics)
+    _timed(phases, "bundle", shrinkwrap.build_offline_bundle, root, charms)
+
+    base = image_layer(payload(scenario["layer_size"], "base"))
+    for i, image in enumerate(images):
+        layer = image_layer(payload(scenario["layer_size"], image))
+        save_image(root / "containers" / f"{image[len('bench/'):]}.tar.gz", image, [base, layer])
+    _timed(phases, "archive", check_call, ["tar", "-czf", f"{root}.tar.gz", "-C", str(build), root.name])
+    push_args = [str(root), "--registry", registry.url, "--prefix", "bench"]
+    _timed(phases, "push-images", shrinkwrap.push_images, push_args)
+
+    downloaded = charmhub.bytes_sent + github.bytes_sent
+    return {
+        "apps": scenario["apps"],
+        "phases": phases,
+        "seconds": round(sum(phases.values()), 3),
+        "downloaded_bytes": downloaded,
+        "download_bytes_per_second": round(downloaded / phases["download"]) if phases["download"] else 0,
+        "pushed_bytes": registry.bytes_received,
+        "push_bytes_per_second": round(registry.bytes_received / phases["push-images"]),
+        "requests": sum(charmhub.requests.values()) + sum(github.requests.values()),
+        "peak_rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "stages": metrics.report()["stages"],
+    }
+
+
+def commit():
+    try:
+        head = check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+        dirty = check_output(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT, text=True)
+    except (CalledProcessError, OSError):
+        return "unknown"
+    return f"{head}-dirty" if dirty.strip() else head
+
+
+def compare(results):
+    lines = Path(results).read_text().splitlines()
+    assert len(lines) >= 2, f"{results} needs two runs to compare"
+    before, after = (json.loads(line) for line in lines[-2:])
+    print(f"{before['commit']} -> {after['commit']}")
+    previous = {scenario["apps"]: scenario for scenario in before["scenarios"]}
+    for scenario in after["scenarios"]:
+        old = previous.get(scenario["apps"])
+        if not old:
+            continue
+        for field in ["seconds", "download_bytes_per_second", "push_bytes_per_second", "peak_rss_kib"]:
+            change = (scenario[field] - old[field]) / old[field] * 100 if old[field] else 0.0
+            print(f"    {scenario['apps']:>5} apps {field:<26} {old[field]:>14} {scenario[field]:>14} {change:+7.1f}%")
+
+
+def main(argv=None):
+    args = get_args(argv)
+    if args.scenario:
+        print(json.dumps(run_scenario(json.loads(args.scenario))))
+        return
+    if args.compare:
+        return compare(args.results)
+
+    settings = {
+        "latency": args.latency,
+        "bandwidth": args.bandwidth,
+        "charm_size": args.charm_size,
+        "resource_size": args.resource_size,
+        "images": args.images,
+        "layer_size": args.layer_size,
+        "packed_charms": args.packed_charms,
+    }
+    scenarios = []
+    for apps in [int(apps) for apps in args.apps.split(",")]:
+        scenario = json.dumps(dict(settings, apps=apps))
+        proc = run([sys.executable, __file__, "--scenario", scenario], stdout=PIPE, text=True, check=True)
+        result = json.loads(proc.stdout.splitlines()[-1])
+        print(
+            f"{apps:>5} apps: {result['seconds']:8.2f}s "
+            f"download {result['download_bytes_per_second'] / 2**20:8.1f} MiB/s "
+            f"push {result['push_bytes_per_second'] / 2**20:8.1f} MiB/s "
+            f"peak {result['peak_rss_kib'] / 2**10:8.1f} MiB"
+        )
+        scenarios.append(result)
+
+    record = {
+        "commit": commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "cpus": os.cpu_count(),
+        "settings": settings,
+        "scenarios": scenarios,
+    }
+    with open(args.results, "a") as fp:
+        fp.write(json.dumps(record) + "\n")
+    return record
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,401 @@
+"""
+Local stand-ins for the remote services shrinkwrap talks to.
+
+Every stand-in runs on a background thread of the calling process, can delay its responses
+and limit their bandwidth, and counts the requests and bytes it served.
+"""
+
+import base64
+from collections import Counter
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import json
+import random
+import re
+import tarfile
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+import uuid
+from xml.etree import ElementTree
+import zipfile
+
+import yaml
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    CHUNK = 1 << 16
+
+    def log_message(self, *_):
+        pass
+
+    def _reply(self, code, body=b"", headers=None):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        self.send_response(code)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command == "HEAD":
+            return
+        for offset in range(0, len(body), self.CHUNK):
+            chunk = body[offset : offset + self.CHUNK]
+            self.wfile.write(chunk)
+            if server.bandwidth:
+                time.sleep(len(chunk) / server.bandwidth)
+        with server.lock:
+            server.bytes_sent += len(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        self.server.requests[self.command, url.path.split("/")[1]] += 1
+        self._reply(*self.server.get(url.path, query))
+
+
+class StandInServer(ThreadingHTTPServer):
+    """
+    HTTP server run on a background thread of the calling process.
+
+    @param latency: seconds waited before each response
+    @param bandwidth: bytes per second each response is limited to, unlimited when None
+    """
+
+    daemon_threads = True
+
+    def __init__(self, handler=StandInHandler, latency=0.0, bandwidth=None):
+        super().__init__(("127.0.0.1", 0), handler)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.requests = Counter()
+        self.bytes_sent = 0
+        self.lock = threading.Lock()
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server_address
+        return f"http://{host}:{port}"
+
+    def get(self, path, query):
+        """:rvalue: tuple[int, bytes, dict] of status, body and headers"""
+        return 404, b"", {}
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *_):
+        self.shutdown()
+        self.server_close()
+
+
+def payload(size, seed=""):
+    """Incompressible bytes, so compression doesn't hide the cost of large artifacts."""
+    return random.Random(seed).getrandbits(8 * size).to_bytes(size, "little") if size else b""
+
+
+def remove_suffix(str_o, suffix):
+    return str_o[: -len(suffix)] if str_o.endswith(suffix) else str_o
+
+
+def synthetic_bundle(apps, prefix="app"):
+    return {
+        "description": f"Synthetic bundle of {apps} applications",
+        "series": "jammy",
+        "applications": {f"{prefix}-{i}": {"charm": f"{prefix}-charm-{i}", "num_units": 1} for i in range(apps)},
+    }
+
+
+class Charmhub(StandInServer):
+    """
+    Charmhub info and download stand-in.
+
+    Every charm has a file resource and a snap resource, the bundles are registered by name.
+    @param charm_size: bytes of padding within each charm archive
+    @param resource_size: bytes of each file resource
+    """
+
+    INFO = re.compile(r"^/v2/charms/info/(?P<name>[^/]+)$")
+
+    def __init__(self, bundles=None, charm_size=1 << 16, resource_size=1 << 20, **kwargs):
+        super().__init__(**kwargs)
+        self.bundles = bundles or {}
+        self.charm_size = charm_size
+        self.resource_size = resource_size
+        self._charms = {}
+
+    def _charm(self, name):
+        if name not in self._charms:
+            data = io.BytesIO()
+            with zipfile.ZipFile(data, "w") as charm:
+                if name in self.bundles:
+                    charm.writestr("bundle.yaml", yaml.safe_dump(self.bundles[name]))
+                else:
+                    charm.writestr("metadata.yaml", yaml.safe_dump({"name": name, "resources": self._resources(name)}))
+                    charm.writestr("config.yaml", yaml.safe_dump({"options": {"channel": {"default": "stable"}}}))
+                    charm.writestr("payload.bin", payload(self.charm_size, name))
+            self._charms[name] = data.getvalue()
+        return self._charms[name]
+
+    @staticmethod
+    def _resources(name):
+        return {
+            "data": {"type": "file", "filename": "data.tar.gz"},
+            "tool": {"type": "file", "filename": "tool.snap"},
+        }
+
+    def get(self, path, query):
+        match = self.INFO.match(path)
+        if match:
+            name = match.group("name")
+            resources = [
+                {
+                    "name": resource,
+                    "type": meta["type"],
+                    "filename": meta["filename"],
+                    "revision": 1,
+                    "download": {"url": f"{self.url}/resources/{name}.{resource}_1"},
+                }
+                for resource, meta in ({} if name in self.bundles else self._resources(name)).items()
+            ]
+            info = {
+                "default-release": {
+                    "revision": {"revision": 1, "download": {"url": f"{self.url}/download/{name}_1.charm"}},
+                    "resources": resources,
+                }
+            }
+            return 200, json.dumps(info).encode(), {"Content-Type": "application/json"}
+        if path.startswith("/download/"):
+            return 200, self._charm(remove_suffix(path[len("/download/") :], "_1.charm")), {}
+        if path.startswith("/resources/"):
+            return 200, payload(self.resource_size, path), {}
+        return super().get(path, query)
+
+
+class GitHub(StandInServer):
+    """GitHub contents API stand-in serving the overlays and container-images folders."""
+
+    def __init__(self, overlays=None, images=None, release="1.30.0", **kwargs):
+        super().__init__(**kwargs)
+        self.overlays = overlays or {}
+        self.images = images or []
+        self.release = release
+
+    def _listing(self, folder, names):
+        listing = [{"name": name, "download_url": f"{self.url}/raw/{folder}/{name}"} for name in names]
+        return 200, json.dumps(listing).encode(), {"Content-Type": "application/json"}
+
+    def get(self, path, query):
+        if path == "/overlays":
+            return self._listing("overlays", self.overlays)
+        if path == "/container-images":
+            return self._listing("container-images", ["README.md", f"v{self.release}.txt"])
+        if path.startswith("/raw/overlays/"):
+            return 200, yaml.safe_dump(self.overlays[path.rsplit("/", 1)[1]]).encode(), {}
+        if path.startswith("/raw/container-images/"):
+            return 200, "\n".join(self.images).encode(), {}
+        return super().get(path, query)
+
+
+class RegistryHandler(StandInHandler):
+    UPLOADS = re.compile(r"^/v2/(?P<repo>.+)/blobs/uploads/(?P<upload>[^/]*)$")
+    BLOBS = re.compile(r"^/v2/(?P<repo>.+)/blobs/(?P<digest>sha256:[0-9a-f]+)$")
+    MANIFESTS = re.compile(r"^/v2/(?P<repo>.+)/manifests/(?P<reference>[^/]+)$")
+
+    def _route(self):
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        for kind, pattern in [("uploads", self.UPLOADS), ("blobs", self.BLOBS), ("manifests", self.MANIFESTS)]:
+            match = pattern.match(url.path)
+            if match:
+                self.server.requests[self.command, kind] += 1
+                return kind, match.groupdict(), query
+        return None, {}, query
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        kind, params, _ = self._route()
+        registry = self.server
+        if kind == "blobs" and (params["repo"], params["digest"]) in registry.blobs:
+            return self._reply(200, registry.blobs[params["repo"], params["digest"]])
+        if kind == "manifests" and (params["repo"], params["reference"]) in registry.manifests:
+            media_type, body = registry.manifests[params["repo"], params["reference"]]
+            return self._reply(200, body, {"Content-Type": media_type})
+        self._reply(404)
+
+    def do_POST(self):
+        kind, params, query = self._route()
+        registry = self.server
+        if kind != "uploads":
+            return self._reply(404)
+        repo, digest = params["repo"], query.get("mount")
+        if digest and registry.mounts and (query.get("from"), digest) in registry.blobs:
+            registry.blobs[repo, digest] = registry.blobs[query["from"], digest]
+            return self._reply(201, headers={"Location": f"/v2/{repo}/blobs/{digest}"})
+        upload = uuid.uuid4().hex
+        registry.uploads.add(upload)
+        self._reply(202, headers={"Location": f"/v2/{repo}/blobs/uploads/{upload}?_state=started"})
+
+    def do_DELETE(self):
+        kind, params, _ = self._route()
+        if kind == "uploads" and params["upload"] in self.server.uploads:
+            self.server.uploads.discard(params["upload"])
+            return self._reply(204)
+        self._reply(404)
+
+    def do_PUT(self):
+        kind, params, query = self._route()
+        registry = self.server
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with registry.lock:
+            registry.bytes_received += len(body)
+        digest = f"sha256:{hashlib.sha256(body).hexdigest()}"
+        if kind == "uploads":
+            if query.get("digest") != digest or params["upload"] not in registry.uploads:
+                return self._reply(400)
+            registry.uploads.discard(params["upload"])
+            registry.blobs[params["repo"], digest] = body
+            return self._reply(201, headers={"Location": f"/v2/{params['repo']}/blobs/{digest}"})
+        if kind == "manifests":
+            manifest = json.loads(body)
+            referenced = [manifest["config"]] + manifest["layers"] if "layers" in manifest else manifest["manifests"]
+            for descriptor in referenced:
+                known = registry.blobs if "layers" in manifest else registry.manifests
+                if (params["repo"], descriptor["digest"]) not in known:
+                    return self._reply(400)
+            stored = self.headers["Content-Type"], body
+            registry.manifests[params["repo"], params["reference"]] = stored
+            registry.manifests[params["repo"], digest] = stored
+            return self._reply(201)
+        self._reply(404)
+
+
+class Registry(StandInServer):
+    """
+    Registry v2 API stand-in storing blobs and manifests in memory.
+
+    @param mounts: False to decline every cross repository mount, starting an upload session instead
+    """
+
+    def __init__(self, mounts=True, **kwargs):
+        super().__init__(RegistryHandler, **kwargs)
+        self.mounts = mounts
+        self.uploads = set()
+        self.blobs = {}
+        self.manifests = {}
+        self.bytes_received = 0
+
+
+class ObjectStoreHandler(StandInHandler):
+    def _route(self):
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query, keep_blank_values=True).items()}
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.requests[self.command, "parts" if "partNumber" in query else "objects"] += 1
+        signed = (self.headers.get("Authorization") or "").startswith("AWS4-HMAC-SHA256 Credential=")
+        if not signed or self.headers.get("x-amz-content-sha256") != hashlib.sha256(body).hexdigest():
+            return None, query, body
+        return url.path.lstrip("/"), query, body
+
+    def do_GET(self):
+        key, _, _ = self._route()
+        if key in self.server.objects:
+            return self._reply(200, self.server.objects[key])
+        self._reply(404)
+
+    def do_POST(self):
+        key, query, body = self._route()
+        store = self.server
+        if key is None:
+            return self._reply(403)
+        if "uploads" in query:
+            upload = uuid.uuid4().hex
+            store.uploads[upload] = {}
+            result = f"<InitiateMultipartUploadResult><UploadId>{upload}</UploadId></InitiateMultipartUploadResult>"
+            return self._reply(200, result.encode(), {"Content-Type": "application/xml"})
+        parts = store.uploads.pop(query.get("uploadId"), None)
+        if parts is None:
+            return self._reply(404)
+        numbers = [int(part.find("PartNumber").text) for part in ElementTree.fromstring(body)]
+        store.objects[key] = b"".join(parts[number] for number in numbers)
+        return self._reply(200, b"<CompleteMultipartUploadResult/>", {"Content-Type": "application/xml"})
+
+    def do_PUT(self):
+        key, query, body = self._route()
+        store = self.server
+        if key is None:
+            return self._reply(403)
+        if query.get("uploadId") not in store.uploads:
+            return self._reply(404)
+        md5 = hashlib.md5(body)
+        if self.headers.get("Content-MD5") != base64.b64encode(md5.digest()).decode():
+            return self._reply(400)
+        number = int(query["partNumber"])
+        with store.lock:
+            store.bytes_received += len(body)
+            store.uploads[query["uploadId"]][number] = body
+        etag = "0" * 32 if number in store.corrupt_parts or store.encryption else md5.hexdigest()
+        headers = {"ETag": f'"{etag}"'}
+        if store.encryption:
+            headers["x-amz-server-side-encryption"] = store.encryption
+        self._reply(200, headers=headers)
+
+    def do_DELETE(self):
+        _, query, _ = self._route()
+        self.server.uploads.pop(query.get("uploadId"), None)
+        self.server.aborted += 1
+        self._reply(204)
+
+
+class ObjectStore(StandInServer):
+    """
+    S3 multipart upload stand-in, like a local MinIO, storing objects in memory by bucket/key.
+
+    @param corrupt_parts: part numbers answered with the wrong ETag
+    @param encryption: server side encryption of the bucket, e.g. aws:kms, whose ETags aren't md5s
+    """
+
+    def __init__(self, corrupt_parts=(), encryption=None, **kwargs):
+        super().__init__(ObjectStoreHandler, **kwargs)
+        self.objects = {}
+        self.uploads = {}
+        self.corrupt_parts = set(corrupt_parts)
+        self.encryption = encryption
+        self.bytes_received = 0
+        self.aborted = 0
+
+
+def image_layer(content: bytes):
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode="w") as tar:
+        info = tarfile.TarInfo("file")
+        info.size = len(content)
+        tar.addfile(info, io.BytesIO(content))
+    return data.getvalue()
+
+
+def save_image(target, image, layers, architecture="amd64"):
+    """Write an image archive like `docker save | gzip`, from uncompressed layer tarballs."""
+    diff_ids = [f"sha256:{hashlib.sha256(layer).hexdigest()}" for layer in layers]
+    config = json.dumps({"architecture": architecture, "os": "linux", "rootfs": {"diff_ids": diff_ids}}).encode()
+    config_name = f"{hashlib.sha256(config).hexdigest()}.json"
+    members = {f"{diff_id[7:]}/layer.tar": layer for diff_id, layer in zip(diff_ids, layers)}
+    members[config_name] = config
+    members["manifest.json"] = json.dumps(
+        [{"Config": config_name, "RepoTags": [image], "Layers": list(members)[:-1]}]
+    ).encode()
+
+    target.parent.mkdir(parents=True, exist_ok=True)
+    with tarfile.open(target, "w:gz") as tar:
+        for name, content in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    return target
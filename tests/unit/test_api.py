@@ -0,0 +1,90 @@
+from pathlib import Path
+import subprocess
+import sys
+
+from shrinkwrap import ArtifactStore, Progress, ShrinkwrapBuild
+
+import mock
+import pytest
+
+
+def test_import_is_lazy():
+    modules = ["jinja2", "requests", "semver", "yaml"]
+    script = f"import sys, shrinkwrap; print(sorted(set({modules!r}) & set(sys.modules)))"
+    out = subprocess.check_output([sys.executable, "-c", script], cwd=Path(__file__).parents[2], text=True)
+    assert out.strip() == "[]"
+
+
+def test_build_options(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    build = ShrinkwrapBuild(
+        "etcd",
+        channel="1.29/stable",
+        overlays=["calico-overlay.yaml"],
+        arches=["amd64", "arm64"],
+        root=Path(tmpdir) / "etcd",
+        store=Path(tmpdir) / "store",
+        skip_snaps=True,
+        max_disk="40G",
+    )
+    args = build.args
+    assert (args.bundle, args.channel, args.overlay, args.arch) == (
+        "etcd",
+        "1.29/stable",
+        ["calico-overlay.yaml"],
+        ["amd64", "arm64"],
+    )
+    assert args.skip_snaps and args.max_disk == 40 << 30
+    assert isinstance(build.store, ArtifactStore) and build.output == Path(tmpdir) / "etcd.tar.gz"
+
+    # single values are given as strs, as on the command line
+    args = ShrinkwrapBuild("etcd", arches="amd64,arm64", overlays="calico-overlay.yaml", only_apps="etcd,easyrsa").args
+    assert (args.arch, args.overlay, args.only_apps) == (
+        ["amd64", "arm64"],
+        ["calico-overlay.yaml"],
+        ["etcd", "easyrsa"],
+    )
+    assert ShrinkwrapBuild("etcd", image_deny="*-s390x:*").args.image_deny == ["*-s390x:*"]
+
+    with pytest.raises(TypeError, match="skip_everything"):
+        ShrinkwrapBuild("etcd", skip_everything=True)
+
+
+@mock.patch("shrinkwrap.build_offline_bundle")
+@mock.patch("shrinkwrap.fetch_download")
+@mock.patch("shrinkwrap.plan_download")
+def test_build_steps(mock_plan, mock_fetch, mock_offline_bundle, tmpdir):
+    events = []
+    root = Path(tmpdir) / "etcd"
+    root.mkdir()
+
+    def fetch(args, plan, metrics):
+        with metrics.stage("snaps"), metrics.artifact("snap", "snaps/etcd.snap") as record:
+            record["bytes"] = 10
+        return mock.Mock(name="charms")
+
+    mock_fetch.side_effect = fetch
+    build = ShrinkwrapBuild("etcd", root=root, skip_tar_gz=True, progress=events.append)
+    assert build.resolve() is mock_plan.return_value
+    build.download()
+    assert build.package() == root
+    mock_plan.assert_called_once()
+    mock_offline_bundle.assert_called_once()
+    assert [(event.event, event.name) for event in events] == [
+        ("started", "snaps"),
+        ("fetched", "snaps/etcd.snap"),
+        ("finished", "snaps"),
+        ("started", "bundle"),
+        ("finished", "bundle"),
+    ]
+    assert events[1] == Progress("fetched", "snaps/etcd.snap", "snap", events[1].seconds, 10)
+    assert (Path(tmpdir) / "etcd.metrics.json").exists()
+
+
+def test_build_holds_root(tmpdir):
+    root = Path(tmpdir) / "etcd"
+    build = ShrinkwrapBuild("etcd", root=root, skip_tar_gz=True)
+    with pytest.raises(RuntimeError, match="already being built"):
+        ShrinkwrapBuild("etcd", root=root, skip_tar_gz=True, skip_snaps=True)
+    build.close()
+    ShrinkwrapBuild("etcd", root=root, skip_tar_gz=True, skip_snaps=True).close()
@@ -0,0 +1,78 @@
+import json
+from pathlib import Path
+import threading
+
+from shrinkwrap import ArtifactIndex, tree_digest
+
+import mock
+
+
+def test_artifact_index_manifest(tmpdir):
+    root = Path(tmpdir)
+    charm = root / "charms" / "etcd" / "stable"
+    charm.mkdir(parents=True)
+    (charm / "metadata.yaml").write_text("name: etcd")
+    snap = root / "snaps" / "etcd" / "3.4" / "amd64" / "etcd-20220101.tar.gz"
+    snap.parent.mkdir(parents=True)
+    snap.write_bytes(b"snap")
+
+    index = ArtifactIndex(root)
+    assert index.add("charm", charm, app="etcd", name="etcd").path == "charms/etcd/stable"
+    assert index.add("snap", snap, name="etcd", arch="amd64").size == 4
+    assert index.add("resource", root / "resources" / "etcd" / "snapshot" / "missing.tar.gz") is None
+    index.save()
+
+    manifest = json.loads((root / ArtifactIndex.MANIFEST).read_text())
+    assert [entry["kind"] for entry in manifest["artifacts"]] == ["charm", "snap"]
+
+    loaded = ArtifactIndex.load(root)
+    assert list(loaded) == list(index)
+    assert loaded.find("charm", "etcd").digest == tree_digest(charm)
+    assert loaded.of("snap")[0].local_path == "./snaps/etcd/3.4/amd64/etcd-20220101.tar.gz"
+
+    # unchanged artifacts keep their digest rather than reading them again
+    loaded.add("snap", snap, name="etcd", arch="amd64")
+    with mock.patch("shrinkwrap.tree_digest") as digest:
+        loaded.save()
+    digest.assert_not_called()
+
+    snap.unlink()
+    assert ArtifactIndex.load(root).of("snap") == []
+    assert ArtifactIndex.load(root / "snaps") is None
+
+
+def test_artifact_index_scan(tmpdir):
+    root = Path(tmpdir)
+    resource = root / "resources" / "etcd" / "snapshot" / "snapshot.tar.gz"
+    resource.parent.mkdir(parents=True)
+    resource.touch()
+    for arch in ["amd64", "arm64"]:
+        image = root / "containers" / arch / "cdkbot" / "microbot:latest.tar.gz"
+        image.parent.mkdir(parents=True)
+        image.touch()
+
+    index = ArtifactIndex.scan(root, ["amd64", "arm64"])
+    assert index.find("resource", "etcd", "snapshot").local_path == "./resources/etcd/snapshot/snapshot.tar.gz"
+    assert [(image.name, image.arch) for image in index.of("container")] == [
+        ("cdkbot/microbot:latest", "amd64"),
+        ("cdkbot/microbot:latest", "arm64"),
+    ]
+
+
+def test_artifact_index_concurrent_saves(tmpdir):
+    root = Path(tmpdir)
+    (root / "charm").mkdir()
+
+    def save():
+        index = ArtifactIndex(root)
+        index.add("charm", root / "charm", app="etcd", name="etcd")
+        for _ in range(20):
+            index.save()
+
+    threads = [threading.Thread(target=save) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert ArtifactIndex.load(root).find("charm", name="etcd")
+    assert sorted(path.name for path in root.iterdir()) == ["artifacts.json", "charm"]
@@ -0,0 +1,164 @@
+from argparse import Namespace
+import multiprocessing
+from pathlib import Path
+import time
+
+from shrinkwrap import ArtifactStore, ResourceDownloader, Resource, SnapDownloader, batch_targets, main, warm
+
+import mock
+import pytest
+
+
+@pytest.fixture()
+def mock_requests():
+    with mock.patch("shrinkwrap.requests.get") as mr:
+        yield mr
+
+
+def test_artifact_store(tmpdir):
+    store = ArtifactStore(Path(tmpdir) / "store")
+    assert store.key("resources", "https://host/etcd/resource/snapshot/0") == (
+        "resources/https:__host_etcd_resource_snapshot_0"
+    )
+
+    def fetch(path):
+        path.mkdir()
+        (path / "metadata.yaml").write_text("name: etcd")
+
+    fetch = mock.MagicMock(side_effect=fetch)
+    first, second = Path(tmpdir) / "first" / "etcd", Path(tmpdir) / "second" / "etcd"
+    assert store.provide("charms/etcd_1.charm", first, fetch) == first
+    assert store.provide("charms/etcd_1.charm", second, fetch) == second
+    fetch.assert_called_once_with(store.path / "charms" / "etcd_1.charm.partial")
+    assert (second / "metadata.yaml").read_text() == "name: etcd"
+    assert (second / "metadata.yaml").stat().st_ino == (
+        store.path / "charms" / "etcd_1.charm" / "metadata.yaml"
+    ).stat().st_ino
+
+    resolve = mock.MagicMock(return_value={"name": "etcd"})
+    assert store.memo(("charmhub", "etcd"), resolve) == store.memo(("charmhub", "etcd"), resolve)
+    resolve.assert_called_once_with()
+
+
+def test_store_resource_downloads(tmpdir):
+    store = ArtifactStore(Path(tmpdir) / "store")
+    resource = Resource("snapshot", "file", "snapshot.tar.gz", 0, "https://host/etcd/resource/snapshot/{revision}")
+
+    def wget(cmd):
+        Path(cmd[-1]).write_text("snapshot")
+
+    with mock.patch("shrinkwrap.check_call", side_effect=wget) as mock_wget:
+        for root in ["first", "second"]:
+            downloader = ResourceDownloader(Path(tmpdir) / root, store=store)
+            target = downloader.mark_download("etcd", "etcd", resource)
+            downloader.download()
+            assert target.read_text() == "snapshot"
+    mock_wget.assert_called_once()
+
+
+def test_snap_revision(tmpdir, mock_requests):
+    downloader = SnapDownloader(tmpdir)
+    mock_requests.return_value.json.return_value = {
+        "channel-map": [
+            {"channel": {"track": "latest", "risk": "stable", "architecture": "amd64"}, "revision": 10},
+            {"channel": {"track": "latest", "risk": "stable", "architecture": "arm64"}, "revision": 11},
+            {"channel": {"track": "1.28", "risk": "stable", "architecture": "arm64"}, "revision": 12},
+        ]
+    }
+    assert downloader.revision("kubectl", "stable", "arm64") == 11
+    assert downloader.revision("kubectl", "latest/stable", "amd64") == 10
+    assert downloader.revision("kubectl", "1.28/stable", "arm64") == 12
+    assert downloader.revision("kubectl", "1.28/edge", "arm64") is None
+
+
+def test_batch_targets(tmpdir):
+    batch = Path(tmpdir) / "targets.yaml"
+    batch.write_text(
+        "- bundle: charmed-kubernetes\n"
+        "  channel: 1.28/stable\n"
+        "  overlay: calico-overlay.yaml\n"
+        "- bundle: charmed-kubernetes\n"
+        "  channel: 1.30/edge\n"
+        "  arch: amd64,arm64\n"
+    )
+    args = Namespace(bundle=None, channel=None, overlay=[], arch=["s390x"], batch=str(batch), skip_snaps=True)
+    first, second = batch_targets(args)
+    assert (first.bundle, first.channel, first.overlay, first.arch) == (
+        "charmed-kubernetes",
+        "1.28/stable",
+        ["calico-overlay.yaml"],
+        ["s390x"],
+    )
+    assert (second.channel, second.overlay, second.arch) == ("1.30/edge", [], ["amd64", "arm64"])
+    assert first.skip_snaps and second.batch is None
+
+
+def test_batch_roots(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    Path("targets.yaml").write_text(
+        "- {bundle: charmed-kubernetes, channel: 1.29/stable}\n"
+        "- {bundle: charmed-kubernetes, channel: 1.29/stable, overlay: calico-overlay.yaml}\n"
+    )
+    monkeypatch.setattr("sys.argv", ["shrinkwrap.py", "--batch", "targets.yaml"])
+    with mock.patch("shrinkwrap.build") as mock_build, mock.patch("shrinkwrap.METADATA"):
+        main()
+    # targets started within the same second don't share a root
+    roots = [call.args[2] for call in mock_build.call_args_list]
+    assert len(set(roots)) == 2 and roots[1].name.endswith("-target2")
+
+
+def test_warm_store(tmpdir, capsys):
+    targets = Path(tmpdir) / "targets.yaml"
+    targets.write_text("- {bundle: charmed-kubernetes, channel: 1.29/stable}\n- {bundle: missing}\n")
+    store_path = Path(tmpdir) / "store"
+
+    def download(args, root, store, metrics, save_index=True):
+        assert root.parent == store.path and args.skip_snaps and args.skip_tar_gz and not save_index
+        if args.bundle == "missing":
+            raise AssertionError("no bundle")
+        with metrics.artifact("charm", "charms/etcd_1.charm") as record:
+            record["bytes"] = 10
+        with metrics.artifact("charm", "charms/easyrsa_1.charm"):
+            pass
+
+    with mock.patch("shrinkwrap.download", side_effect=download) as mock_download:
+        warm(["--once", "--skip-snaps", "--store", str(store_path), str(targets)])
+    assert mock_download.call_count == 2
+    out = capsys.readouterr().out
+    assert "Stored 1 new artifacts, 10 bytes" in out
+    assert "Failed warming missing: AssertionError: no bundle" in out
+    assert list(store_path.iterdir()) == []
+
+
+def _wget_slowly(cmd):
+    # count the fetches across processes, and give the other build time to race this one
+    with (Path(cmd[-1]).parent / "fetches").open("a") as fp:
+        fp.write("wget\n")
+    time.sleep(0.2)
+    Path(cmd[-1]).write_text("snapshot")
+
+
+def _build_resource(root, store_path, resource):
+    downloader = ResourceDownloader(root, store=ArtifactStore(store_path))
+    downloader.mark_download("etcd", "etcd", resource)
+    downloader.download()
+
+
+def test_concurrent_builds_share_downloads(tmpdir):
+    tmp = Path(tmpdir)
+    resource = Resource("snapshot", "file", "snapshot.tar.gz", 0, "https://host/etcd/resource/snapshot/{revision}")
+    fork = multiprocessing.get_context("fork")
+    with mock.patch("shrinkwrap.check_call", side_effect=_wget_slowly):
+        # two builds of one root, and a third build of another root, all sharing the store
+        builds = [
+            fork.Process(target=_build_resource, args=(tmp / root, tmp / "store", resource))
+            for root in ["shared", "shared", "other"]
+        ]
+        for build in builds:
+            build.start()
+        for build in builds:
+            build.join(30)
+    assert [build.exitcode for build in builds] == [0, 0, 0]
+    assert (tmp / "store" / "resources" / "fetches").read_text() == "wget\n"
+    for root in ["shared", "other"]:
+        assert (tmp / root / "resources" / "etcd" / "snapshot" / "snapshot.tar.gz").read_text() == "snapshot"
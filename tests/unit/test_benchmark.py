@@ -0,0 +1,29 @@
+import json
+
+from tests.benchmark import bench
+
+import shrinkwrap
+
+
+def test_benchmark_scenario(tmpdir):
+    ch_url = shrinkwrap.StoreDownloader.CH_URL
+    result = bench.run_scenario(
+        dict(apps=2, latency=0.0, bandwidth=None, charm_size=1024, resource_size=1024, images=1, layer_size=1024)
+    )
+    assert shrinkwrap.StoreDownloader.CH_URL == ch_url, "stand-in urls are restored"
+    assert set(result["phases"]) == {"download", "bundle", "archive", "push-images"}
+    assert result["downloaded_bytes"] > 3 * 1024, "bundle, charms and resources are downloaded"
+    assert result["pushed_bytes"] > 0
+    assert set(result["stages"]) >= {"resolve", "charms", "resources"}
+
+
+def test_benchmark_compare(tmpdir, capsys):
+    results = tmpdir / "results.jsonl"
+    scenario = {"apps": 5, "seconds": 2.0, "download_bytes_per_second": 100, "push_bytes_per_second": 10}
+    with open(results, "w") as fp:
+        fp.write(json.dumps({"commit": "abc", "scenarios": [dict(scenario, peak_rss_kib=1000)]}) + "\n")
+        fp.write(json.dumps({"commit": "def", "scenarios": [dict(scenario, seconds=1.0, peak_rss_kib=900)]}) + "\n")
+    bench.main(["--compare", "--results", str(results)])
+    out = capsys.readouterr().out
+    assert "abc -> def" in out
+    assert "-50.0%" in out
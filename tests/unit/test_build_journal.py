@@ -0,0 +1,102 @@
+import json
+from pathlib import Path
+
+from shrinkwrap import BuildJournal, ResourceDownloader, Resource, build, get_args, tree_digest
+
+import mock
+
+
+def test_build_journal_replay(tmpdir):
+    path = Path(tmpdir) / "build.journal"
+    artifact = Path(tmpdir) / "artifact"
+    artifact.write_bytes(b"content")
+
+    journal = BuildJournal(path, {"bundle": "etcd"})
+    assert not journal.resumed
+    assert journal.memo(["charmhub", "etcd"], lambda: {"revision": 1}) == {"revision": 1}
+    journal.artifact(artifact)
+    journal.record("download")
+    with path.open("a") as fp:
+        fp.write('{"step": "bun')  # interrupted mid write
+
+    resumed = BuildJournal(path, {"bundle": "etcd"})
+    assert resumed.resumed and resumed.done("download") and not resumed.done("bundle")
+    assert resumed.memo(["charmhub", "etcd"], mock.Mock(side_effect=AssertionError)) == {"revision": 1}
+    assert resumed.completed(artifact)
+    assert resumed.digest(artifact) == tree_digest(artifact)
+    artifact.write_bytes(b"changed")
+    assert resumed.digest(artifact) is None
+
+    # the journal of a different build is started again
+    other = BuildJournal(path, {"bundle": "kubernetes-core"})
+    assert not other.resumed and not other.done("download")
+    assert [json.loads(line)["step"] for line in path.read_text().splitlines()] == ["start"]
+
+
+@mock.patch("shrinkwrap.check_call")
+def test_resume_fetches_incomplete_artifacts(mock_check_call, tmpdir):
+    root = Path(tmpdir)
+    complete = Resource("snapshot", "file", "snapshot.tar.gz", 0, "https://example.com/snapshot/{revision}")
+    partial = Resource("config", "file", "config.tar.gz", 0, "https://example.com/config/{revision}")
+    journal = BuildJournal(root.parent / "root.journal", {})
+    downloader = ResourceDownloader(root, journal=journal)
+    targets = [downloader.mark_download("etcd", "etcd", resource) for resource in (complete, partial)]
+    for target in targets:
+        target.parent.mkdir(parents=True)
+        target.write_bytes(b"tarball")
+    journal.artifact(targets[0])
+
+    # interrupted while the second resource was downloading
+    downloader = ResourceDownloader(root, journal=BuildJournal(root.parent / "root.journal", {}))
+    for resource in (complete, partial):
+        downloader.mark_download("etcd", "etcd", resource)
+    mock_check_call.side_effect = lambda cmd: Path(cmd[-1]).write_bytes(b"tarball")
+    downloader.download()
+    mock_check_call.assert_called_once_with(["wget", "--quiet", "https://example.com/config/0", "-O", str(targets[1])])
+    assert BuildJournal(root.parent / "root.journal", {}).completed(targets[1])
+
+
+@mock.patch("shrinkwrap.build_offline_bundle")
+@mock.patch("shrinkwrap.bundle_downloader")
+@mock.patch("shrinkwrap.fetch_download")
+@mock.patch("shrinkwrap.plan_download")
+def test_build_resumes_steps(
+    mock_plan, mock_download, mock_bundle_downloader, mock_offline_bundle, tmpdir, monkeypatch
+):
+    monkeypatch.chdir(tmpdir)
+    root = Path("build") / "etcd"
+    root.mkdir(parents=True)
+    args = get_args(["etcd", "--use_path", str(root), "--skip-tar-gz"])
+
+    mock_offline_bundle.side_effect = KeyboardInterrupt
+    try:
+        build(args)
+    except KeyboardInterrupt:
+        pass
+    mock_plan.assert_called_once()
+    mock_download.assert_called_once()
+
+    # the restarted build picks up after the completed download
+    mock_offline_bundle.side_effect = None
+    assert build(args) == root
+    mock_download.assert_called_once()
+    mock_bundle_downloader.assert_called_once()
+    assert mock_offline_bundle.call_count == 2
+
+    # a completed build isn't built again
+    assert build(args) == root
+    assert mock_offline_bundle.call_count == 2
+
+    # the folder of a --skip-tar-gz build is archived by a later run
+    with mock.patch("shrinkwrap.check_call") as mock_tar, mock.patch("shrinkwrap.shutil.rmtree"):
+        assert build(get_args(["etcd", "--use_path", str(root)])) == Path("build/etcd.tar.gz")
+        assert build(get_args(["etcd", "--use_path", str(root)])) == Path("build/etcd.tar.gz")
+    mock_tar.assert_called_once()
+    assert mock_offline_bundle.call_count == 2
+
+    # a build of other arguments starts over, keeping the first build's journal
+    build(get_args(["etcd", "--use_path", str(root), "--skip-tar-gz", "--skip-snaps"]))
+    assert mock_download.call_count == 2
+    assert len(list(root.parent.glob("etcd.*.journal"))) == 2
+    assert build(args) == root
+    assert mock_download.call_count == 2
@@ -1,7 +1,7 @@
 from pathlib import Path
 import yaml
 
-from shrinkwrap import build_offline_bundle, BundleDownloader
+from shrinkwrap import ArtifactIndex, build_offline_bundle, BundleDownloader
 
 import mock
 
@@ -68,3 +68,55 @@ def test_build_offline_bundle(tmpdir, test_bundle):
 
     deploy_sh = root / "deploy.sh"
     assert deploy_sh.exists()
+
+
+def test_build_offline_bundle_multi_arch(tmpdir):
+    root = Path(tmpdir)
+    charms = mock.MagicMock(spec_set=BundleDownloader)
+    charms.bundles = {"bundle.yaml": {"applications": {"kubernetes-worker": None}}}
+    for arch in ["amd64", "arm64"]:
+        cont_path = root / "containers" / arch / "pause:3.2.tar.gz"
+        cont_path.parent.mkdir(parents=True)
+        cont_path.touch()
+
+    build_offline_bundle(root, charms, ["amd64", "arm64"])
+
+    text = (root / "push_container_images.sh").read_text()
+    assert text.count("docker load") == 2
+    assert "docker load < ./containers/arm64/pause:3.2.tar.gz" in text
+    assert "docker image push $DOCKER_REGISTRY/cdk/pause:3.2-arm64" in text
+    assert (
+        "docker manifest create --amend $DOCKER_REGISTRY/cdk/pause:3.2 "
+        "$DOCKER_REGISTRY/cdk/pause:3.2-amd64 $DOCKER_REGISTRY/cdk/pause:3.2-arm64"
+    ) in text
+
+
+def test_build_offline_bundle_from_index(tmpdir):
+    root = Path(tmpdir)
+    charms = mock.MagicMock(spec_set=BundleDownloader)
+    charms.bundles = {"bundle.yaml": {"applications": {"etcd": {"charm": "etcd", "resources": {"snapshot": 0}}}}}
+    charm = root / "charms" / "etcd" / "stable.charm"
+    snap = root / "snaps" / "etcd" / "etcd.tar.gz"
+    resource = root / "resources" / "etcd" / "snapshot" / "snapshot.tar.gz"
+    for path in [charm, snap, resource]:
+        path.parent.mkdir(parents=True)
+        path.touch()
+
+    # only indexed artifacts are written into the offline bundle
+    (root / "snaps" / "etcd" / "stale.tar.gz").touch()
+    index = ArtifactIndex(root)
+    index.add("charm", charm, app="etcd", name="etcd")
+    index.add("snap", snap, name="etcd")
+    index.add("resource", resource, app="etcd", name="snapshot", revision=0)
+    index.save()
+
+    build_offline_bundle(root, charms)
+
+    created_yaml = yaml.safe_load((root / "bundle.yaml").read_text())
+    assert created_yaml["applications"]["etcd"] == {
+        "charm": "./charms/etcd/stable.charm",
+        "resources": {"snapshot": "./resources/etcd/snapshot/snapshot.tar.gz"},
+    }
+    text = (root / "push_snaps.sh").read_text()
+    assert "./snaps/etcd/etcd.tar.gz" in text
+    assert "stale.tar.gz" not in text
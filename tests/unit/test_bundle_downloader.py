@@ -1,7 +1,8 @@
 from io import BytesIO
 from pathlib import Path
+import zipfile
 
-from shrinkwrap import BundleDownloader
+from shrinkwrap import METADATA, BundleDownloader, charm_snap_channel, build_offline_bundle
 
 import mock
 import pytest
@@ -51,9 +52,10 @@ def test_charmhub_downloader(mock_zipfile, mock_get, tmpdir):
     expected_gets = [
         mock.call(
             "https://api.charmhub.io/v2/charms/info/kubernetes-unit-test",
+            timeout=METADATA.timeout,
             params=dict(channel=args.channel, fields="default-release.revision.download.url"),
         ),
-        mock.call(bundle_mock_url),
+        mock.call(bundle_mock_url, timeout=METADATA.timeout),
     ]
     mock_get.assert_has_calls(expected_gets)
     mock_zipfile.assert_called_once()
@@ -73,7 +75,9 @@ def test_charmstore_downloader(mock_zipfile, mock_get, tmpdir):
     result = downloader.bundle_download()
     assert result == tmpdir / "charms" / ".bundle" / "bundle.yaml"
     mock_get.assert_called_once_with(
-        "https://api.jujucharms.com/charmstore/v5/kubernetes-unit-test/archive", params={"channel": args.channel}
+        "https://api.jujucharms.com/charmstore/v5/kubernetes-unit-test/archive",
+        timeout=METADATA.timeout,
+        params={"channel": args.channel},
     )
     mock_zipfile.assert_called_once()
     assert isinstance(mock_zipfile.call_args.args[0], BytesIO)
@@ -140,3 +144,55 @@ def test_bundle_downloader_properties(tmpdir, test_bundle, test_overlay, mock_ov
         "kubernetes-worker",
         "openstack-integrator",
     }
+
+
+def test_bundle_downloader_selected_apps(tmpdir, test_bundle, test_overlay, mock_overlay_list):
+    args = mock.MagicMock()
+    args.overlay = ["test-overlay.yaml"]
+    downloader = BundleDownloader(tmpdir, args, only_apps=["etcd", "easyrsa", "calico"])
+    with test_bundle.file.open() as fp:
+        (downloader.bundle_path / "bundle.yaml").write_text(fp.read())
+    with test_overlay.open() as fp:
+        (downloader.bundle_path / "test-overlay.yaml").write_text(fp.read())
+
+    assert downloader.applications.keys() == {"calico", "easyrsa", "etcd"}
+    relations = downloader.bundles["bundle.yaml"]["relations"]
+    assert relations and all({endpoint.split(":")[0] for endpoint in rel} <= {"easyrsa", "etcd"} for rel in relations)
+
+    downloader = BundleDownloader(tmpdir, args, exclude_apps=["calico", "flannel"])
+    assert "calico" not in downloader.applications and "etcd" in downloader.applications
+
+    with pytest.raises(AssertionError, match="vault aren't applications"):
+        BundleDownloader(tmpdir, args, only_apps=["vault"]).bundles
+
+
+@mock.patch("shrinkwrap.requests.get")
+def test_packed_charm_downloader(mock_get, tmpdir, test_charm_config):
+    args = mock.MagicMock()
+    args.overlay = []
+    charm = BytesIO()
+    with zipfile.ZipFile(charm, "w") as zf:
+        zf.writestr("config.yaml", test_charm_config.read_text())
+        zf.writestr("metadata.yaml", "name: etcd\nresources:\n  snapshot:\n    type: file\n")
+
+    def mock_get_response(url, **_kwargs):
+        response = mock.MagicMock()
+        if "info" in url:
+            response.json.return_value = {"default-release": {"revision": {"download": {"url": "etcd_1.charm"}}}}
+        else:
+            response.content = charm.getvalue()
+        return response
+
+    mock_get.side_effect = mock_get_response
+    downloader = BundleDownloader(tmpdir, args, packed=True)
+    app = {"charm": "etcd", "channel": "latest/edge"}
+    charm_name, charm_path = downloader.app_download("etcd", app)
+    assert charm_path == Path(tmpdir) / "charms" / "etcd" / "latest" / "edge.charm"
+    assert charm_path.read_bytes() == charm.getvalue()
+    assert not (Path(tmpdir) / "charms" / "etcd" / "latest" / "edge").exists(), "charm isn't extracted"
+    assert charm_snap_channel(app, charm_path) == "stable", "auto channel read from the packed config.yaml"
+
+    downloader._cached_bundles["bundle.yaml"] = {"applications": {"etcd": app}}
+    build_offline_bundle(Path(tmpdir), downloader)
+    assert app["charm"] == "./charms/etcd/latest/edge.charm"
+    assert app["resources"] == {"snapshot": {"type": "file"}}, "resources read from the packed metadata.yaml"
@@ -1,6 +1,8 @@
+from argparse import Namespace
 from pathlib import Path
+from subprocess import CalledProcessError
 
-from shrinkwrap import ContainerDownloader
+from shrinkwrap import ContainerDownloader, ImageFilter
 
 import mock
 import pytest
@@ -14,7 +16,8 @@ def mock_requests():
 
 @pytest.fixture()
 def mock_docker_cmd():
-    with mock.patch("shrinkwrap.Popen"):
+    with mock.patch("shrinkwrap.Popen") as popen, mock.patch("platform.machine", return_value="x86_64"):
+        popen.return_value.returncode = 0
         with mock.patch("shrinkwrap.check_call") as ck:
             yield ck
 
@@ -67,13 +70,15 @@ def test_container_downloader(tmpdir, test_container_listing, mock_requests, moc
     downloader.download(channel)
     mock_docker_cmd.assert_has_calls(
         [
-            mock.call("docker pull -q rocks.canonical.com/cdk/cdkbot/microbot-amd64:latest".split()),
-            mock.call("docker pull -q rocks.canonical.com/cdk/k8s-dns-sidecar:1.14.13".split()),
             mock.call(
-                "docker pull -q rocks.canonical.com/cdk/kubernetes-ingress-controller/nginx-ingress-controller-amd64:0.30.0".split()  # noqa: 501
+                "docker pull -q --platform linux/amd64 rocks.canonical.com/cdk/cdkbot/microbot-amd64:latest".split()
             ),
             mock.call("docker rmi rocks.canonical.com/cdk/cdkbot/microbot-amd64:latest".split()),
+            mock.call("docker pull -q --platform linux/amd64 rocks.canonical.com/cdk/k8s-dns-sidecar:1.14.13".split()),
             mock.call("docker rmi rocks.canonical.com/cdk/k8s-dns-sidecar:1.14.13".split()),
+            mock.call(
+                "docker pull -q --platform linux/amd64 rocks.canonical.com/cdk/kubernetes-ingress-controller/nginx-ingress-controller-amd64:0.30.0".split()  # noqa: 501
+            ),
             mock.call(
                 "docker rmi rocks.canonical.com/cdk/kubernetes-ingress-controller/nginx-ingress-controller-amd64:0.30.0".split()  # noqa: 501
             ),
@@ -83,3 +88,57 @@ def test_container_downloader(tmpdir, test_container_listing, mock_requests, moc
     assert (downloader.path / "cdkbot" / "microbot-amd64:latest.tar.gz").exists()
     assert (downloader.path / "k8s-dns-sidecar:1.14.13.tar.gz").exists()
     assert (downloader.path / "kubernetes-ingress-controller" / "nginx-ingress-controller-amd64:0.30.0.tar.gz").exists()
+
+
+def test_container_downloader_multi_arch(tmpdir, test_container_listing, mock_requests, mock_docker_cmd):
+    downloader = ContainerDownloader(tmpdir, ["amd64", "ppc64el"])
+    assert downloader.multi_arch
+    mock_requests.return_value.json.return_value = [
+        {
+            "name": "v1.18.17.txt",
+            "download_url": "https://raw.githubusercontent.com/charmed-kubernetes/bundle/main/container-images/v1.18.17.txt",  # noqa: 501
+        },
+    ]
+    mock_requests.return_value.text = "k8s-dns-sidecar:1.14.13\n"
+    downloader.download("1.18/stable")
+    mock_docker_cmd.assert_has_calls(
+        [
+            mock.call("docker pull -q --platform linux/amd64 rocks.canonical.com/cdk/k8s-dns-sidecar:1.14.13".split()),
+            mock.call("docker rmi rocks.canonical.com/cdk/k8s-dns-sidecar:1.14.13".split()),
+            mock.call(
+                "docker pull -q --platform linux/ppc64le rocks.canonical.com/cdk/k8s-dns-sidecar:1.14.13".split()
+            ),
+            mock.call("docker rmi rocks.canonical.com/cdk/k8s-dns-sidecar:1.14.13".split()),
+        ]
+    )
+    assert (downloader.path / "amd64" / "k8s-dns-sidecar:1.14.13.tar.gz").exists()
+    assert (downloader.path / "ppc64el" / "k8s-dns-sidecar:1.14.13.tar.gz").exists()
+
+
+def test_image_filter(tmpdir, mock_requests):
+    image_map = Path(tmpdir) / "images.yaml"
+    image_map.write_text("ceph-csi: ['cephcsi/*', 'csi-*']\nkubernetes-worker: ['cdkbot/microbot-*']\n")
+    applications = {"kubernetes-worker": {"charm": "ch:kubernetes-worker"}, "csi": None}
+    args = Namespace(image_allow=None, image_deny=["*-s390x:*"], image_map=str(image_map))
+    image_filter = ImageFilter.from_args(args, applications)
+    assert image_filter("cdkbot/microbot-amd64:latest")
+    assert not image_filter("cdkbot/microbot-s390x:latest")
+    assert not image_filter("cephcsi/cephcsi:v3.3.1")
+    assert image_filter("pause:3.2"), "images which aren't mapped are always pulled"
+    assert ImageFilter.from_args(Namespace(image_allow=None, image_deny=None, image_map=None), applications) is None
+
+    downloader = ContainerDownloader(tmpdir, image_filter=ImageFilter(["pause:*"], [], {}, set()))
+    mock_requests.return_value.json.return_value = [{"name": "v1.18.17.txt", "download_url": "https://listing"}]
+    mock_requests.return_value.text = "rocks.canonical.com/cdk/pause:3.2\ncoredns/coredns:1.6.7\n"
+    assert downloader.images("1.18/stable") == ["rocks.canonical.com/cdk/pause:3.2"]
+
+
+def test_failed_image_save(tmpdir, mock_docker_cmd):
+    downloader = ContainerDownloader(tmpdir)
+    with mock.patch("shrinkwrap.Popen") as popen:
+        popen.return_value.returncode = 1
+        popen.return_value.args = ["docker", "save", "rocks.canonical.com/cdk/pause:3.6"]
+        with pytest.raises(CalledProcessError):
+            downloader._image_save("pause:3.6")
+    # the truncated archive isn't kept
+    assert not downloader.image_target("pause:3.6").exists()
@@ -0,0 +1,151 @@
+import argparse
+import hashlib
+import json
+from pathlib import Path
+import tarfile
+import threading
+
+from shrinkwrap import (
+    ArtifactIndex,
+    ContainerDownloader,
+    DiskBudget,
+    SnapDownloader,
+    StreamingPackager,
+    disk_size,
+)
+
+import mock
+import pytest
+
+
+def test_disk_size():
+    assert disk_size("1024") == 1024
+    assert disk_size("512M") == 512 << 20
+    assert disk_size("40GiB") == 40 << 30
+    assert disk_size("1.5t") == 3 << 39
+    with pytest.raises(argparse.ArgumentTypeError):
+        disk_size("lots")
+
+
+def test_disk_budget_check():
+    budget = DiskBudget(120)
+    # an image's staging in docker comes on top of every artifact's size
+    assert budget.check(10, [(20, 20), (30, 90)]) == 10 + 50 + 60
+    with pytest.raises(AssertionError, match="more than the --max-disk budget"):
+        DiskBudget(100).check(10, [(20, 20), (30, 91)])
+
+    # a packed artifact is briefly in the root and the tarball
+    with pytest.raises(AssertionError):
+        DiskBudget(100, packager=mock.Mock()).check(50, [(30, 30)])
+
+
+def test_disk_budget_admit(tmpdir):
+    budget = DiskBudget(100)
+    first, second = Path(tmpdir) / "first", Path(tmpdir) / "second"
+    admitted = threading.Event()
+
+    def fetch():
+        with budget.admit(60, second):
+            admitted.set()
+            second.write_bytes(b"2" * 40)
+
+    with budget.admit(60, first):
+        thread = threading.Thread(target=fetch)
+        thread.start()
+        # the second transfer waits until the first completes
+        assert not admitted.wait(0.2)
+        first.write_bytes(b"1" * 40)
+    thread.join(5)
+    assert admitted.is_set() and budget.used == 80
+
+    with pytest.raises(AssertionError, match="already used"):
+        with budget.admit(30, first):
+            pass
+
+
+def test_streaming_packager(tmpdir):
+    root = Path(tmpdir) / "build" / "etcd"
+    snap = root / "snaps" / "etcd" / "etcd.tar.gz"
+    snap.parent.mkdir(parents=True)
+    snap.write_bytes(b"snap")
+    charm = root / "charms" / "etcd" / "metadata.yaml"
+    charm.parent.mkdir(parents=True)
+    charm.write_text("name: etcd")
+    output = Path(f"{root}.tar.gz")
+
+    packager = StreamingPackager(root, output)
+    index = ArtifactIndex(root)
+    DiskBudget(1 << 30, packager).attach(index)
+    index.add("charm", charm.parent, app="etcd", name="etcd")
+    index.add("snap", snap, name="etcd")
+    packager.wait()
+    # snaps leave the root once packed, charms are kept for the offline bundle
+    assert not snap.exists() and charm.exists()
+    assert index.find("snap", name="etcd").digest == f"sha256:{hashlib.sha256(b'snap').hexdigest()}"
+
+    index.save()
+    assert json.loads((root / "artifacts.json").read_text())["artifacts"][1]["mtime_ns"] is None
+    packager.close()
+    assert not root.exists()
+    with tarfile.open(output) as tar:
+        assert {"etcd/snaps/etcd/etcd.tar.gz", "etcd/charms/etcd/metadata.yaml", "etcd/artifacts.json"} <= set(
+            tar.getnames()
+        )
+        assert tar.extractfile("etcd/snaps/etcd/etcd.tar.gz").read() == b"snap"
+
+
+@mock.patch("shrinkwrap.requests.get")
+def test_snap_size(mock_get, tmpdir):
+    downloader = SnapDownloader(tmpdir)
+    mock_get.return_value.json.return_value = {
+        "channel-map": [
+            {
+                "channel": {"track": "latest", "risk": "stable", "architecture": "amd64"},
+                "revision": 10,
+                "download": {"size": 4096},
+            },
+        ]
+    }
+    assert downloader.size("kubectl", "stable", "amd64") == 4096
+    assert downloader.size("kubectl", "stable", "arm64") == 0
+    downloader.mark_download("kubectl", "stable", "amd64")
+    assert downloader.estimate() == [(4096, 4096)]
+
+
+@mock.patch("shrinkwrap.check_output")
+def test_image_size(mock_check_output, tmpdir):
+    downloader = ContainerDownloader(tmpdir, ["amd64", "arm64"])
+    mock_check_output.return_value = json.dumps(
+        [
+            {
+                "Descriptor": {"platform": {"architecture": arch}},
+                "SchemaV2Manifest": {"layers": [{"size": size}, {"size": size}]},
+            }
+            for arch, size in [("amd64", 100), ("arm64", 200)]
+        ]
+    )
+    assert downloader.size("pause:3.6", "amd64") == 200
+    assert downloader.size("pause:3.6", "arm64") == 400
+    mock_check_output.assert_called_once_with(
+        ["docker", "manifest", "inspect", "-v", "rocks.canonical.com/cdk/pause:3.6"], text=True
+    )
+
+    with mock.patch.object(downloader, "images", return_value=["pause:3.6"]):
+        assert downloader.estimate("1.28/stable") == [(200, 600), (400, 1200)]
+
+
+def test_packed_image_charged(tmpdir):
+    packager = mock.Mock(**{"add.side_effect": lambda index, artifact: (index.root / artifact.path).unlink()})
+    budget = DiskBudget(1 << 30, packager)
+    downloader = ContainerDownloader(tmpdir, budget=budget)
+    budget.attach(downloader.index)
+
+    def save(image, arch):
+        downloader.image_target(image, arch).parent.mkdir(parents=True, exist_ok=True)
+        downloader.image_target(image, arch).write_bytes(b"image" * 10)
+
+    with mock.patch.object(downloader, "_image_save", side_effect=save), mock.patch.object(downloader, "size"):
+        downloader.size.return_value = 50
+        downloader._image_fetch("pause:3.6")
+    # the archive is charged before the packager removes it from the root
+    assert budget.used == 50 and packager.add.call_count == 1
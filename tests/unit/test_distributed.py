@@ -0,0 +1,121 @@
+from argparse import Namespace
+import multiprocessing
+from pathlib import Path
+
+from shrinkwrap import (
+    ArtifactStore,
+    DownloadPlan,
+    Metrics,
+    Resource,
+    ResourceDownloader,
+    SnapDownloader,
+    StoreDownloader,
+    WorkQueue,
+    distributed_download,
+    run_worker,
+    serve_work,
+    work_items,
+)
+from tests.standins import Charmhub, payload, synthetic_bundle
+
+import mock
+import pytest
+
+
+def test_work_queue():
+    queue = WorkQueue([{"kind": "snap"}, {"kind": "resource"}], lease=0)
+    assert queue.claim() == ("0", {"kind": "snap"})
+    assert queue.claim() == ("1", {"kind": "resource"})
+    assert queue.claim() is None
+    queue.complete("1", "CalledProcessError: wget")
+    # the snap's lease has already expired, so nothing is left to wait for
+    queue.wait()
+    assert queue.errors == {"1": "CalledProcessError: wget"}
+
+    exited = mock.MagicMock(**{"poll.return_value": 1})
+    WorkQueue([{"kind": "snap"}]).wait([exited])
+
+
+def test_work_items(tmpdir):
+    snaps, resources = SnapDownloader(tmpdir), ResourceDownloader(tmpdir)
+    snaps.mark_download("core20", "stable", "arm64")
+    resource = Resource("snapshot", "file", "snapshot.tar.gz", 1, "https://host/etcd/resource/snapshot/{revision}")
+    resources.mark_download("etcd", "etcd", resource)
+    containers = mock.MagicMock(arches=["amd64", "arm64"], **{"images.return_value": ["pause:3.2"]})
+    plan = DownloadPlan(None, snaps, resources, containers, "1.29/stable")
+    args = Namespace(skip_snaps=False, skip_resources=False)
+
+    items = work_items(args, plan)
+    assert items == [
+        {"kind": "snap", "snap": "core20", "channel": "stable", "arch": "arm64"},
+        {"kind": "resource", "app": "etcd", "charm": "etcd", "resource": resource._asdict()},
+        {"kind": "container", "image": "pause:3.2", "arch": "amd64"},
+        {"kind": "container", "image": "pause:3.2", "arch": "arm64"},
+    ]
+    containers.images.assert_called_with("1.29/stable")
+    assert Resource(**items[1]["resource"]) == resource
+
+    # workers fetch the coordinator's architecture, whatever their own
+    snaps.mark_download("kubectl", "stable", None)
+    plan = DownloadPlan(None, snaps, resources, mock.MagicMock(arches=[None], **{"images.return_value": []}), "")
+    with mock.patch("platform.machine", return_value="s390x"):
+        assert work_items(args, plan)[1] == {"kind": "snap", "snap": "kubectl", "channel": "stable", "arch": "s390x"}
+
+
+def _store_item(item, store, root):
+    (store.path / item["name"]).write_text(str(multiprocessing.current_process().pid))
+
+
+def test_distributed_workers(tmpdir):
+    store_path = Path(tmpdir) / "store"
+    store_path.mkdir()
+    queue = WorkQueue([{"kind": "snap", "name": f"snap-{n}"} for n in range(8)] + [{"kind": "bad", "name": ""}])
+    server, url = serve_work(queue, ("127.0.0.1", 0))
+    try:
+        # forked workers share the patched download of each item
+        with mock.patch("shrinkwrap.run_work_item", side_effect=_store_item):
+            fork = multiprocessing.get_context("fork")
+            workers = [fork.Process(target=run_worker, args=(url, store_path)) for _ in range(2)]
+            for process in workers:
+                process.start()
+            for process in workers:
+                process.join(30)
+        queue.wait()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert [process.exitcode for process in workers] == [0, 0]
+    assert sorted(path.name for path in store_path.iterdir()) == [f"snap-{n}" for n in range(8)]
+    assert list(queue.errors) == ["8"]
+
+
+def test_distributed_download(tmpdir):
+    root, store = Path(tmpdir) / "build", ArtifactStore(Path(tmpdir) / "store")
+    args = Namespace(
+        bundle="bench-bundle",
+        channel=None,
+        overlay=[],
+        arch=None,
+        packed_charms=False,
+        only_apps=None,
+        exclude_apps=None,
+        skip_snaps=True,
+        skip_resources=False,
+        skip_containers=True,
+        coordinate="0.0.0.0:0",
+        local_workers=2,
+    )
+    with pytest.raises(ValueError, match="--store"):
+        distributed_download(args, root, None, Metrics())
+
+    charmhub = Charmhub({"bench-bundle": synthetic_bundle(2)}, charm_size=1024, resource_size=1024)
+    with charmhub, mock.patch.object(StoreDownloader, "CH_URL", f"{charmhub.url}/v2"):
+        # the local workers reach the coordinator over loopback and fetch every resource into the store
+        with mock.patch("shrinkwrap.check_call", side_effect=AssertionError("fetched by the coordinator")):
+            distributed_download(args, root, store, Metrics())
+
+    assert charmhub.requests["GET", "resources"] == 2, "each file resource is downloaded once"
+    for n in range(2):
+        data = root / "resources" / f"app-{n}" / "data" / "data.tar.gz"
+        assert data.read_bytes() == payload(1024, f"/resources/app-charm-{n}.data_1")
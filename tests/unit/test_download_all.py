@@ -14,6 +14,11 @@ import mock
 def test_download_method(resource_list, resource_dl, snap_dl, app_dl, tmpdir, test_bundle, test_charm_config):
     args = mock.MagicMock()
     args.overlay = []
+    args.arch = None
+    args.packed_charms = False
+    args.only_apps = None
+    args.exclude_apps = None
+    args.image_allow = args.image_deny = args.image_map = None
     args.skip_snaps = False
     args.skip_resources = False
     args.skip_containers = False
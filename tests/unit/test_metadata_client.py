@@ -0,0 +1,93 @@
+import threading
+
+from shrinkwrap import MetadataClient, Metrics
+
+import mock
+import pytest
+import requests
+
+
+@pytest.fixture()
+def mock_get():
+    with mock.patch("shrinkwrap.requests.get") as mg:
+        yield mg
+
+
+def test_timeouts_and_latency(mock_get):
+    client = MetadataClient(connect_timeout=2, read_timeout=10)
+    assert client.latency(95) is None
+    for _ in range(5):
+        client.get("https://api.charmhub.io/v2/charms/info/etcd", params={"channel": "stable"})
+    mock_get.assert_called_with(
+        "https://api.charmhub.io/v2/charms/info/etcd", timeout=(2, 10), params={"channel": "stable"}
+    )
+    # too few responses are timed to hedge
+    assert client.hedge_delay() is None
+    assert client.report()["requests"] == 5 and client.report()["hedged"] == 0
+
+
+def test_hedged_request(mock_get):
+    client = MetadataClient(min_samples=0, min_delay=0.05)
+    client._latencies.extend([0.01] * 20)
+    slow, release = mock.Mock(name="slow"), threading.Event()
+
+    def get(url, **_kwargs):
+        if mock_get.call_count == 1:
+            release.wait(5)
+            return slow
+        return mock.Mock(name="fast")
+
+    mock_get.side_effect = get
+    assert client.hedge_delay() == 0.05
+    resp = client.get("https://api.github.com/repos/charmed-kubernetes/bundle/contents/overlays")
+    release.set()
+    assert resp is not slow and mock_get.call_count == 2
+    assert client.hedged == 1
+
+    # a hedge which fails falls back to the original request
+    mock_get.reset_mock()
+    release.clear()
+
+    def fail_hedge(url, **_kwargs):
+        if mock_get.call_count == 1:
+            release.wait(0.2)
+            return slow
+        raise requests.ConnectionError("reset")
+
+    mock_get.side_effect = fail_hedge
+    assert client.get("https://api.github.com") is slow
+    assert client.failures == 1
+
+    # downloads aren't hedged
+    mock_get.reset_mock()
+    mock_get.side_effect = None
+    timed = len(client._latencies)
+    client.get("https://api.charmhub.io/api/v1/charms/download/etcd.charm", hedge=False)
+    mock_get.assert_called_once()
+    # nor timed, so large transfers don't stretch the hedge delay of metadata requests
+    assert len(client._latencies) == timed
+
+
+def test_pooled_sessions(mock_get):
+    client = MetadataClient()
+    client.pool()
+    with mock.patch("shrinkwrap.requests.Session") as mock_session:
+        client.head("https://example.com/resource", allow_redirects=True)
+        client.head("https://example.com/resource", allow_redirects=True)
+    mock_session.assert_called_once_with()
+    assert mock_session.return_value.head.call_count == 2
+    mock_get.assert_not_called()
+
+
+@mock.patch("time.sleep")
+def test_timeouts_retried(_sleep, mock_get):
+    mock_get.side_effect = [requests.Timeout("read timed out"), mock.Mock(status_code=200)]
+    assert MetadataClient().get("https://api.snapcraft.io/v2/snaps/info/etcd").status_code == 200
+    assert mock_get.call_count == 2
+
+    # retried transfers are counted against the artifact being fetched
+    metrics = Metrics()
+    mock_get.side_effect = [requests.ConnectionError("reset"), mock.Mock(status_code=200)]
+    with metrics.artifact("charm", "etcd.charm"):
+        MetadataClient().get("https://api.charmhub.io/api/v1/charms/download/etcd.charm", hedge=False)
+    assert metrics.artifacts[0]["retries"] == 1
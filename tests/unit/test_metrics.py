@@ -0,0 +1,74 @@
+import json
+from pathlib import Path
+from subprocess import CalledProcessError
+
+from shrinkwrap import ContainerDownloader, Metrics, Resource, ResourceDownloader
+
+import mock
+
+
+def test_metrics_report(tmpdir):
+    metrics = Metrics()
+    with metrics.stage("snaps"):
+        with metrics.artifact("snap", "core") as record:
+            metrics.attempt()
+            metrics.attempt()
+            record["bytes"] = 2048
+        with metrics.artifact("snap", "lxd"):
+            pass
+    metrics.attempt()  # outside of any artifact
+
+    report = metrics.report()
+    assert set(report["stages"]) == {"snaps"}
+    core, lxd = report["artifacts"]
+    assert (core["bytes"], core["retries"], core["reused"]) == (2048, 1, False)
+    assert (lxd["bytes"], lxd["retries"], lxd["reused"]) == (0, 0, True)
+    assert report["totals"]["snap"]["count"] == 2
+    assert report["totals"]["snap"]["retries"] == 1
+
+    metrics.write(Path(tmpdir) / "build.metrics.json")
+    assert json.loads((Path(tmpdir) / "build.metrics.json").read_text())["totals"]["snap"]["bytes"] == 2048
+
+    metrics.write_prometheus(Path(tmpdir) / "shrinkwrap.prom")
+    text = (Path(tmpdir) / "shrinkwrap.prom").read_text()
+    assert "# TYPE shrinkwrap_stage_seconds gauge" in text
+    assert 'shrinkwrap_artifact_bytes{kind="snap"} 2048' in text
+    assert 'shrinkwrap_artifact_retries{kind="snap"} 1' in text
+
+
+def test_downloader_metrics(tmpdir):
+    metrics = Metrics()
+    downloader = ResourceDownloader(tmpdir, metrics=metrics)
+    resource = Resource("snapshot", "file", "snapshot.tar.gz", 0, "https://host/etcd/resource/snapshot/{revision}")
+    downloader.mark_download("etcd", "etcd", resource)
+
+    with mock.patch("shrinkwrap.check_call", side_effect=lambda cmd: Path(cmd[-1]).write_text("snapshot")):
+        downloader.download()
+    (record,) = metrics.artifacts
+    assert (record["kind"], record["bytes"]) == ("resource", len("snapshot"))
+
+
+@mock.patch("time.sleep")
+def test_retries_counted(_sleep, tmpdir):
+    metrics = Metrics()
+    resources = ResourceDownloader(tmpdir, metrics=metrics)
+    resource = Resource("snapshot", "file", "snapshot.tar.gz", 0, "https://host/etcd/resource/snapshot/{revision}")
+    resources.mark_download("etcd", "etcd", resource)
+
+    def flaky_wget(cmd):
+        if flaky_wget.failed:
+            return Path(cmd[-1]).write_text("snapshot")
+        flaky_wget.failed = True
+        raise CalledProcessError(4, cmd)
+
+    flaky_wget.failed = False
+    with mock.patch("shrinkwrap.check_call", side_effect=flaky_wget):
+        resources.download()
+    assert metrics.artifacts[0]["retries"] == 1
+
+    containers = ContainerDownloader(tmpdir, metrics=metrics)
+    with mock.patch("shrinkwrap.check_call", side_effect=[CalledProcessError(1, "docker pull"), None]), mock.patch(
+        "shrinkwrap.Popen", **{"return_value.returncode": 0}
+    ):
+        containers._image_save("pause:3.6", "amd64")
+    assert metrics.artifacts[1]["kind"] == "container" and metrics.artifacts[1]["retries"] == 1
@@ -0,0 +1,24 @@
+from pathlib import Path
+import pstats
+
+from shrinkwrap import Metrics, Profiler, load_yaml
+
+
+def test_profiler(tmpdir):
+    profiler = Profiler(Path(tmpdir) / "profile")
+    metrics = Metrics(profiler)
+    for _ in range(2):
+        with metrics.stage("charms"):
+            load_yaml("options: {channel: {default: stable}}")
+    with metrics.stage("bundle"):
+        kept = [bytes(2**16) for _ in range(16)]
+    profiler.write()
+
+    stats = pstats.Stats(str(profiler.path / "charms.pstats"))
+    (load_yaml_stats,) = [stat for func, stat in stats.stats.items() if func[2] == "load_yaml"]
+    assert load_yaml_stats[0] == 2, "both entries into the stage are profiled"
+    assert (profiler.path / "bundle.pstats").exists()
+    assert profiler.memory["bundle"]["peak"] >= len(kept) * 2**16
+    summary = (profiler.path / "memory.txt").read_text()
+    assert summary.startswith("charms: peak")
+    assert "test_profiler.py" in summary
@@ -0,0 +1,115 @@
+import hashlib
+import io
+import json
+from pathlib import Path
+import tarfile
+
+from shrinkwrap import ArtifactIndex, ImageArchive, image_archives, push_images
+from tests.standins import Registry, image_layer as _layer, save_image
+
+import pytest
+
+
+@pytest.fixture()
+def registry():
+    with Registry() as registry:
+        yield registry
+
+
+@pytest.fixture()
+def big_layer():
+    # larger than the inline size, so it's streamed from the archive
+    yield _layer(b"0123456789abcdef" * (ImageArchive.INLINE_SIZE // 8))
+
+
+def test_image_archive(tmpdir, big_layer):
+    base = _layer(b"base")
+    archive = ImageArchive(save_image(Path(tmpdir) / "pause:3.2.tar.gz", "pause:3.2", [base, big_layer]))
+    manifest = json.loads(archive.manifest)
+    assert [layer["size"] for layer in manifest["layers"]] == [len(base), len(big_layer)]
+    assert manifest["layers"][0]["digest"] == f"sha256:{hashlib.sha256(base).hexdigest()}"
+    assert archive.platform == {"architecture": "amd64", "os": "linux"}
+    assert archive.blobs[2].name not in archive.inline
+
+
+def test_push_images(tmpdir, registry, big_layer):
+    root = Path(tmpdir)
+    base = _layer(b"base")
+    save_image(root / "containers" / "pause:3.2.tar.gz", "pause:3.2", [base, _layer(b"pause")])
+    save_image(root / "containers" / "cdkbot" / "microbot:latest.tar.gz", "microbot", [base, big_layer])
+
+    push_images([str(root), "--registry", registry.url, "--workers", "1"])
+    assert ("cdk/pause", "3.2") in registry.manifests
+    assert ("cdk/cdkbot/microbot", "latest") in registry.manifests
+    # the base layer is mounted from the first repository it was pushed to
+    assert registry.requests["PUT", "uploads"] == 5
+    assert registry.requests["POST", "uploads"] == 6
+
+    registry.requests.clear()
+    push_images([str(root), "--registry", registry.url])
+    assert registry.requests["HEAD", "blobs"] == 6
+    assert registry.requests["PUT", "uploads"] == 0
+    assert registry.requests["PUT", "manifests"] == 2
+
+
+def test_push_images_mount_declined(tmpdir, big_layer):
+    root = Path(tmpdir)
+    save_image(root / "containers" / "pause:3.2.tar.gz", "pause:3.2", [big_layer])
+    save_image(root / "containers" / "cdkbot" / "microbot:latest.tar.gz", "microbot", [big_layer, _layer(b"bot")])
+
+    with Registry(mounts=False) as registry:
+        push_images([str(root), "--registry", registry.url, "--workers", "1"])
+        assert ("cdk/cdkbot/microbot", "latest") in registry.manifests
+        # the session of a declined mount uploads the blob or is cancelled, none are left open
+        assert registry.uploads == set()
+        assert registry.requests["DELETE", "uploads"] == 1
+        assert registry.requests["POST", "uploads"] == registry.requests["PUT", "uploads"] + 1
+
+
+def test_image_archive_linked_layers(tmpdir):
+    # docker save links a layer repeated within an image to its first copy
+    layer = _layer(b"repeated")
+    diff_id = f"sha256:{hashlib.sha256(layer).hexdigest()}"
+    config = json.dumps({"architecture": "amd64", "os": "linux", "rootfs": {"diff_ids": [diff_id] * 2}}).encode()
+    saved = [{"Config": "config.json", "RepoTags": ["pause:3.2"], "Layers": ["first/layer.tar", "second/layer.tar"]}]
+    path = Path(tmpdir) / "pause:3.2.tar.gz"
+    with tarfile.open(path, "w:gz") as tar:
+        for name, content in [("config.json", config), ("first/layer.tar", layer), ("manifest.json", saved)]:
+            content = content if isinstance(content, bytes) else json.dumps(content).encode()
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+        info = tarfile.TarInfo("second/layer.tar")
+        info.type, info.linkname = tarfile.SYMTYPE, "../first/layer.tar"
+        tar.addfile(info)
+
+    archive = ImageArchive(path)
+    assert [blob.name for blob in archive.blobs[1:]] == ["first/layer.tar"] * 2
+    assert [layer["size"] for layer in json.loads(archive.manifest)["layers"]] == [len(layer)] * 2
+
+
+def test_push_multi_arch_images(tmpdir, registry):
+    containers = Path(tmpdir) / "containers"
+    for arch, docker_arch in [("amd64", "amd64"), ("ppc64el", "ppc64le")]:
+        save_image(containers / arch / "pause:3.2.tar.gz", "pause:3.2", [_layer(arch.encode())], docker_arch)
+    assert set(image_archives(containers).values()) == {("pause:3.2", "amd64"), ("pause:3.2", "ppc64el")}
+
+    push_images([str(containers), "--registry", registry.url])
+    media_type, body = registry.manifests["cdk/pause", "3.2"]
+    assert media_type == ImageArchive.INDEX_TYPE
+    assert [m["platform"]["architecture"] for m in json.loads(body)["manifests"]] == ["amd64", "ppc64le"]
+
+
+def test_manifest_image_archives(tmpdir):
+    root = Path(tmpdir)
+    index = ArtifactIndex(root)
+    # repositories named like architectures, which scanning would mistake for a multi arch build
+    for image in ["amd64/busybox:1.36", "s390x/busybox:1.36"]:
+        archive = save_image(root / "containers" / f"{image}.tar.gz", image, [_layer(image.encode())])
+        index.add("container", archive, name=image)
+    save_image(root / "containers" / "stray:1.0.tar.gz", "stray:1.0", [_layer(b"stray")])
+    index.save()
+    assert image_archives(root / "containers") == {
+        root / "containers" / "amd64" / "busybox:1.36.tar.gz": ("amd64/busybox:1.36", None),
+        root / "containers" / "s390x" / "busybox:1.36.tar.gz": ("s390x/busybox:1.36", None),
+    }
@@ -0,0 +1,71 @@
+from pathlib import Path
+from subprocess import CalledProcessError, STDOUT
+
+from shrinkwrap import ArtifactIndex, push_snaps, PushJournal, read_journal
+
+import mock
+import pytest
+
+
+@pytest.fixture()
+def mock_push_cmd():
+    with mock.patch("shrinkwrap.check_output") as co:
+        yield co
+
+
+@pytest.fixture()
+def snaps_root(tmpdir):
+    root = Path(tmpdir)
+    for snap in ["core/stable", "etcd/3.4/stable", "kubectl/1.28/stable"]:
+        snap_path = root / "snaps" / snap
+        snap_path.mkdir(parents=True)
+        (snap_path / f"{snap.split('/')[0]}-20211019T154844.tar.gz").write_text(snap)
+    yield root
+
+
+def test_push_snaps(snaps_root, mock_push_cmd):
+    push_snaps([str(snaps_root)])
+    assert mock_push_cmd.call_count == 3
+    mock_push_cmd.assert_any_call(
+        ["snap-store-proxy", "push-snap", str(snaps_root / "snaps/core/stable/core-20211019T154844.tar.gz")],
+        stderr=STDOUT,
+        text=True,
+    )
+    journal = PushJournal(snaps_root / ".push_snaps.journal")
+    assert ("snaps/core/stable/core-20211019T154844.tar.gz", len("core/stable")) in journal
+
+    mock_push_cmd.reset_mock()
+    with journal.path.open("a") as fp:
+        fp.write('{"name": "snaps/interrupted')  # a push interrupted while recording
+    push_snaps([str(snaps_root)])
+    mock_push_cmd.assert_not_called()
+
+    push_snaps([str(snaps_root), "--force", "--workers", "1"])
+    assert mock_push_cmd.call_count == 3
+    assert len(read_journal(journal.path)) == 6, "entries after the partial line are read"
+
+
+def test_push_snaps_failure(snaps_root, mock_push_cmd):
+    def fail_etcd(cmd, **_kwargs):
+        if "etcd" in cmd[-1]:
+            raise CalledProcessError(1, cmd, "proxy unavailable")
+
+    mock_push_cmd.side_effect = fail_etcd
+    with pytest.raises(SystemExit) as exit_info:
+        push_snaps([str(snaps_root)])
+    assert str(exit_info.value) == "1 of 3 snaps failed to push, rerun to retry them"
+
+    mock_push_cmd.reset_mock(side_effect=True)
+    push_snaps([str(snaps_root)])
+    mock_push_cmd.assert_called_once()
+    assert "etcd" in mock_push_cmd.call_args.args[0][-1]
+
+
+def test_push_manifest_snaps(snaps_root, mock_push_cmd):
+    index = ArtifactIndex(snaps_root)
+    index.add("snap", snaps_root / "snaps/etcd/3.4/stable/etcd-20211019T154844.tar.gz", name="etcd")
+    index.save()
+    # only the snaps of the bundle's manifest are pushed
+    push_snaps([str(snaps_root)])
+    mock_push_cmd.assert_called_once()
+    assert mock_push_cmd.call_args.args[0][-1] == str(snaps_root / "snaps/etcd/3.4/stable/etcd-20211019T154844.tar.gz")
@@ -1,6 +1,6 @@
 from pathlib import Path
 
-from shrinkwrap import ResourceDownloader
+from shrinkwrap import METADATA, ResourceDownloader
 
 import mock
 import pytest
@@ -71,6 +71,7 @@ def test_resource_downloader(tmpdir, mock_requests, mock_wget_cmd):
     ]
     mock_requests.assert_called_once_with(
         "https://api.jujucharms.com/charmstore/v5/etcd/meta/resources",
+        timeout=METADATA.timeout,
         params={"channel": "stable"},
     )
 
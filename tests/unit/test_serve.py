@@ -0,0 +1,134 @@
+import io
+import json
+from pathlib import Path
+import threading
+from urllib.request import urlopen, Request
+from urllib.error import HTTPError
+
+from shrinkwrap import ArtifactStore, BuildService, BuildJob, _JobOutput, _ServiceHandler, thread_pool
+from http.server import ThreadingHTTPServer
+
+import mock
+import pytest
+
+
+@pytest.fixture()
+def service(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    service = BuildService(ArtifactStore(Path(tmpdir) / "store"), workers=2, output=_JobOutput(io.StringIO()))
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _ServiceHandler)
+    server.service = service
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    service.url = f"http://127.0.0.1:{server.server_port}"
+    yield service
+    server.shutdown()
+    server.server_close()
+    service.shutdown()
+
+
+def post(url, body):
+    request = Request(url, data=json.dumps(body).encode(), headers={"Content-Type": "application/json"})
+    with urlopen(request) as resp:
+        return resp.status, json.loads(resp.read())
+
+
+def test_build_job_parse():
+    job = BuildJob.parse("1", {"bundle": "cs:kubernetes-core", "channel": "1.24/stable", "arch": "amd64,arm64"})
+    assert (job.args.bundle, job.args.channel, job.args.arch) == (
+        "cs:kubernetes-core",
+        "1.24/stable",
+        ["amd64", "arm64"],
+    )
+    assert BuildJob.parse("2", {"bundle": "etcd", "overlay": ["a.yaml"], "skip_snaps": True}).args.skip_snaps
+    with pytest.raises(ValueError):
+        BuildJob.parse("3", {"channel": "stable"})
+    with pytest.raises(ValueError):
+        BuildJob.parse("4", {"bundle": "etcd", "use_path": "/tmp"})
+
+
+def test_serve_jobs(service, tmpdir):
+    release = threading.Event()
+
+    def build(args, store, root):
+        assert store is service.store
+        print(f"Building {args.bundle}")
+        with thread_pool(1) as pool:
+            pool.submit(print, f"Fetching {args.bundle} snaps").result()
+        release.wait(5)
+        Path(f"{root}.metrics.json").parent.mkdir(parents=True, exist_ok=True)
+        Path(f"{root}.metrics.json").write_text(json.dumps({"wall_seconds": 1.0}))
+        if args.bundle == "broken":
+            raise AssertionError("no such bundle")
+        return Path(f"{root}.tar.gz")
+
+    with mock.patch("shrinkwrap.build", side_effect=build), mock.patch("sys.stdout", service.output):
+        code, job = post(f"{service.url}/jobs", {"bundle": "etcd", "channel": "stable"})
+        assert (code, job["id"], job["bundle"]) == (202, "1", "etcd")
+        _, broken = post(f"{service.url}/jobs", {"bundle": "broken"})
+
+        with pytest.raises(HTTPError) as e:
+            post(f"{service.url}/jobs", {"channel": "stable"})
+        assert e.value.code == 400
+
+        release.set()
+        with urlopen(f"{service.url}/jobs/1/log") as resp:
+            assert resp.read().decode() == "Building etcd\nFetching etcd snaps\n"
+
+        with urlopen(f"{service.url}/jobs/1") as resp:
+            job = json.loads(resp.read())
+        assert job["state"] == "succeeded"
+        assert job["output"].endswith("-job1.tar.gz")
+        assert job["metrics"] == {"wall_seconds": 1.0}
+
+        with urlopen(f"{service.url}/jobs/{broken['id']}/log") as resp:
+            resp.read()
+        with urlopen(f"{service.url}/jobs") as resp:
+            jobs = {job["id"]: job for job in json.loads(resp.read())}
+        assert jobs["2"]["state"] == "failed"
+        assert jobs["2"]["error"] == "AssertionError: no such bundle"
+
+    with pytest.raises(HTTPError) as e:
+        urlopen(f"{service.url}/jobs/9")
+    assert e.value.code == 404
+
+
+def test_finished_jobs_forgotten(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    service = BuildService(ArtifactStore(Path(tmpdir) / "store"), workers=1, keep_jobs=1)
+    with mock.patch("shrinkwrap.build", side_effect=AssertionError("no such bundle")):
+        for _ in range(3):
+            job = service.submit({"bundle": "etcd"})
+            list(job.log())
+        service.submit({"bundle": "etcd"})
+        service.shutdown()
+    # only the newest finished job is kept, and ids aren't reused
+    assert list(service.jobs) == ["3", "4"]
+
+
+def test_store_coalesces_concurrent_fetches(tmpdir):
+    store = ArtifactStore(Path(tmpdir) / "store", ttl=0)
+    started, release = threading.Event(), threading.Event()
+
+    def fetch(path):
+        started.set()
+        release.wait(5)
+        path.write_text("charm")
+
+    fetch = mock.MagicMock(side_effect=fetch)
+    targets = [Path(tmpdir) / root / "etcd.charm" for root in ["first", "second"]]
+    threads = [threading.Thread(target=store.provide, args=("charms/etcd.charm", target, fetch)) for target in targets]
+    threads[0].start()
+    started.wait(5)
+    threads[1].start()
+    release.set()
+    for thread in threads:
+        thread.join()
+    fetch.assert_called_once()
+    assert all(target.read_text() == "charm" for target in targets)
+
+    # with a ttl, resolved metadata is refreshed once it expires
+    resolve = mock.MagicMock(return_value={"name": "etcd"})
+    store.memo(("charmhub", "etcd"), resolve)
+    store.memo(("charmhub", "etcd"), resolve)
+    assert resolve.call_count == 2
@@ -8,7 +8,7 @@ import pytest
 
 @pytest.fixture()
 def mock_snap_cmd():
-    with mock.patch("shrinkwrap.check_call"):
+    with mock.patch("shrinkwrap.check_call"), mock.patch("platform.machine", return_value="aarch64"):
         with mock.patch("shrinkwrap.check_output") as co:
             yield co
 
@@ -26,7 +26,21 @@ def test_snap_downloader(tmpdir, mock_snap_cmd):
 
     downloader.download()
     mock_snap_cmd.assert_called_once_with(
-        "snap-store-proxy fetch-snaps jq --channel=latest/stable".split(),
+        "snap-store-proxy fetch-snaps jq --channel=latest/stable --architecture=arm64".split(),
         stderr=STDOUT,
         text=True,
     )
+
+
+def test_snap_downloader_multi_arch(tmpdir, mock_snap_cmd):
+    downloader = SnapDownloader(tmpdir)
+    mock_snap_cmd.side_effect = lambda cmd, **_: f"Downloaded {cmd[2]} to /tmp/{cmd[2]}-{cmd[-1][-5:]}.tar.gz\n"
+    for arch in ["amd64", "arm64", "s390x"]:
+        downloader.mark_download("jq", "latest/stable", arch)
+
+    downloader.download()
+    assert sorted(call.args[0][-1] for call in mock_snap_cmd.call_args_list) == [
+        "--architecture=amd64",
+        "--architecture=arm64",
+        "--architecture=s390x",
+    ]
@@ -0,0 +1,69 @@
+import io
+import gzip
+from pathlib import Path
+from subprocess import CalledProcessError
+import tarfile
+
+from shrinkwrap import Metrics, S3Client, upload_archive, upload_stream
+from tests.standins import ObjectStore, payload
+
+import mock
+import pytest
+
+
+@pytest.fixture()
+def object_store():
+    with ObjectStore() as object_store:
+        yield object_store
+
+
+def test_upload_stream(object_store):
+    client = S3Client(object_store.url, "access", "secret")
+    data = payload(5 * 1024 + 7, "bundle")
+    size = upload_stream(client, "bundles", "ck/bundle.tar.gz", io.BytesIO(data), part_size=1024, workers=3)
+    assert size == len(data)
+    assert object_store.objects["bundles/ck/bundle.tar.gz"] == data
+    assert object_store.requests["PUT", "parts"] == 6
+
+    assert upload_stream(client, "bundles", "empty.tar.gz", io.BytesIO(b""), part_size=1024) == 0
+    assert object_store.objects["bundles/empty.tar.gz"] == b""
+
+
+def test_upload_stream_verifies_parts(object_store):
+    object_store.corrupt_parts.add(2)
+    client = S3Client(object_store.url, "access", "secret")
+    with pytest.raises(AssertionError, match="Part 2 of ck.tar.gz"):
+        upload_stream(client, "bundles", "ck.tar.gz", io.BytesIO(payload(4096)), part_size=1024, workers=2)
+    assert object_store.aborted == 1
+    assert object_store.objects == {} and object_store.uploads == {}
+
+    # parts encrypted with KMS keys have ETags which aren't their md5
+    object_store.corrupt_parts.clear()
+    object_store.encryption = "aws:kms"
+    assert upload_stream(client, "bundles", "ck.tar.gz", io.BytesIO(payload(4096)), part_size=1024) == 4096
+    assert object_store.objects["bundles/ck.tar.gz"] == payload(4096)
+
+
+def test_upload_archive(tmpdir, object_store):
+    root = Path(tmpdir) / "charmed-kubernetes-1.29" / "stable-2024-01-01-00-00-00"
+    (root / "charms").mkdir(parents=True)
+    (root / "bundle.yaml").write_text("applications: {}")
+    env = {"AWS_ENDPOINT_URL": object_store.url, "AWS_ACCESS_KEY_ID": "access", "AWS_SECRET_ACCESS_KEY": "secret"}
+    metrics = Metrics()
+
+    with mock.patch.dict("os.environ", env):
+        url = upload_archive(root, "s3://bundles/releases/", metrics, base=Path(tmpdir))
+    key = "releases/charmed-kubernetes-1.29/stable-2024-01-01-00-00-00.tar.gz"
+    assert url == f"s3://bundles/{key}"
+    with tarfile.open(fileobj=io.BytesIO(gzip.decompress(object_store.objects[f"bundles/{key}"]))) as tar:
+        assert "charmed-kubernetes-1.29/stable-2024-01-01-00-00-00/bundle.yaml" in tar.getnames()
+    assert metrics.artifacts[0]["kind"] == "upload"
+    assert metrics.artifacts[0]["bytes"] == len(object_store.objects[f"bundles/{key}"])
+
+
+def test_upload_archive_tar_fails(tmpdir, object_store):
+    env = {"AWS_ENDPOINT_URL": object_store.url, "AWS_ACCESS_KEY_ID": "access", "AWS_SECRET_ACCESS_KEY": "secret"}
+    with mock.patch.dict("os.environ", env), pytest.raises(CalledProcessError):
+        upload_archive(Path(tmpdir) / "missing", "s3://bundles/releases/", Metrics())
+    # the truncated tarball isn't published
+    assert object_store.objects == {} and object_store.aborted == 1
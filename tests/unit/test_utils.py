@@ -1,7 +1,10 @@
 from pathlib import Path
+import threading
 import yaml
 
-from shrinkwrap import remove_suffix, remove_prefix, charm_snap_channel
+from shrinkwrap import DocumentCache, UMASK, remove_suffix, remove_prefix, charm_snap_channel, arch_list
+
+import mock
 
 
 def test_remove_prefix():
@@ -26,3 +29,67 @@ def test_charm_channel(tmpdir, test_charm_config, test_bundle):
     etcd = bundle[test_bundle.apps]["etcd"]
 
     assert charm_snap_channel(etcd, charm_path) == "3.4/stable"
+
+    # parsed once, then reused by later builds
+    documents = DocumentCache(Path(tmpdir) / "documents.json")
+    assert charm_snap_channel(etcd, charm_path, documents) == "3.4/stable"
+    documents.save()
+    with mock.patch("shrinkwrap.load_yaml") as load_yaml:
+        assert charm_snap_channel(etcd, charm_path, DocumentCache(Path(tmpdir) / "documents.json")) == "3.4/stable"
+    load_yaml.assert_not_called()
+
+
+def test_document_cache(tmpdir):
+    documents = DocumentCache(Path(tmpdir) / "documents.json")
+    loaded = documents.load(b"applications:\n  etcd: {num_units: 3}\n")
+    loaded["applications"]["etcd"]["num_units"] = 1
+    # every load is a fresh copy
+    assert documents.load(b"applications:\n  etcd: {num_units: 3}\n") == {"applications": {"etcd": {"num_units": 3}}}
+
+    # documents which don't survive json aren't kept
+    assert documents.load(b"released: 2024-01-01\n")["released"].year == 2024
+    documents.save()
+    assert len(DocumentCache(Path(tmpdir) / "documents.json")._documents) == 1
+
+
+def test_document_cache_bounded(tmpdir):
+    path = Path(tmpdir) / "documents.json"
+    documents = DocumentCache(path, max_documents=3)
+    for i in range(4):
+        documents.load(f"name: charm-{i}\n".encode())
+    documents.load(b"name: charm-0\n")
+    documents.save()
+    # the least recently used are dropped, and the file is as readable as any other in a shared store
+    with mock.patch("shrinkwrap.load_yaml") as load_yaml:
+        documents = DocumentCache(path)
+        for i in (0, 2, 3):
+            documents.load(f"name: charm-{i}\n".encode())
+    load_yaml.assert_not_called()
+    assert len(documents._documents) == 3
+    assert path.stat().st_mode & 0o777 == 0o666 & ~UMASK
+
+
+def test_document_cache_shared(tmpdir):
+    path = Path(tmpdir) / "documents.json"
+
+    def build(n):
+        documents = DocumentCache(path)
+        for i in range(20):
+            documents.load(f"name: charm-{n}-{i}\n".encode())
+            documents.save()
+
+    threads = [threading.Thread(target=build, args=(n,)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # concurrent builds keep each other's documents
+    assert len(DocumentCache(path)._documents) == 80
+    assert [p.name for p in Path(tmpdir).iterdir()] == ["documents.json"]
+
+
+def test_arch_list():
+    assert arch_list(None) is None
+    assert arch_list(["amd64"]) == ["amd64"]
+    assert arch_list(["amd64,arm64", "s390x", "arm64"]) == ["amd64", "arm64", "s390x"]
+    assert arch_list([","]) is None
@@ -0,0 +1,81 @@
+import os
+from pathlib import Path
+import tarfile
+
+from shrinkwrap import ArtifactIndex, file_digest, verify, verify_archive, verify_tree
+
+import mock
+import pytest
+
+
+@pytest.fixture()
+def bundle(tmpdir):
+    root = Path(tmpdir) / "etcd-bundle"
+    charm = root / "charms" / "etcd" / "stable"
+    (charm / "hooks").mkdir(parents=True)
+    (charm / "metadata.yaml").write_text("name: etcd")
+    (charm / "hooks" / "install").write_text("#!/bin/sh")
+    snap = root / "snaps" / "etcd" / "3.4" / "etcd-20220101.tar.gz"
+    snap.parent.mkdir(parents=True)
+    snap.write_bytes(b"snap" * 1024)
+    (root / "snaps" / ".empty.snap").touch()
+    resource = root / "resources" / "etcd" / "core" / "core.snap"
+    resource.parent.mkdir(parents=True)
+    os.symlink(os.path.relpath(root / "snaps" / ".empty.snap", resource.parent), resource)
+
+    index = ArtifactIndex(root)
+    index.add("charm", charm, app="etcd", name="etcd")
+    index.add("snap", snap, name="etcd")
+    index.add("resource", resource, app="etcd", name="core")
+    index.save()
+    return root
+
+
+def archive(root):
+    path = Path(f"{root}.tar.gz")
+    with tarfile.open(path, "w:gz") as tar:
+        tar.add(root, arcname=root.name)
+    return path
+
+
+def test_file_digest_mmap(tmpdir):
+    path = Path(tmpdir) / "image.tar.gz"
+    path.write_bytes(b"layer" * 1000)
+    buffered = file_digest(path)
+    with mock.patch("shrinkwrap.MMAP_DIGEST_SIZE", 16):
+        assert file_digest(path) == buffered
+
+    class Mapped(bytes):
+        # python 3.7's memory maps can't be advised
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *_):
+            pass
+
+    with mock.patch("shrinkwrap.MMAP_DIGEST_SIZE", 16), mock.patch(
+        "mmap.mmap", lambda *_, **__: Mapped(b"layer" * 1000)
+    ):
+        assert file_digest(path) == buffered
+
+
+def test_verify_tree(bundle, capsys):
+    assert verify_tree(bundle, workers=4) == []
+    verify([str(bundle)])
+    assert "Verified" in capsys.readouterr().out
+
+    (bundle / "charms" / "etcd" / "stable" / "hooks" / "install").write_text("#!/bin/bash")
+    (bundle / "snaps" / "etcd" / "3.4" / "etcd-20220101.tar.gz").unlink()
+    failed = {artifact.kind: reason for artifact, reason in verify_tree(bundle)}
+    assert failed == {"charm": "digest mismatch", "snap": "missing"}
+    with pytest.raises(SystemExit, match="2 artifacts"):
+        verify([str(bundle)])
+
+
+def test_verify_archive(bundle):
+    assert verify_archive(archive(bundle)) == []
+
+    (bundle / "snaps" / "etcd" / "3.4" / "etcd-20220101.tar.gz").write_bytes(b"corrupt")
+    (bundle / "resources" / "etcd" / "core" / "core.snap").unlink()
+    failed = {artifact.kind: reason for artifact, reason in verify_archive(archive(bundle))}
+    assert failed == {"snap": "digest mismatch", "resource": "missing"}